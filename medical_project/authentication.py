@@ -3,61 +3,82 @@
 # This includes registering patients, authenticating patients, and resetting PINs
 # Each patient will be authenticated with a unique PIN
 
-import hashlib
+import logging
+import os
+import time
 from datetime import datetime
 import random
-import json
+
+from credential_hashing import CredentialHasher, ssn_lookup_hash, upgrade_ssn_hash
+from event_log import elapsed_ms, get_logger, log_event
+from key_wrapping import DEFAULT_MASTER_KEYS_PATH, MasterKeyStore
+from metrics import METRICS
+from storage import DuplicatePatientError, JsonPatientStore
+
+logger = get_logger('authentication')
 
 # This class will handle the authentication of patients
 class PatientAuthenticator:
     
     # This function will initialize the authenticator and store the patients
-    # In real practice this would be stored in a database
-    def __init__(self):
-        self.patients = {}
-        self.patient_id_counter = 1
+    # Patients live in a store (JSON file by default, or a SQLite database - see storage.py)
+    # PINs and passwords are hashed with the hasher (salted scrypt by default, see credential_hashing.py)
+    # Timings and counters go to metrics (the shared registry by default, see metrics.py)
+    # SSNs are looked up by an HMAC keyed with lookup_key (by default the ssn_lookup_key kept in
+    # master_keys.json next to patients_path, see key_wrapping.py)
+    def __init__(self, patients_path='patients_data.json', store=None, hasher=None, metrics=None,
+                 lookup_key=None):
+        self.store = store if store is not None else JsonPatientStore(patients_path)
+        self.hasher = hasher if hasher is not None else CredentialHasher()
+        self.metrics = metrics if metrics is not None else METRICS
+        if lookup_key is None:
+            master_keys_path = os.path.join(os.path.dirname(patients_path), DEFAULT_MASTER_KEYS_PATH)
+            lookup_key = MasterKeyStore(master_keys_path).ssn_lookup_key()
+        self.lookup_key = lookup_key
+        # Hash used to keep failed logins for unknown SSNs as slow as real ones
+        self.dummy_hash = None
+        # Read-only dict-like view of patient_id -> patient
+        self.patients = self.store
         self.load_patients()
     
+    # Keyed HMAC of the SSN, which has to be looked up by its hash so it can't be salted
+    # Without the server-side key the hash can't be brute-forced from a stolen patient file
     def hash_credential(self, credential):
-        
-        # Encoding credential to bytes
-        credential_bytes = credential.encode('utf-8')
-        
-        # Hashing the credential using SHA-256
-        hashed_credential = hashlib.sha256(credential_bytes).hexdigest()
-        
-        # Returning hashed credential
-        return hashed_credential
+        return ssn_lookup_hash(credential, self.lookup_key)
+
+    # Finds a patient by their hashed SSN, returns None if not found
+    def find_patient_by_ssn_hash(self, ssn_hash):
+        return self.store.find_by_ssn_hash(ssn_hash)
+
+    # Finds a patient by their email, returns None if not found
+    def find_patient_by_email(self, email):
+        return self.store.find_by_email(email)
 
     # This function will register a new patient
+    # The new PIN is only ever returned to the caller, never logged
     def register_patient(self, ssn, name, email, password):
-        print(f"\n{'='*60}")
-        print(f"REGISTERING NEW PATIENT: {name}")
-        print(f"{'='*60}")
+        start = time.perf_counter()
         
         # Check if patient already exists
         ssn_hash = self.hash_credential(ssn)
-        for patient in self.patients.values():
-            if patient['ssn_hash'] == ssn_hash:
-                print(f"Patient already exists")
-                return False, patient['patient_id'], None, "Patient already exists"
+        patient = self.find_patient_by_ssn_hash(ssn_hash)
+        if patient is not None:
+            log_event(logger, 'patient.exists', "Patient already exists",
+                      patient_id=patient['patient_id'])
+            return False, patient['patient_id'], None, "Patient already exists"
         
         # Generate a random 6-digit PIN
         import random
         pin = str(random.randint(100000, 999999))
-        print(f"\nGenerated PIN: {pin}")
-        print(f"\n\tGive this to the patient on paper!")
         
-        # Hash all credentials
-        ssn_hash = self.hash_credential(ssn)
-        pin_hash = self.hash_credential(pin)
-        password_hash = self.hash_credential(password)
+        # Hash the remaining credentials with the slow salted hasher (ssn_hash was computed above)
+        with self.metrics.timer('credential_hash', secrets=2):
+            pin_hash, password_hash = self.hasher.hash_many([pin, password])
         
         # Store patient information
-        patient_id = self.patient_id_counter
-        self.patient_id_counter += 1
+        patient_id = self.store.allocate_patient_id()
         
-        self.patients[patient_id] = {
+        patient = {
             'patient_id': patient_id,
             'name': name,
             'ssn_hash': ssn_hash,        # Hashed - can't reverse!
@@ -66,68 +87,108 @@ class PatientAuthenticator:
             'email': email,
             'registered_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }
-        
-        print(f"\nPatient registered successfully!")
-        print(f"\tPatient ID: {patient_id}")
-        print(f"\tName: {name}")
-        print(f"\tEmail: {email}")
-        print(f"\n{'='*40}")
+        try:
+            self.store.put(patient)
+        except DuplicatePatientError:
+            # Registered by another process since the lookup above
+            existing = self.find_patient_by_ssn_hash(ssn_hash)
+            existing_id = existing['patient_id'] if existing is not None else None
+            log_event(logger, 'patient.exists', "Patient already exists", patient_id=existing_id)
+            return False, existing_id, None, "Patient already exists"
+        
+        self.metrics.increment('registrations')
+        self.metrics.record_call('register', time.perf_counter() - start, patient_id=patient_id)
+        log_event(logger, 'patient.registered', f"Patient {patient_id} registered successfully",
+                  patient_id=patient_id, duration_ms=elapsed_ms(start))
         
         return True, patient_id, pin, "Registration successful"
     
     # Used to verify a patients login credentials
     def authenticate_patient(self, ssn, pin, password):
-        
-        print(f"\n{'='*60}")
-        print(f"AUTHENTICATING PATIENT")
-        print(f"{'='*60}")
-        
+        start = time.perf_counter()
         
         hashed_ssn = self.hash_credential(ssn)
-        hashed_pin = self.hash_credential(pin)
-        hashed_password = self.hash_credential(password)
 
-        for patient in self.patients.values():
-            if patient['ssn_hash'] == hashed_ssn and patient['pin_hash'] == hashed_pin and patient['password_hash'] == hashed_password:
-                
-                return True, patient['patient_id'], f"Welcome, {patient['name']}!"
-            
+        # Look the patient up by SSN, then check the other two factors
+        patient = self.find_patient_by_ssn_hash(hashed_ssn)
+        if patient is None:
+            # Do the same amount of hashing work so an unknown SSN can't be told apart by timing
+            if self.dummy_hash is None:
+                self.dummy_hash = self.hasher.hash('dummy')
+            with self.metrics.timer('credential_verify'):
+                self.hasher.verify_many([(pin, self.dummy_hash), (password, self.dummy_hash)])
+            self.record_login(False, start, None)
+            log_event(logger, 'auth.failed', "Authentication failed!", logging.WARNING,
+                      patient_id=None, duration_ms=elapsed_ms(start))
+            return False, None, "Invalid credentials"
+
+        # The slow verification runs on the hasher's worker threads
+        with self.metrics.timer('credential_verify', patient_id=patient['patient_id']):
+            verified = self.hasher.verify_many([(pin, patient['pin_hash']),
+                                                (password, patient['password_hash'])])
+        if verified:
+            self.upgrade_hashes(patient, pin, password)
+            self.record_login(True, start, patient['patient_id'])
+            log_event(logger, 'auth.succeeded', f"Patient {patient['patient_id']} authenticated",
+                      patient_id=patient['patient_id'], duration_ms=elapsed_ms(start))
+            return True, patient['patient_id'], f"Welcome, {patient['name']}!"
                 
-        print(f"Authentication failed!")
+        self.record_login(False, start, patient['patient_id'])
+        log_event(logger, 'auth.failed', "Authentication failed!", logging.WARNING,
+                  patient_id=patient['patient_id'], duration_ms=elapsed_ms(start))
         return False, None, "Invalid credentials"
+
+    # Counts a login attempt and times it
+    def record_login(self, success, start, patient_id):
+        self.metrics.increment('auth_successes' if success else 'auth_failures')
+        self.metrics.record_call('authenticate', time.perf_counter() - start, patient_id=patient_id)
+
+    # Re-hashes a patient's PIN and password after a successful login if they were stored
+    # with the old unsalted SHA-256 or with different cost settings
+    def upgrade_hashes(self, patient, pin, password):
+        if not (self.hasher.needs_rehash(patient['pin_hash']) or
+                self.hasher.needs_rehash(patient['password_hash'])):
+            return
+        with self.metrics.timer('credential_hash', secrets=2):
+            patient['pin_hash'], patient['password_hash'] = self.hasher.hash_many([pin, password])
+        self.store.put(patient)
+        self.save_patients()
+        self.metrics.increment('credential_rehashes')
+        log_event(logger, 'auth.rehashed', f"Upgraded credential hashes for patient {patient['patient_id']}",
+                  patient_id=patient['patient_id'])
     
     # Function incase patient forgets their pin 
+    # Like register_patient, the new PIN is returned but never logged
     def reset_pin(self, ssn, email):
-        print(f"\n{'='*60}")
-        print(f"PIN RECOVERY")
-        print(f"{'='*60}")
-        
-        
         # Hash the SSN
         hashed_ssn = self.hash_credential(ssn)
         # Find the patient with matching SSN hash
-        for patient in self.patients.values():
-            if patient['ssn_hash'] == hashed_ssn:
-                # Verify the email matches
-                if patient['email'] != email:
-                    print(f"\nEmail does not match")
-                    return False, None, "Invalid Credentials"
-
-                new_pin = str(random.randint(100000,999999))
-                    # Hash the new PIN
-                hashed_new_pin = self.hash_credential(new_pin)
-                    # Update patient['pin_hash'] with the new hash
-                patient['pin_hash'] = hashed_new_pin
+        patient = self.find_patient_by_ssn_hash(hashed_ssn)
+        if patient is not None:
+            # Verify the email matches
+            if patient['email'] != email:
+                log_event(logger, 'pin.reset_failed', "Email does not match", logging.WARNING,
+                          patient_id=patient['patient_id'])
+                return False, None, "Invalid Credentials"
 
-                print(f"Pin successfully reseted")
-                print(f"New Pin: {new_pin}")
+            new_pin = str(random.randint(100000,999999))
+            # Hash the new PIN
+            with self.metrics.timer('credential_hash', secrets=1):
+                hashed_new_pin = self.hasher.hash(new_pin)
+            # Update patient['pin_hash'] with the new hash
+            patient['pin_hash'] = hashed_new_pin
+            # Write the updated entry back to the store
+            self.store.put(patient)
 
-                self.save_patients()
+            self.save_patients()
+            self.metrics.increment('pin_resets')
+            log_event(logger, 'pin.reset', f"Pin successfully reset for patient {patient['patient_id']}",
+                      patient_id=patient['patient_id'])
 
-                return True, new_pin, "Pin reset successful"
+            return True, new_pin, "Pin reset successful"
     
         
-        print(f"Invalid Credentials")
+        log_event(logger, 'pin.reset_failed', "Invalid Credentials", logging.WARNING, patient_id=None)
         return False, None, "Patient not found"
 
 
@@ -152,24 +213,35 @@ class PatientAuthenticator:
 
     # Save patients to file
     def save_patients(self):
-        data = {
-            'patients': self.patients,
-            'patient_id_counter': self.patient_id_counter
-        }
-        with open('patients_data.json', 'w') as f:
-            json.dump(data, f, indent=2)
+        with self.metrics.timer('patients_save', patients=len(self.patients)):
+            self.store.save()
     
     # Load patients from file
     def load_patients(self):
+        start = time.perf_counter()
         try:
-            with open('patients_data.json', 'r') as f:
-                data = json.load(f)
-                self.patients = data['patients']
-                # Convert string keys back to integers
-                self.patients = {int(k): v for k, v in self.patients.items()}
-                self.patient_id_counter = data['patient_id_counter']
-            print(f"Loaded {len(self.patients)} patients from file")
+            self.store.load()
+            self.upgrade_ssn_hashes()
+            self.metrics.record_call('patients_load', time.perf_counter() - start, patients=len(self.patients))
+            log_event(logger, 'patients.loaded', f"Loaded {len(self.patients)} patients from file",
+                      patients=len(self.patients), duration_ms=elapsed_ms(start))
         except FileNotFoundError:
-            print("No existing patient data found, starting fresh")
+            log_event(logger, 'patients.not_found', "No existing patient data found, starting fresh")
         except Exception as e:
-            print(f"Error loading patients: {e}")
+            log_event(logger, 'patients.load_failed', f"Error loading patients: {e}", logging.ERROR,
+                      error=type(e).__name__)
+
+    # Replaces the unkeyed SHA-256 SSN hashes of patients stored before the lookup hash was keyed
+    # The keyed hash is made from the old hash, so no SSN is needed and it runs once at load
+    def upgrade_ssn_hashes(self):
+        patients = self.store.patients_with_unkeyed_ssn_hash()
+        if not patients:
+            return
+        for patient in patients:
+            # A copy, so the store can take the old hash out of its index
+            upgraded = dict(patient)
+            upgraded['ssn_hash'] = upgrade_ssn_hash(patient['ssn_hash'], self.lookup_key)
+            self.store.put(upgraded)
+        self.save_patients()
+        log_event(logger, 'patients.ssn_hashes_upgraded', f"Keyed the SSN hashes of {len(patients)} patients",
+                  patients=len(patients))
@@ -0,0 +1,82 @@
+# Credential Hashing Benchmark
+# Measures how many logins per second can be verified at each hashing cost setting,
+# both one at a time and from several threads at once (as the HTTP service's threads log patients in)
+#
+# Usage:
+#   python benchmarks/bench_hashing.py
+#   python benchmarks/bench_hashing.py --logins 200 --workers 8 --json results.json
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# The project modules live one folder up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from credential_hashing import PBKDF2, SCRYPT, CredentialHasher, legacy_sha256, verify_all
+
+# (label, scheme, cost) for every setting that is measured
+COST_SETTINGS = [
+    ('scrypt n=2^12', SCRYPT, (2 ** 12, 8, 1)),
+    ('scrypt n=2^14 (default)', SCRYPT, (2 ** 14, 8, 1)),
+    ('scrypt n=2^15', SCRYPT, (2 ** 15, 8, 1)),
+    ('pbkdf2 100k', PBKDF2, (100000,)),
+    ('pbkdf2 600k', PBKDF2, (600000,)),
+]
+
+
+# Verifies `logins` logins (PIN + password each) from `threads` threads, returns logins per second
+def logins_per_second(hasher, pairs, logins, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(lambda _: hasher.verify_many(pairs), range(logins)))
+    if not all(results):
+        raise RuntimeError("Verification unexpectedly failed")
+    return logins / (time.perf_counter() - start)
+
+
+# Runs every cost setting and returns a list of result dicts
+def run(logins, workers):
+    results = []
+
+    # Legacy unsalted SHA-256 as the baseline
+    pairs = [('123456', legacy_sha256('123456')), ('password', legacy_sha256('password'))]
+    start = time.perf_counter()
+    for _ in range(logins):
+        verify_all(pairs)
+    results.append({'setting': 'legacy sha256', 'threads': 1,
+                    'logins_per_second': round(logins / (time.perf_counter() - start), 1)})
+
+    for label, scheme, cost in COST_SETTINGS:
+        for threads in sorted({1, workers}):
+            hasher = CredentialHasher(scheme, cost, workers=workers)
+            pairs = [('123456', hasher.hash('123456')), ('password', hasher.hash('password'))]
+            # Fewer logins on a single thread so slow settings don't take forever
+            count = logins if threads > 1 else max(1, logins // 4)
+            rate = logins_per_second(hasher, pairs, count, threads)
+            hasher.shutdown()
+            results.append({'setting': label, 'threads': threads, 'logins_per_second': round(rate, 1)})
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark credential hashing cost settings")
+    parser.add_argument('--logins', type=int, default=40, help="logins to verify per setting")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="threads logging in at once (also the hasher's thread pool size)")
+    parser.add_argument('--json', help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(args.logins, args.workers)
+
+    print(f"{'Setting':<28}{'Threads':>8}{'Logins/sec':>14}")
+    for result in results:
+        print(f"{result['setting']:<28}{result['threads']:>8}{result['logins_per_second']:>14}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
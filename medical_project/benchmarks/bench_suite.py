@@ -0,0 +1,607 @@
+# Record System Benchmark Suite
+# Measures the main paths of the system on synthetic data so runs can be compared over time:
+#   encrypt  - encrypt_file / decrypt_file throughput for a range of file sizes
+#   keys     - save_keys / load_keys time, file size and memory against the number of records
+#   auth     - register_patient / authenticate_patient latency against the number of patients
+#   view     - end-to-end view_my_records for patients with 1 to 1000 records
+#   memory   - memory and load time of up to 1M key records and patients, as plain dicts
+#              and as the compact records the JSON stores keep (see compact_records.py)
+#
+# Everything runs in a temporary folder that is deleted afterwards; nothing real is touched
+# Results are printed and can be written as JSON, then compared against an earlier run
+#
+# Usage:
+#   python benchmarks/bench_suite.py
+#   python benchmarks/bench_suite.py --only encrypt --sizes 1K,1M,1G --repeat 1
+#   python benchmarks/bench_suite.py --json today.json --compare baseline.json
+#   python benchmarks/bench_suite.py --only memory --memory-counts 1000000
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+# The project modules live one folder up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.fernet import Fernet
+
+from authentication import PatientAuthenticator
+from compact_records import compact_key_record, compact_patient
+from credential_hashing import PBKDF2, CredentialHasher, ssn_lookup_hash
+from encryption import MedicalFileEncryptor, encrypt_file_contents
+from key_journal import KeyJournal
+from key_wrapping import KeyEnvelope, MasterKeyStore
+from main_system import MedicalRecordSystem
+from metrics import MetricsRegistry
+from storage import JsonKeyStore, SQLiteKeyStore
+
+BENCHMARKS = ('encrypt', 'keys', 'auth', 'view', 'memory')
+
+DEFAULT_SIZES = '1K,64K,1M,16M,64M'
+DEFAULT_RECORD_COUNTS = '1000,10000,100000'
+DEFAULT_REGISTRY_SIZES = '10,1000,10000'
+DEFAULT_VIEW_COUNTS = '1,10,100,1000'
+DEFAULT_MEMORY_COUNTS = '100000,1000000'
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+WRITE_PIECE_SIZE = 1024 * 1024
+# SSN lookup key for synthetic patients (their SSNs are never looked up)
+FILLER_LOOKUP_KEY = b'bench-filler-lookup-key'
+
+# A line of a synthetic lab report; view_my_records decodes records as text
+LAB_LINE = "Glucose: 95 mg/dL | Hemoglobin: 14.2 g/dL | WBC: 6.1 K/uL | Platelets: 250 K/uL\n"
+
+
+# Turns '64K', '1M' or '2G' into a number of bytes
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+# Turns '1,10,100' into [1, 10, 100]
+def parse_list(text, convert=int):
+    return [convert(item) for item in text.split(',') if item.strip()]
+
+
+# Writes a file of random bytes without holding it all in memory
+def write_random_file(path, size):
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            piece = min(remaining, WRITE_PIECE_SIZE)
+            f.write(os.urandom(piece))
+            remaining -= piece
+
+
+# Writes a text file that looks like a lab report
+def write_lab_file(path, size):
+    lines = LAB_LINE * (size // len(LAB_LINE) + 1)
+    with open(path, 'w') as f:
+        f.write(lines[:size])
+
+
+# min / median / p95 / mean of a list of timings, in seconds
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'min_seconds': round(ordered[0], 6),
+        'median_seconds': round(statistics.median(ordered), 6),
+        'p95_seconds': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 6),
+        'mean_seconds': round(statistics.mean(ordered), 6),
+    }
+
+
+# Runs a function and returns (seconds taken, its result)
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+# Megabytes per second for size bytes in seconds
+def mb_per_second(size, seconds):
+    return round(size / (1024 * 1024) / seconds, 2) if seconds > 0 else 0.0
+
+
+# Runs the body inside a fresh temporary folder (the system writes its files to the working folder)
+@contextmanager
+def scratch_dir():
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='medical-bench-') as path:
+        os.chdir(path)
+        try:
+            yield path
+        finally:
+            os.chdir(previous)
+
+
+# A hasher that runs on the calling thread; fast=True uses a cheap setting so only
+# the registry and storage costs are measured
+def make_hasher(fast):
+    if fast:
+        return CredentialHasher(PBKDF2, (1000,), workers=0)
+    return CredentialHasher(workers=0)
+
+
+# A key store entry shaped like the ones MedicalFileEncryptor.build_record makes
+def synthetic_record(envelope, record_id, patient_id):
+    record_info = {
+        'record_id': record_id,
+        'patient_id': patient_id,
+        'record_type': ('blood_test', 'x_ray', 'mri', 'prescription')[record_id % 4],
+        'original_filename': f"report_{record_id}.txt",
+        'encrypted_filename': f"encrypted_{record_id}_report_{record_id}.txt.enc",
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'file_size': 4096,
+        'format': 'stream',
+    }
+    record_info.update(envelope.wrap_fields(record_id, Fernet.generate_key()))
+    return record_info
+
+
+# A patient entry with a pre-computed credential hash, so large registries are quick to build
+def synthetic_patient(patient_id, credential_hash):
+    return {
+        'patient_id': patient_id,
+        'name': f"Patient {patient_id}",
+        'ssn_hash': ssn_lookup_hash(f"filler-{patient_id}", FILLER_LOOKUP_KEY),
+        'pin_hash': credential_hash,
+        'password_hash': credential_hash,
+        'email': f"patient{patient_id}@example.com",
+        'registered_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+# A key store entry with every optional field filled in (compressed, typed, deduplicated),
+# built without real key wrapping so a million of them are quick to make
+def full_synthetic_record(record_id):
+    digest = hashlib.sha256(str(record_id).encode()).hexdigest()
+    return {
+        'record_id': record_id,
+        'patient_id': record_id % 50000 + 1,
+        'record_type': ('blood_test', 'x_ray', 'mri', 'prescription')[record_id % 4],
+        'original_filename': f"report_{record_id}.txt",
+        'encrypted_filename': f"blobs/{digest[:2]}/{digest[2:4]}/{record_id}.enc",
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(1700000000 + record_id * 7)),
+        'file_size': 4096 + record_id % 1000,
+        'format': 'stream',
+        'compression': 'zlib',
+        'stored_size': 1500 + record_id % 500,
+        'compress_ms': 0.125,
+        'content_type': 'text/plain',
+        'fingerprint': digest,
+        'wrapped_key': base64.b64encode(os.urandom(72)).decode(),
+        'kek_id': 'kek-20260101000000-0a1b2c3d',
+    }
+
+
+# Writes count records to a key snapshot one at a time, so the benchmark never holds them all
+def write_key_snapshot(path, count):
+    with open(path, 'w') as f:
+        f.write('{')
+        for record_id in range(1, count + 1):
+            separator = ',' if record_id > 1 else ''
+            f.write(f'{separator}\n"{record_id}": {json.dumps(full_synthetic_record(record_id))}')
+        f.write('\n}')
+
+
+# Writes count patients to a patients file one at a time
+def write_patients_file(path, count, credential_hash):
+    with open(path, 'w') as f:
+        f.write('{"patients": {')
+        for patient_id in range(1, count + 1):
+            separator = ',' if patient_id > 1 else ''
+            f.write(f'{separator}\n"{patient_id}": {json.dumps(synthetic_patient(patient_id, credential_hash))}')
+        f.write(f'\n}}, "patient_id_counter": {count + 1}, "version": 1}}')
+
+
+# Loads a key snapshot the way the JSON key store did before compact records, and the way it does now
+def load_plain_keys(path):
+    with open(path) as f:
+        return {int(k): v for k, v in json.load(f).items()}
+
+
+def load_compact_keys(path):
+    return KeyJournal(path, record_factory=compact_key_record).load()
+
+
+# Loads a patients file as plain dicts, and as compact records (as JsonPatientStore.read_file does)
+def load_plain_patients(path):
+    with open(path) as f:
+        return {int(k): v for k, v in json.load(f)['patients'].items()}
+
+
+def load_compact_patients(path):
+    with open(path) as f:
+        return {int(k): compact_patient(v) for k, v in json.load(f)['patients'].items()}
+
+
+# Times a load, then loads again under tracemalloc to measure what the loaded records hold
+# Returns (seconds, bytes held once loaded, peak bytes while loading)
+def measure_load(load, path, count):
+    seconds, records = timed(load, path)
+    if len(records) != count:
+        raise RuntimeError("Loaded the wrong number of records")
+    del records
+    tracemalloc.start()
+    records = load(path)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    return seconds, current, peak
+
+
+# Memory per record and load time of key records and patients, plain dicts against compact records
+def bench_memory(counts):
+    results = []
+    filler_hash = make_hasher(fast=True).hash('filler')
+    for count in counts:
+        with scratch_dir():
+            write_key_snapshot('keys.json', count)
+            write_patients_file('patients.json', count, filler_hash)
+            cases = (('keys', 'keys.json', load_plain_keys, load_compact_keys),
+                     ('patients', 'patients.json', load_plain_patients, load_compact_patients))
+            for kind, path, load_plain, load_compact in cases:
+                plain_seconds, plain_bytes, plain_peak = measure_load(load_plain, path, count)
+                compact_seconds, compact_bytes, compact_peak = measure_load(load_compact, path, count)
+                results.append({
+                    'case': f"{kind} {count}",
+                    'records': count,
+                    'file_bytes': os.path.getsize(path),
+                    'plain_bytes_per_record': round(plain_bytes / count),
+                    'compact_bytes_per_record': round(compact_bytes / count),
+                    'saved_percent': round((1 - compact_bytes / plain_bytes) * 100, 1),
+                    'plain_peak_memory_bytes': plain_peak,
+                    'compact_peak_memory_bytes': compact_peak,
+                    'plain_load_seconds': round(plain_seconds, 6),
+                    'compact_load_seconds': round(compact_seconds, 6),
+                })
+    return results
+
+
+# encrypt_file / decrypt_file throughput for each file size
+def bench_encrypt(sizes, repeat):
+    results = []
+    with scratch_dir():
+        encryptor = MedicalFileEncryptor('keys.json', metrics=MetricsRegistry())
+        for size in sizes:
+            write_random_file('plain.bin', size)
+            encrypt_times = []
+            decrypt_times = []
+            for _ in range(repeat):
+                seconds, record_info = timed(encryptor.encrypt_file, 'plain.bin', 1, 'imaging')
+                encrypt_times.append(seconds)
+                # return_data=False streams to disk and skips the decrypted record cache
+                seconds, output = timed(encryptor.decrypt_file, record_info['record_id'], 'out.bin',
+                                        return_data=False)
+                if output is None:
+                    raise RuntimeError("Decryption unexpectedly failed")
+                decrypt_times.append(seconds)
+                # Every run writes a new blob; large runs can be several GB, so drop each one
+                encrypted_size = os.path.getsize(record_info['encrypted_filename'])
+                encryptor.delete_record(record_info['record_id'])
+
+            encrypt_stats = summarize(encrypt_times)
+            decrypt_stats = summarize(decrypt_times)
+            results.append({
+                'case': f"{size} bytes",
+                'size_bytes': size,
+                'encrypted_bytes': encrypted_size,
+                'encrypt_seconds': encrypt_stats['median_seconds'],
+                'encrypt_mb_per_second': mb_per_second(size, encrypt_stats['median_seconds']),
+                'decrypt_seconds': decrypt_stats['median_seconds'],
+                'decrypt_mb_per_second': mb_per_second(size, decrypt_stats['median_seconds']),
+            })
+            # Large runs can be several GB, so clean up before the next size
+            for path in ('plain.bin', 'out.bin'):
+                if os.path.exists(path):
+                    os.remove(path)
+    return results
+
+
+# save_keys / load_keys against the number of stored records, for each backend
+def bench_keys(counts, backends):
+    results = []
+    for backend in backends:
+        for count in counts:
+            with scratch_dir():
+                master_keys = MasterKeyStore()
+                envelope = KeyEnvelope(master_keys)
+                records = [synthetic_record(envelope, record_id, record_id % 500 + 1)
+                           for record_id in range(1, count + 1)]
+                if backend == 'json':
+                    results.append(bench_json_keys(records, master_keys))
+                else:
+                    results.append(bench_sqlite_keys(records, master_keys))
+    return results
+
+
+def bench_json_keys(records, master_keys):
+    metrics = MetricsRegistry()
+
+    def open_encryptor():
+        return MedicalFileEncryptor(store=JsonKeyStore('keys.json'), metrics=metrics, master_keys=master_keys)
+
+    encryptor = open_encryptor()
+
+    # Adding records only appends to the journal
+    put_seconds, _ = timed(encryptor.add_records, records)
+    journal_bytes = os.path.getsize(encryptor.store.journal.journal_path)
+    replay_seconds, _ = timed(open_encryptor)
+
+    # save_keys writes a full snapshot and empties the journal
+    save_seconds, _ = timed(encryptor.save_keys)
+    load_seconds, loaded = timed(open_encryptor)
+    if len(loaded.key_storage) != len(records):
+        raise RuntimeError("Loaded the wrong number of keys")
+
+    # Keep the loaded encryptor alive so its memory is still counted
+    tracemalloc.start()
+    loaded = open_encryptor()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del loaded
+
+    return {
+        'case': f"json {len(records)} records",
+        'backend': 'json',
+        'records': len(records),
+        'add_records_seconds': round(put_seconds, 6),
+        'journal_bytes': journal_bytes,
+        'load_from_journal_seconds': round(replay_seconds, 6),
+        'save_keys_seconds': round(save_seconds, 6),
+        'snapshot_bytes': os.path.getsize('keys.json'),
+        'load_keys_seconds': round(load_seconds, 6),
+        'load_peak_memory_bytes': peak,
+        'loaded_memory_bytes': current,
+    }
+
+
+def bench_sqlite_keys(records, master_keys):
+    metrics = MetricsRegistry()
+    encryptor = MedicalFileEncryptor(store=SQLiteKeyStore('keys.db'), metrics=metrics, master_keys=master_keys)
+
+    put_seconds, _ = timed(encryptor.add_records, records)
+    save_seconds, _ = timed(encryptor.save_keys)
+    encryptor.store.close()
+
+    # SQLite reads rows on demand, so "loading" is opening the database plus a full scan
+    def open_and_scan():
+        loaded = MedicalFileEncryptor(store=SQLiteKeyStore('keys.db'), metrics=metrics,
+                                      master_keys=master_keys)
+        total = sum(1 for _ in loaded.key_storage.values())
+        loaded.store.close()
+        return total
+
+    load_seconds, total = timed(open_and_scan)
+    if total != len(records):
+        raise RuntimeError("Loaded the wrong number of keys")
+
+    tracemalloc.start()
+    open_and_scan()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'case': f"sqlite {len(records)} records",
+        'backend': 'sqlite',
+        'records': len(records),
+        'add_records_seconds': round(put_seconds, 6),
+        'save_keys_seconds': round(save_seconds, 6),
+        'database_bytes': os.path.getsize('keys.db'),
+        'load_keys_seconds': round(load_seconds, 6),
+        'load_peak_memory_bytes': peak,
+    }
+
+
+# register_patient / authenticate_patient latency against the number of registered patients
+def bench_auth(registry_sizes, samples, fast_hash):
+    results = []
+    hasher = make_hasher(fast_hash)
+    filler_hash = hasher.hash('filler')
+    for size in registry_sizes:
+        with scratch_dir():
+            authenticator = PatientAuthenticator('patients.json', hasher=hasher, metrics=MetricsRegistry())
+            for patient_id in range(1, size + 1):
+                authenticator.store.put(synthetic_patient(authenticator.store.allocate_patient_id(),
+                                                          filler_hash))
+            authenticator.save_patients()
+            load_seconds, _ = timed(PatientAuthenticator, 'patients.json', hasher=hasher,
+                                    metrics=MetricsRegistry())
+
+            register_times = []
+            login_times = []
+            failed_times = []
+            unknown_times = []
+            for sample in range(samples):
+                ssn = f"bench-{sample}"
+                # The system saves the registry after every registration, so that is timed too
+                start = time.perf_counter()
+                success, patient_id, pin, message = authenticator.register_patient(
+                    ssn, f"Bench {sample}", f"bench{sample}@example.com", 'password')
+                authenticator.save_patients()
+                register_times.append(time.perf_counter() - start)
+
+                seconds, (success, _, _) = timed(authenticator.authenticate_patient, ssn, pin, 'password')
+                if not success:
+                    raise RuntimeError("Login unexpectedly failed")
+                login_times.append(seconds)
+                seconds, _ = timed(authenticator.authenticate_patient, ssn, '000000', 'password')
+                failed_times.append(seconds)
+                seconds, _ = timed(authenticator.authenticate_patient, 'no-such-ssn', pin, 'password')
+                unknown_times.append(seconds)
+
+            results.append({
+                'case': f"{size} patients",
+                'patients': size,
+                'hashing': 'fast' if fast_hash else 'default',
+                'load_patients_seconds': round(load_seconds, 6),
+                'register_median_seconds': summarize(register_times)['median_seconds'],
+                'register_p95_seconds': summarize(register_times)['p95_seconds'],
+                'login_median_seconds': summarize(login_times)['median_seconds'],
+                'login_p95_seconds': summarize(login_times)['p95_seconds'],
+                'wrong_pin_median_seconds': summarize(failed_times)['median_seconds'],
+                'unknown_ssn_median_seconds': summarize(unknown_times)['median_seconds'],
+            })
+    hasher.shutdown()
+    return results
+
+
+# End-to-end view_my_records for patients with different numbers of records
+def bench_view(record_counts, record_size, fast_hash):
+    results = []
+    with scratch_dir():
+        system = MedicalRecordSystem(metrics=MetricsRegistry())
+        system.authenticator.hasher = make_hasher(fast_hash)
+        write_lab_file('lab.txt', record_size)
+
+        for count in record_counts:
+            ssn = f"view-{count}"
+            success, patient_id, pin, message = system.register_patient(
+                ssn, f"Viewer {count}", f"viewer{count}@example.com", 'password')
+
+            # Records are added the way bulk_ingest.py does: encrypt each file, one batched commit
+            records = []
+            for _ in range(count):
+                record_id = system.encryptor.store.allocate_record_id()
+                encrypted_filename = system.encryptor.blobs.path_for(record_id)
+                codec = system.encryptor.compression.codec_for_file('blood_test', 'lab.txt')
+                key, compression_info = encrypt_file_contents('lab.txt', encrypted_filename, compression=codec)
+                records.append(system.encryptor.build_record(record_id, patient_id, 'blood_test', 'lab.txt',
+                                                             key, encrypted_filename, record_size,
+                                                             compression_info))
+            system.encryptor.add_records(records)
+
+            system.login(ssn, pin, 'password')
+            list_seconds, _ = timed(system.list_my_records)
+
+            system.encryptor.cache.clear()
+            cold_seconds, (success, my_records, message) = timed(system.view_my_records, write_files=False)
+            if len(my_records) != count:
+                raise RuntimeError("view_my_records returned the wrong number of records")
+            warm_seconds, _ = timed(system.view_my_records, write_files=False)
+
+            system.encryptor.cache.clear()
+            parallel_seconds, _ = timed(system.view_my_records, parallel=True, write_files=False)
+
+            system.encryptor.cache.clear()
+            files_seconds, _ = timed(system.view_my_records, write_files=True)
+            system.logout()
+
+            results.append({
+                'case': f"{count} records",
+                'records': count,
+                'record_bytes': record_size,
+                'list_page_seconds': round(list_seconds, 6),
+                'view_cold_seconds': round(cold_seconds, 6),
+                'view_warm_seconds': round(warm_seconds, 6),
+                'view_parallel_cold_seconds': round(parallel_seconds, 6),
+                'view_write_files_seconds': round(files_seconds, 6),
+                'records_per_second_cold': round(count / cold_seconds, 1) if cold_seconds > 0 else 0.0,
+            })
+    return results
+
+
+# Where and on what the benchmarks ran, so results from different machines aren't mixed up
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'commit': commit,
+    }
+
+
+# Prints each benchmark's rows
+def print_results(results):
+    for name in BENCHMARKS:
+        if name not in results:
+            continue
+        print(f"\n[{name}]")
+        for row in results[name]:
+            values = ', '.join(f"{key}={value}" for key, value in row.items() if key != 'case')
+            print(f"  {row['case']:<24} {values}")
+
+
+# Prints how each timing changed against an earlier run (negative is faster)
+def print_comparison(results, baseline):
+    print("\nChange against baseline (timings; negative is faster)")
+    for name in BENCHMARKS:
+        old_rows = {row['case']: row for row in baseline.get('results', {}).get(name, [])}
+        for row in results.get(name, []):
+            old_row = old_rows.get(row['case'])
+            if old_row is None:
+                continue
+            for key, value in row.items():
+                old_value = old_row.get(key)
+                if key.endswith('_seconds') and isinstance(old_value, (int, float)) and old_value > 0:
+                    change = (value - old_value) / old_value * 100
+                    print(f"  {name:<8}{row['case']:<24}{key:<30}{change:+8.1f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark encryption, key storage, authentication and viewing")
+    parser.add_argument('--only', default=','.join(BENCHMARKS),
+                        help="comma separated benchmarks to run: " + ', '.join(BENCHMARKS))
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="file sizes for the encrypt benchmark (K/M/G)")
+    parser.add_argument('--repeat', type=int, default=3, help="encrypt/decrypt runs per file size")
+    parser.add_argument('--record-counts', default=DEFAULT_RECORD_COUNTS, help="key store sizes")
+    parser.add_argument('--backends', default='json,sqlite', help="key store backends to measure")
+    parser.add_argument('--registry-sizes', default=DEFAULT_REGISTRY_SIZES, help="numbers of registered patients")
+    parser.add_argument('--samples', type=int, default=5, help="registrations/logins per registry size")
+    parser.add_argument('--fast-hash', action='store_true',
+                        help="use a cheap hashing setting so registry and storage costs stand out")
+    parser.add_argument('--view-counts', default=DEFAULT_VIEW_COUNTS, help="records per patient for view")
+    parser.add_argument('--record-size', default='4K', help="size of each record in the view benchmark")
+    parser.add_argument('--memory-counts', default=DEFAULT_MEMORY_COUNTS,
+                        help="numbers of key records and patients for the memory benchmark")
+    parser.add_argument('--json', help="also write the results to this JSON file")
+    parser.add_argument('--compare', help="an earlier --json file to compare against")
+    args = parser.parse_args()
+
+    selected = parse_list(args.only, str.strip)
+    for name in selected:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+
+    results = {}
+    if 'encrypt' in selected:
+        results['encrypt'] = bench_encrypt(parse_list(args.sizes, parse_size), args.repeat)
+    if 'keys' in selected:
+        results['keys'] = bench_keys(parse_list(args.record_counts), parse_list(args.backends, str.strip))
+    if 'auth' in selected:
+        results['auth'] = bench_auth(parse_list(args.registry_sizes), args.samples, args.fast_hash)
+    if 'view' in selected:
+        results['view'] = bench_view(parse_list(args.view_counts), parse_size(args.record_size), args.fast_hash)
+    if 'memory' in selected:
+        results['memory'] = bench_memory(parse_list(args.memory_counts))
+
+    run = {'environment': environment(), 'results': results}
+    print_results(results)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(run, f, indent=2)
@@ -0,0 +1,199 @@
+# Encrypted Blob Store
+# This module decides where encrypted record files (.enc) live on disk
+# Instead of one flat folder of encrypted_<name>.enc files, each record's file goes in a
+# sharded folder under a configurable root:
+#   <root>/<aa>/<bb>/<record_id>.enc      (aa/bb are the first bytes of sha256(record_id))
+# so no folder ever holds more than a small share of the files, and names never collide
+# The original filename is only kept in the key store, never on disk
+#
+# Files are written to a temporary name and renamed into place once complete, so a crash
+# never leaves a half-written .enc file under a record's path
+# The path each record's file was written to is stored with the record ('encrypted_filename')
+#
+# Usage (moving the flat .enc files of existing records into the sharded layout):
+#   python blob_store.py migrate
+#   python blob_store.py migrate --root /data/blobs --storage sqlite --dry-run
+
+import argparse
+import errno
+import hashlib
+import os
+import secrets
+import shutil
+import time
+
+DEFAULT_BLOB_ROOT = 'blobs'
+# Number of folder levels; each level has up to 256 folders
+DEFAULT_SHARD_DEPTH = 2
+DEFAULT_MIGRATION_BATCH_SIZE = 1000
+
+
+# A file that is written under a temporary name and only appears at its path once committed
+# Used as a context manager, it commits on success and is thrown away if an exception is raised
+class AtomicFile:
+    def __init__(self, path):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # Unique per writer, so two processes writing the same path never share a temporary file
+        self.temp_path = f"{path}.{os.getpid()}.{secrets.token_hex(4)}.tmp"
+        self.file = open(self.temp_path, 'wb')
+
+    def write(self, data):
+        return self.file.write(data)
+
+    # Makes sure the contents are on disk, then moves the file into place
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    # Throws the temporary file away; the path is left as it was
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+# This class will handle the layout of encrypted files under the blob root
+class BlobStore:
+    def __init__(self, root=DEFAULT_BLOB_ROOT, shard_depth=DEFAULT_SHARD_DEPTH):
+        self.root = root
+        self.shard_depth = shard_depth
+
+    # Returns the path a record's encrypted file is stored at
+    # Hashing the record id spreads consecutive ids evenly over the folders
+    def path_for(self, record_id):
+        digest = hashlib.sha256(str(record_id).encode()).hexdigest()
+        shards = [digest[level * 2:level * 2 + 2] for level in range(self.shard_depth)]
+        return os.path.join(self.root, *shards, f"{record_id}.enc")
+
+    # Checks whether a path is inside this store's root
+    def contains(self, path):
+        root = os.path.abspath(self.root)
+        return os.path.commonpath([root, os.path.abspath(path)]) == root
+
+    # Opens a new blob for writing; nothing appears at path until it is committed
+    def open_blob(self, path):
+        return AtomicFile(path)
+
+    # Deletes a blob (if it is there)
+    # Its shard folders stay, even when empty: another process may have just created one to
+    # write a new blob into, and there are never more than 256 ** shard_depth of them
+    def remove(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# Moves a file to a new path, copying it if the new path is on another file system
+def move_blob(old_path, new_path):
+    folder = os.path.dirname(new_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    try:
+        os.replace(old_path, new_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        with open(old_path, 'rb') as src, AtomicFile(new_path) as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(old_path)
+
+
+# Moves the encrypted files of every record that isn't in the blob store yet into the sharded layout
+# Records sharing a file (deduplicated, or older records with the same filename) move together
+# to the path of the first of them. Each file is moved before its records are updated, so an
+# interrupted migration is finished by running it again: a record whose old file is gone but
+# whose new path exists is just updated
+# Returns a report dict
+def migrate_flat_files(encryptor, batch_size=DEFAULT_MIGRATION_BATCH_SIZE, dry_run=False, progress=None):
+    start = time.perf_counter()
+    blobs = encryptor.blobs
+
+    # encrypted_filename -> records pointing at it, for records outside the blob store
+    groups = {}
+    for record_info in encryptor.key_storage.values():
+        if not blobs.contains(record_info['encrypted_filename']):
+            groups.setdefault(record_info['encrypted_filename'], []).append(record_info)
+
+    moved = 0
+    record_count = 0
+    missing = []
+    updated = []
+    done = 0
+    for old_path, records in groups.items():
+        done += 1
+        new_path = blobs.path_for(min(record_info['record_id'] for record_info in records))
+        if os.path.exists(old_path):
+            if not dry_run:
+                move_blob(old_path, new_path)
+            moved += 1
+        elif not os.path.exists(new_path):
+            missing.append(old_path)
+            continue
+        updated.extend(dict(record_info, encrypted_filename=new_path) for record_info in records)
+        record_count += len(records)
+
+        # Updating the key store in batches: one journal append / transaction per batch
+        if len(updated) >= batch_size:
+            if not dry_run:
+                encryptor.store.put_many(updated)
+            updated = []
+            if progress is not None:
+                progress(done, len(groups))
+    if updated and not dry_run:
+        encryptor.store.put_many(updated)
+    if progress is not None:
+        progress(len(groups), len(groups))
+    if not dry_run:
+        encryptor.save_keys()
+
+    elapsed = time.perf_counter() - start
+    return {
+        'files': len(groups),
+        'moved': moved,
+        'records': record_count,
+        'missing': missing,
+        'dry_run': dry_run,
+        'seconds': round(elapsed, 6),
+    }
+
+
+if __name__ == "__main__":
+    from encryption import MedicalFileEncryptor
+    from storage import DEFAULT_DB_PATH, open_stores
+
+    parser = argparse.ArgumentParser(description="Encrypted blob store tools")
+    parser.add_argument('command', choices=['migrate'],
+                        help="migrate: move flat .enc files of existing records into the sharded layout")
+    parser.add_argument('--root', default=DEFAULT_BLOB_ROOT, help="blob store root folder")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_MIGRATION_BATCH_SIZE,
+                        help="records updated per key store write")
+    parser.add_argument('--dry-run', action='store_true', help="only report what would be moved")
+    parser.add_argument('--storage', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help="SQLite database path")
+    args = parser.parse_args()
+
+    patient_store, key_store = open_stores(args.storage, args.db)
+    encryptor = MedicalFileEncryptor(store=key_store, blob_root=args.root)
+
+    def show_progress(done, total):
+        print(f"\rMigrated {done}/{total} files", end='', flush=True)
+
+    report = migrate_flat_files(encryptor, args.batch_size, args.dry_run, show_progress)
+    action = "Would move" if report['dry_run'] else "Moved"
+    print(f"\n{action} {report['moved']} files ({report['records']} records) into {args.root} "
+          f"in {report['seconds']:.2f}s")
+    for path in report['missing']:
+        print(f"MISSING {path}: record left pointing at its old path")
@@ -0,0 +1,234 @@
+# Bulk Record Ingest
+# This module encrypts a whole batch of medical records at once (e.g. the nightly lab results)
+# Files are encrypted concurrently on a thread or process pool and all of the key
+# metadata is committed to the key store in one batch at the end
+# With deduplication on, a file whose contents are already stored (or appear earlier in the
+# same batch) is recorded against the existing .enc file and its new copy is deleted
+#
+# Input is either:
+#   a CSV manifest with the columns file_path,patient_id,record_type
+#   a directory laid out as <directory>/<patient_id>/<record_type>/<files>
+#
+# Usage:
+#   python bulk_ingest.py --manifest nightly.csv --workers 8
+#   python bulk_ingest.py --directory incoming/ --processes --report report.json
+
+import argparse
+import csv
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from dedup import SCOPES
+from encryption import encrypt_file_contents
+from event_log import LOG_MODES, SILENT, configure_logging, get_logger, log_event
+from stream_cipher import DEFAULT_CHUNK_SIZE
+
+DEFAULT_WORKERS = 4
+
+logger = get_logger('bulk_ingest')
+
+
+# Reads a CSV manifest into a list of (file_path, patient_id, record_type)
+# Relative file paths are taken relative to the manifest's folder
+def read_manifest(manifest_path):
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    entries = []
+    with open(manifest_path, newline='') as f:
+        for row in csv.DictReader(f):
+            file_path = row['file_path'].strip()
+            if not os.path.isabs(file_path):
+                file_path = os.path.join(base_dir, file_path)
+            entries.append((file_path, int(row['patient_id']), row['record_type'].strip()))
+    return entries
+
+
+# Walks <directory>/<patient_id>/<record_type>/<files> into a list of (file_path, patient_id, record_type)
+def scan_directory(directory):
+    entries = []
+    for patient_dir in sorted(os.listdir(directory)):
+        patient_path = os.path.join(directory, patient_dir)
+        if not os.path.isdir(patient_path) or not patient_dir.isdigit():
+            continue
+        for record_type in sorted(os.listdir(patient_path)):
+            type_path = os.path.join(patient_path, record_type)
+            if not os.path.isdir(type_path):
+                continue
+            for file_name in sorted(os.listdir(type_path)):
+                file_path = os.path.join(type_path, file_name)
+                if os.path.isfile(file_path):
+                    entries.append((file_path, int(patient_dir), record_type))
+    return entries
+
+
+# Encrypts one file inside a worker and times it
+# The compression codec is chosen here too, since it may need to sample the file
+# The contents are fingerprinted on the way through when a deduplicator is given
+# Returns (encryption_key, content_info, seconds); nothing is left at encrypted_filename on failure
+def encrypt_job(input_file_path, encrypted_filename, chunk_size, compression_policy, record_type,
+                deduplicator=None):
+    start = time.perf_counter()
+    codec = compression_policy.codec_for_file(record_type, input_file_path)
+    encryption_key, content_info = encrypt_file_contents(input_file_path, encrypted_filename,
+                                                         chunk_size, codec, deduplicator)
+    return encryption_key, content_info, time.perf_counter() - start
+
+
+# Encrypts every entry concurrently and stores all of the keys in one batch
+# entries is a list of (file_path, patient_id, record_type)
+# Returns a report with one result per entry (in input order) and overall throughput
+# Encrypted files go in the encryptor's blob store (see blob_store.py)
+def bulk_ingest(system, entries, workers=DEFAULT_WORKERS, use_processes=False):
+    encryptor = system.encryptor
+    chunk_size = getattr(encryptor, 'chunk_size', DEFAULT_CHUNK_SIZE)
+
+    start = time.perf_counter()
+    results = []
+    jobs = []
+
+    # Check every entry up front and hand out record ids on this thread
+    for file_path, patient_id, record_type in entries:
+        result = {
+            'file_path': file_path,
+            'patient_id': patient_id,
+            'record_type': record_type,
+            'record_id': None,
+            'status': 'failed',
+            'error': None,
+            'bytes': 0,
+            'seconds': 0.0,
+            'shared_from': None,
+        }
+        results.append(result)
+
+        if patient_id not in system.authenticator.patients:
+            result['error'] = "Patient not found"
+            continue
+        if not os.path.isfile(file_path):
+            result['error'] = f"File not found: {file_path}"
+            continue
+
+        result['record_id'] = encryptor.store.allocate_record_id()
+        result['bytes'] = os.path.getsize(file_path)
+        # Record ids are unique, so files with the same name never overwrite each other
+        encrypted_filename = encryptor.blobs.path_for(result['record_id'])
+        jobs.append((result, encrypted_filename))
+
+    # Encrypt on the pool; CPU-heavy batches may do better with processes
+    pool_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    encrypted = []
+    with pool_class(max_workers=workers) as pool:
+        futures = [(result, encrypted_filename,
+                    pool.submit(encrypt_job, result['file_path'], encrypted_filename, chunk_size,
+                                encryptor.compression, result['record_type'], encryptor.dedup))
+                   for result, encrypted_filename in jobs]
+
+        for result, encrypted_filename, future in futures:
+            try:
+                encryption_key, content_info, seconds = future.result()
+            except Exception as e:
+                result['error'] = str(e)
+                log_event(logger, 'ingest.file_failed', f"FAILED record {result['record_id']}: {e}",
+                          logging.WARNING, record_id=result['record_id'], patient_id=result['patient_id'],
+                          error=type(e).__name__)
+                continue
+
+            result['status'] = 'encrypted'
+            result['seconds'] = round(seconds, 6)
+            encryptor.metrics.record_call('file_encrypt', seconds, record_id=result['record_id'],
+                                          bytes=result['bytes'])
+            log_event(logger, 'ingest.file_encrypted', f"Encrypted record {result['record_id']}",
+                      logging.DEBUG, record_id=result['record_id'], patient_id=result['patient_id'],
+                      bytes=result['bytes'], duration_ms=round(seconds * 1000, 3))
+            encrypted.append((result, encrypted_filename, encryption_key, content_info))
+
+    # Files with the same contents as a stored record (or an earlier file of this batch) share
+    # its blob; the store's lock keeps another process from deleting that blob in between
+    records = []
+    with encryptor.store.locked():
+        for result, encrypted_filename, encryption_key, content_info in encrypted:
+            file_name = os.path.basename(result['file_path'])
+            if 'fingerprint' in content_info:
+                shared_record, data_key = encryptor.find_shared_blob(content_info['fingerprint'],
+                                                                     result['patient_id'], records)
+                if shared_record is not None:
+                    encryptor.blobs.remove(encrypted_filename)
+                    result['shared_from'] = shared_record['record_id']
+                    records.append(encryptor.build_shared_record(
+                        result['record_id'], result['patient_id'], result['record_type'], file_name,
+                        result['bytes'], shared_record, data_key))
+                    continue
+            records.append(encryptor.build_record(
+                result['record_id'], result['patient_id'], result['record_type'],
+                file_name, encryption_key, encrypted_filename, result['bytes'], content_info))
+
+        # One batched commit instead of one save per file
+        encryptor.add_records(records)
+    shared = [record_info for record_info in records if 'shared_from' in record_info]
+    if shared:
+        encryptor.count_deduplicated(len(shared), sum(record_info.get('stored_size', record_info['file_size'])
+                                                      for record_info in shared))
+
+    elapsed = time.perf_counter() - start
+    total_bytes = sum(result['bytes'] for result in results if result['status'] == 'encrypted')
+    log_event(logger, 'ingest.finished', f"{len(records)} of {len(results)} files encrypted",
+              files=len(results), encrypted=len(records), failed=len(results) - len(records),
+              deduplicated=len(shared), bytes=total_bytes, duration_ms=round(elapsed * 1000, 3))
+    return {
+        'files': len(results),
+        'encrypted': len(records),
+        'failed': len(results) - len(records),
+        'deduplicated': len(shared),
+        'bytes': total_bytes,
+        'seconds': round(elapsed, 6),
+        'files_per_second': round(len(records) / elapsed, 2) if elapsed > 0 else 0.0,
+        'mb_per_second': round(total_bytes / (1024 * 1024) / elapsed, 2) if elapsed > 0 else 0.0,
+        'results': results,
+    }
+
+
+if __name__ == "__main__":
+    from main_system import MedicalRecordSystem
+    from storage import DEFAULT_DB_PATH
+
+    parser = argparse.ArgumentParser(description="Encrypt a batch of medical records")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--manifest', help="CSV with file_path,patient_id,record_type columns")
+    source.add_argument('--directory', help="folder laid out as <patient_id>/<record_type>/<files>")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="number of concurrent workers")
+    parser.add_argument('--processes', action='store_true', help="use a process pool instead of threads")
+    parser.add_argument('--blob-root', help="folder the encrypted files are written under (default blobs/)")
+    parser.add_argument('--report', help="write the full per-file report as JSON to this path")
+    parser.add_argument('--storage', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help="SQLite database path")
+    parser.add_argument('--dedup', choices=SCOPES,
+                        help="store identical files once, shared within one patient or across all patients")
+    parser.add_argument('--log', choices=LOG_MODES, default=SILENT,
+                        help="where log events go (json writes one object per line to stderr)")
+    args = parser.parse_args()
+
+    configure_logging(args.log)
+
+    entries = read_manifest(args.manifest) if args.manifest else scan_directory(args.directory)
+    system = MedicalRecordSystem(storage=args.storage, db_path=args.db, dedup=args.dedup,
+                                 blob_root=args.blob_root)
+    report = bulk_ingest(system, entries, args.workers, args.processes)
+
+    for result in report['results']:
+        if result['status'] == 'encrypted' and result['shared_from'] is not None:
+            print(f"OK     {result['file_path']} -> record {result['record_id']} "
+                  f"(same contents as record {result['shared_from']})")
+        elif result['status'] == 'encrypted':
+            print(f"OK     {result['file_path']} -> record {result['record_id']}")
+        else:
+            print(f"FAILED {result['file_path']}: {result['error']}")
+
+    print(f"\n{report['encrypted']} of {report['files']} files encrypted in {report['seconds']:.2f}s "
+          f"({report['files_per_second']} files/s, {report['mb_per_second']} MB/s)")
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.report}")
@@ -0,0 +1,253 @@
+# Compact In-Memory Records
+# The JSON stores keep every patient and key record in memory; as plain dicts of strings each
+# record costs well over a kilobyte, most of it in per-record copies of the same few values
+# Here each record is an object with __slots__ (no per-record dict) whose fields are kept
+# in a compact form:
+#   record types, codecs, content types and KEK ids are interned, so records share one string each
+#   hex digests (keyed SSN hashes, content fingerprints) are kept as their 32 raw bytes
+#   base64 wrapped keys are kept as raw bytes
+#   timestamps ('YYYY-MM-DD HH:MM:SS') are kept as integer seconds (the wall-clock time as
+#   written, no time zone conversion)
+# A value that doesn't fit its compact form exactly (a timestamp written another way or stored
+# as a number, upper case hex, base64 that wouldn't encode back the same) is kept as it is in
+# the record's extra dict, so every record reads back exactly as it was stored
+#
+# Records still behave like dicts: record['field'], get(), in, iteration, dict(record), and
+# changing a field in place; fields the model doesn't know about go in a small extra dict
+# json can't serialise them directly, so pass default=json_default to json.dump(s)
+
+import base64
+import binascii
+import sys
+from datetime import datetime, timedelta
+from collections.abc import MutableMapping
+
+from credential_hashing import SSN_LOOKUP
+
+TIMESTAMP_LENGTH = 19
+DIGEST_HEX_LENGTH = 64
+EPOCH = datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+# Marks a field that isn't set
+MISSING = object()
+# Returned by a codec's pack function for a value that has no compact form
+UNPACKED = object()
+
+
+# Field codecs: each pair turns a value into its compact form and back
+# The pack function returns UNPACKED for a value it can't pack so that it unpacks to the same
+# value; the unpack function only ever sees values its pack function produced
+
+def keep(value):
+    return value
+
+
+def intern_string(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def pack_hex_digest(value):
+    if type(value) is not str or len(value) != DIGEST_HEX_LENGTH:
+        return UNPACKED
+    try:
+        raw = bytes.fromhex(value)
+    except ValueError:
+        return UNPACKED
+    # Upper case hex wouldn't read back the same
+    return raw if raw.hex() == value else UNPACKED
+
+
+def unpack_hex_digest(value):
+    return value.hex()
+
+
+# Digests written as '<scheme>$<64 hex characters>', like keyed SSN hashes
+# Only the expected scheme is packed, so the raw bytes always unpack to the same prefix
+def prefixed_hex_digest(scheme):
+    prefix = scheme + '$'
+
+    def pack(value):
+        if type(value) is str and value.startswith(prefix):
+            return pack_hex_digest(value[len(prefix):])
+        return UNPACKED
+
+    def unpack(value):
+        return prefix + value.hex()
+
+    return pack, unpack
+
+
+def pack_base64(value):
+    if type(value) is not str:
+        return UNPACKED
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return UNPACKED
+    return raw if base64.b64encode(raw).decode() == value else UNPACKED
+
+
+def unpack_base64(value):
+    return base64.b64encode(value).decode()
+
+
+def pack_timestamp(value):
+    # Only the exact 'YYYY-MM-DD HH:MM:SS' layout is packed; fromisoformat checks the date itself
+    if (type(value) is not str or len(value) != TIMESTAMP_LENGTH or value[4] != '-'
+            or value[7] != '-' or value[10] != ' ' or value[13] != ':' or value[16] != ':'
+            or not value.replace('-', '').replace(' ', '').replace(':', '').isdigit()):
+        return UNPACKED
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return UNPACKED
+    return ((moment.toordinal() - EPOCH_ORDINAL) * 86400 + moment.hour * 3600
+            + moment.minute * 60 + moment.second)
+
+
+def unpack_timestamp(value):
+    return (EPOCH + timedelta(seconds=value)).isoformat(' ')
+
+
+KEEP = (keep, keep)
+INTERNED = (intern_string, keep)
+HEX_DIGEST = (pack_hex_digest, unpack_hex_digest)
+BASE64 = (pack_base64, unpack_base64)
+TIMESTAMP = (pack_timestamp, unpack_timestamp)
+SSN_LOOKUP_DIGEST = prefixed_hex_digest(SSN_LOOKUP)
+
+
+# Base class of the compact records; subclasses list their fields in FIELDS as (name, codec)
+# A field whose value has no compact form is kept in extra instead of its slot
+class CompactRecord(MutableMapping):
+    FIELDS = ()
+    __slots__ = ('extra',)
+
+    def __init_subclass__(cls):
+        super().__init_subclass__()
+        cls.CODECS = dict(cls.FIELDS)
+
+    # Loading calls this once per record, so it packs the fields without going through __setitem__
+    def __init__(self, fields=()):
+        self.extra = None
+        codecs = self.CODECS
+        for key, value in (fields.items() if hasattr(fields, 'items') else fields):
+            codec = codecs.get(key)
+            if codec is KEEP:
+                setattr(self, key, value)
+                continue
+            packed = UNPACKED if codec is None else codec[0](value)
+            if packed is UNPACKED:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[key] = value
+            else:
+                setattr(self, key, packed)
+
+    def __getitem__(self, key):
+        codec = self.CODECS.get(key)
+        if codec is not None:
+            value = getattr(self, key, MISSING)
+            if value is not MISSING:
+                return codec[1](value)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        codec = self.CODECS.get(key)
+        packed = UNPACKED if codec is None else codec[0](value)
+        if packed is UNPACKED:
+            if codec is not None and hasattr(self, key):
+                delattr(self, key)
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+        else:
+            setattr(self, key, packed)
+            if self.extra is not None:
+                self.extra.pop(key, None)
+
+    def __delitem__(self, key):
+        if key in self.CODECS and hasattr(self, key):
+            delattr(self, key)
+        elif self.extra is not None and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self.CODECS and getattr(self, key, MISSING) is not MISSING:
+            return True
+        return self.extra is not None and key in self.extra
+
+    def __iter__(self):
+        for name in self.CODECS:
+            if getattr(self, name, MISSING) is not MISSING:
+                yield name
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+    # A plain dict copy, like dict.copy()
+    def copy(self):
+        return dict(self)
+
+
+# One entry of the encryption key store (see MedicalFileEncryptor.build_record)
+class KeyRecord(CompactRecord):
+    FIELDS = (
+        ('record_id', KEEP),
+        ('patient_id', KEEP),
+        ('record_type', INTERNED),
+        ('original_filename', KEEP),
+        ('encrypted_filename', KEEP),
+        ('created_at', TIMESTAMP),
+        ('file_size', KEEP),
+        ('format', INTERNED),
+        ('compression', INTERNED),
+        ('stored_size', KEEP),
+        ('compress_ms', KEEP),
+        ('content_type', INTERNED),
+        ('fingerprint', HEX_DIGEST),
+        ('wrapped_key', BASE64),
+        ('kek_id', INTERNED),
+        ('shared_from', KEEP),
+    )
+    __slots__ = tuple(name for name, codec in FIELDS)
+
+
+# One registered patient (see PatientAuthenticator.register_patient)
+class PatientRecord(CompactRecord):
+    FIELDS = (
+        ('patient_id', KEEP),
+        ('name', KEEP),
+        ('ssn_hash', SSN_LOOKUP_DIGEST),
+        ('pin_hash', KEEP),
+        ('password_hash', KEEP),
+        ('email', KEEP),
+        ('registered_at', TIMESTAMP),
+    )
+    __slots__ = tuple(name for name, codec in FIELDS)
+
+
+# Turns a dict into a compact record (records that already are one are kept as they are)
+def compact_key_record(record_info):
+    return record_info if type(record_info) is KeyRecord else KeyRecord(record_info)
+
+
+def compact_patient(patient):
+    return patient if type(patient) is PatientRecord else PatientRecord(patient)
+
+
+# json.dump(s) default= hook that writes compact records as plain objects
+def json_default(value):
+    if isinstance(value, CompactRecord):
+        return dict(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
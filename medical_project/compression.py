@@ -0,0 +1,237 @@
+# Record Compression
+# This module compresses record contents before they are encrypted
+# (encrypted data looks random and can't be compressed afterwards)
+# Lab reports and uncompressed DICOM shrink a lot; JPEGs, PDFs and other already
+# compressed formats don't, so the codec is chosen per record type or by sampling the file
+#
+# The codec is stored in the record's key metadata ('compression', 'stored_size', 'compress_ms')
+# and decryption reverses it transparently; records without the field were never compressed
+# Decompression hands back pieces of at most DECOMPRESS_PIECE_SIZE bytes, however well (or
+# maliciously) a chunk compresses, so streaming a record keeps its memory use constant
+#
+# Usage:
+#   python compression.py                      # compression report per record type
+#   python compression.py --storage sqlite --json report.json
+
+import argparse
+import json
+import lzma
+import time
+import zlib
+
+NONE = 'none'
+ZLIB = 'zlib'
+LZMA = 'lzma'
+# Pick zlib or nothing by trying to compress a sample of the file
+AUTO = 'auto'
+CODECS = (NONE, ZLIB, LZMA)
+
+ZLIB_LEVEL = 6
+LZMA_PRESET = 6
+
+# How much of a file is sampled for AUTO, and how small the sample must get to be worth it
+SAMPLE_SIZE = 64 * 1024
+AUTO_MAX_RATIO = 0.9
+
+# Largest piece of decompressed data produced at once
+DECOMPRESS_PIECE_SIZE = 64 * 1024
+
+# Codec per record type; anything not listed is sampled
+DEFAULT_TYPE_CODECS = {
+    'blood_test': ZLIB,
+    'lab': ZLIB,
+    'lab_report': ZLIB,
+    'report': ZLIB,
+    'prescription': ZLIB,
+    'notes': ZLIB,
+    'dicom': ZLIB,
+}
+
+
+# Returns a streaming compressor for a codec, or None for NONE
+def make_compressor(codec):
+    if codec == NONE:
+        return None
+    if codec == ZLIB:
+        return zlib.compressobj(ZLIB_LEVEL)
+    if codec == LZMA:
+        return lzma.LZMACompressor(preset=LZMA_PRESET)
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+# Returns a streaming decompressor for a codec, or None for NONE
+def make_decompressor(codec):
+    if codec == NONE:
+        return None
+    if codec == ZLIB:
+        return zlib.decompressobj()
+    if codec == LZMA:
+        return lzma.LZMADecompressor()
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+# Chooses ZLIB if a quick compression of the sample saves enough, otherwise NONE
+def sample_codec(sample):
+    if not sample:
+        return NONE
+    ratio = len(zlib.compress(sample, 1)) / len(sample)
+    return ZLIB if ratio <= AUTO_MAX_RATIO else NONE
+
+
+# This class will handle choosing a codec for a record
+class CompressionPolicy:
+    def __init__(self, type_codecs=None, default=AUTO):
+        self.type_codecs = dict(DEFAULT_TYPE_CODECS if type_codecs is None else type_codecs)
+        self.default = default
+
+    # Chooses the codec for a record type, sampling the first bytes of its contents if needed
+    def codec_for(self, record_type, sample=b''):
+        codec = self.type_codecs.get(record_type.lower(), self.default)
+        if codec == AUTO:
+            return sample_codec(sample[:SAMPLE_SIZE])
+        return codec
+
+    # Same as codec_for, reading the sample from a file only when it is needed
+    def codec_for_file(self, record_type, path):
+        if self.type_codecs.get(record_type.lower(), self.default) != AUTO:
+            return self.codec_for(record_type)
+        with open(path, 'rb') as f:
+            return self.codec_for(record_type, f.read(SAMPLE_SIZE))
+
+
+# Policy that never compresses
+NO_COMPRESSION = CompressionPolicy({}, NONE)
+
+
+# Compresses data on its way into another writer (e.g. a StreamEncryptor)
+# bytes_in counts the original bytes; call finish() before finishing the writer underneath
+class CompressingWriter:
+    def __init__(self, codec, out):
+        self.codec = codec
+        self.out = out
+        self.compressor = make_compressor(codec)
+        self.bytes_in = 0
+        self.seconds = 0.0
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        if self.compressor is None:
+            self.out.write(data)
+            return
+        start = time.perf_counter()
+        compressed = self.compressor.compress(data)
+        self.seconds += time.perf_counter() - start
+        if compressed:
+            self.out.write(compressed)
+
+    def finish(self):
+        if self.compressor is not None:
+            start = time.perf_counter()
+            tail = self.compressor.flush()
+            self.seconds += time.perf_counter() - start
+            if tail:
+                self.out.write(tail)
+
+    # The metadata fields recorded with the record; stored_size is what went to the writer underneath
+    def info(self, stored_size):
+        return {
+            'compression': self.codec,
+            'stored_size': stored_size,
+            'compress_ms': round(self.seconds * 1000, 3),
+        }
+
+
+# Yields the decompressed contents of a stream of compressed chunks, in pieces of at most piece_size bytes
+# Raises ValueError if the compressed data ends early
+def iter_decompressed(chunks, codec, piece_size=DECOMPRESS_PIECE_SIZE):
+    decompressor = make_decompressor(codec)
+    if decompressor is None:
+        yield from chunks
+        return
+    for chunk in chunks:
+        yield from decompress_pieces(decompressor, codec, chunk, piece_size)
+    if codec == ZLIB:
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+    if not decompressor.eof:
+        raise ValueError("Compressed record data is truncated")
+
+
+# Decompresses one compressed chunk, yielding pieces of at most piece_size bytes
+# Input the decompressor couldn't use yet is fed back in (zlib's unconsumed_tail; lzma keeps
+# it internally until needs_input) until the whole chunk has come out
+def decompress_pieces(decompressor, codec, data, piece_size):
+    while True:
+        piece = decompressor.decompress(data, piece_size)
+        if piece:
+            yield piece
+        if decompressor.eof:
+            return
+        if codec == ZLIB:
+            data = decompressor.unconsumed_tail
+            # A full piece may leave output behind in zlib even when all input was used
+            if not data and len(piece) < piece_size:
+                return
+        else:
+            if decompressor.needs_input:
+                return
+            data = b''
+
+
+# Sums up compression per record type from key store records
+# Returns {record_type: {'records', 'codecs', 'original_bytes', 'stored_bytes', 'ratio',
+#                        'saved_percent', 'compress_ms', 'compress_mb_per_second'}}
+def compression_report(records):
+    report = {}
+    for record_info in records:
+        entry = report.setdefault(record_info['record_type'], {
+            'records': 0, 'codecs': {}, 'original_bytes': 0, 'stored_bytes': 0, 'compress_ms': 0.0,
+            'compressed_bytes_in': 0,
+        })
+        codec = record_info.get('compression', NONE)
+        entry['records'] += 1
+        entry['codecs'][codec] = entry['codecs'].get(codec, 0) + 1
+        entry['original_bytes'] += record_info['file_size']
+        entry['stored_bytes'] += record_info.get('stored_size', record_info['file_size'])
+        entry['compress_ms'] += record_info.get('compress_ms', 0.0)
+        if codec != NONE:
+            entry['compressed_bytes_in'] += record_info['file_size']
+
+    for entry in report.values():
+        original, stored = entry['original_bytes'], entry['stored_bytes']
+        entry['ratio'] = round(original / stored, 2) if stored else 1.0
+        entry['saved_percent'] = round((1 - stored / original) * 100, 1) if original else 0.0
+        seconds = entry['compress_ms'] / 1000
+        compressed_bytes_in = entry.pop('compressed_bytes_in')
+        entry['compress_mb_per_second'] = (round(compressed_bytes_in / (1024 * 1024) / seconds, 1)
+                                           if seconds > 0 else 0.0)
+        entry['compress_ms'] = round(entry['compress_ms'], 3)
+    return report
+
+
+if __name__ == "__main__":
+    from encryption import MedicalFileEncryptor
+    from storage import DEFAULT_DB_PATH, open_stores
+
+    parser = argparse.ArgumentParser(description="Report compression ratio and time per record type")
+    parser.add_argument('--storage', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help="SQLite database path")
+    parser.add_argument('--json', help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    patient_store, key_store = open_stores(args.storage, args.db)
+    encryptor = MedicalFileEncryptor(store=key_store)
+    report = compression_report(encryptor.key_storage.values())
+
+    print(f"{'Record type':<16}{'Records':>8}{'Original':>14}{'Stored':>14}{'Ratio':>8}{'Saved':>8}"
+          f"{'Time (ms)':>12}{'MB/s':>8}  Codecs")
+    for record_type, entry in sorted(report.items()):
+        codecs = ', '.join(f"{codec}={count}" for codec, count in sorted(entry['codecs'].items()))
+        print(f"{record_type:<16}{entry['records']:>8}{entry['original_bytes']:>14}{entry['stored_bytes']:>14}"
+              f"{entry['ratio']:>8}{entry['saved_percent']:>7}%{entry['compress_ms']:>12}"
+              f"{entry['compress_mb_per_second']:>8}  {codecs}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,88 @@
+# Record Content Types
+# Each record's content type is worked out when it is encrypted and kept in its key metadata
+# ('content_type'), so retrieval knows whether a record is text that can be shown inline or
+# binary (X-rays, PDFs, DICOM studies) that has to be handed back as bytes
+#
+# The first bytes of the file are checked for the signatures of common medical formats first,
+# then the filename extension is used; anything else is text if it is valid UTF-8, otherwise binary
+# Records stored before this have no content type and are typed from their filename
+
+import codecs
+import mimetypes
+import os
+
+TEXT_PLAIN = 'text/plain'
+OCTET_STREAM = 'application/octet-stream'
+DICOM = 'application/dicom'
+
+# How much of the start of a file is looked at
+SNIFF_SIZE = 8 * 1024
+
+# Leading bytes of common formats
+SIGNATURES = (
+    (b'%PDF-', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+    (b'PK\x03\x04', 'application/zip'),
+)
+# DICOM files start with a 128 byte preamble followed by 'DICM'
+DICOM_PREAMBLE_SIZE = 128
+DICOM_MAGIC = b'DICM'
+
+# Extensions the mimetypes module doesn't know
+EXTRA_TYPES = {
+    '.dcm': DICOM,
+    '.dicom': DICOM,
+}
+
+# Types outside text/ that are still shown inline
+TEXT_APPLICATION_TYPES = ('application/json', 'application/xml')
+
+
+# Checks whether a content type is text that can be shown inline
+def is_text_type(content_type):
+    return content_type.startswith('text/') or content_type in TEXT_APPLICATION_TYPES
+
+
+# Checks whether a sample is UTF-8 text (a character cut off at the end of the sample is fine)
+def looks_like_text(sample):
+    if b'\x00' in sample:
+        return False
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+# Guesses a content type from a filename's extension, or None
+def guess_from_name(file_name):
+    extension = os.path.splitext(file_name)[1].lower()
+    return EXTRA_TYPES.get(extension) or mimetypes.guess_type(file_name, strict=False)[0]
+
+
+# Works out a file's content type from its name and the first bytes of its contents
+def detect_content_type(file_name, sample):
+    sample = sample[:SNIFF_SIZE]
+    for signature, content_type in SIGNATURES:
+        if sample.startswith(signature):
+            return content_type
+    if sample[DICOM_PREAMBLE_SIZE:DICOM_PREAMBLE_SIZE + len(DICOM_MAGIC)] == DICOM_MAGIC:
+        return DICOM
+
+    text = looks_like_text(sample)
+    guessed = guess_from_name(file_name)
+    # A .txt name on binary contents isn't trusted, so it is never decoded as text
+    if guessed is not None and (text or not is_text_type(guessed)):
+        return guessed
+    return TEXT_PLAIN if text else OCTET_STREAM
+
+
+# Returns a record's content type, falling back to its filename for records stored without one
+def record_content_type(record_info):
+    return (record_info.get('content_type') or guess_from_name(record_info['original_filename'])
+            or OCTET_STREAM)
@@ -0,0 +1,178 @@
+# Credential Hashing
+# This module hashes PINs and passwords with a slow, salted key derivation function
+# A 6-digit PIN has only a million possible values, so a plain SHA-256 hash can be reversed
+# instantly; scrypt (or PBKDF2) with a per-patient salt makes every guess expensive
+#
+# Stored hashes say which scheme and cost settings made them:
+#   scrypt$<n>$<r>$<p>$<salt hex>$<hash hex>
+#   pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>
+#   <64 hex characters>                           (legacy unsalted SHA-256)
+#
+# Legacy and outdated hashes still verify, and needs_rehash() tells the caller to
+# replace them after a successful login
+# hashlib's scrypt and PBKDF2 release the GIL while they run, so threads hash in parallel:
+# a login's PIN and password are hashed at the same time, and concurrent logins (e.g. on the
+# HTTP service's threads) overlap without the pickling and IPC a process pool would add
+#
+# The SSN has to be looked up by its hash, so it can't be salted; it is hashed with a keyed
+# HMAC instead (ssn_lookup_hash), using a server-side secret kept next to the master keys,
+# so the ~10^9 possible SSNs can't be tried against a stolen patient file:
+#   hmac_sha256$<HMAC-SHA256(key, SHA-256 hex of the SSN)>
+# Keying the older unsalted SHA-256 hash lets stored ones be upgraded without the SSN
+
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+SCRYPT = 'scrypt'
+PBKDF2 = 'pbkdf2_sha256'
+SSN_LOOKUP = 'hmac_sha256'
+
+DEFAULT_SCHEME = SCRYPT
+DEFAULT_SCRYPT_N = 2 ** 14
+DEFAULT_SCRYPT_R = 8
+DEFAULT_SCRYPT_P = 1
+DEFAULT_PBKDF2_ITERATIONS = 600000
+SALT_SIZE = 16
+HASH_SIZE = 32
+
+# Default number of threads that hash the secrets of one call side by side (0 hashes them one by one)
+DEFAULT_HASH_WORKERS = min(4, os.cpu_count() or 1)
+
+
+# Unsalted SHA-256, the scheme used before this module existed
+def legacy_sha256(secret):
+    return hashlib.sha256(secret.encode('utf-8')).hexdigest()
+
+
+# Checks whether a stored hash is a legacy unsalted SHA-256 hash
+def is_legacy_hash(stored_hash):
+    return len(stored_hash) == 64 and '$' not in stored_hash
+
+
+# Keyed hash of an SSN for looking patients up (key is the server-side secret)
+def ssn_lookup_hash(ssn, key):
+    return upgrade_ssn_hash(legacy_sha256(ssn), key)
+
+
+# Turns a stored unsalted SHA-256 SSN hash into its keyed lookup hash
+def upgrade_ssn_hash(legacy_hash, key):
+    return f"{SSN_LOOKUP}${hmac.new(key, legacy_hash.encode('utf-8'), hashlib.sha256).hexdigest()}"
+
+
+# Hashes a secret with the given scheme and cost settings
+def hash_secret(secret, scheme=DEFAULT_SCHEME, cost=None, salt=None):
+    salt = salt if salt is not None else os.urandom(SALT_SIZE)
+    secret_bytes = secret.encode('utf-8')
+
+    if scheme == SCRYPT:
+        n, r, p = cost or (DEFAULT_SCRYPT_N, DEFAULT_SCRYPT_R, DEFAULT_SCRYPT_P)
+        derived = hashlib.scrypt(secret_bytes, salt=salt, n=n, r=r, p=p,
+                                 maxmem=256 * n * r + 1024 * 1024, dklen=HASH_SIZE)
+        return f"{SCRYPT}${n}${r}${p}${salt.hex()}${derived.hex()}"
+
+    if scheme == PBKDF2:
+        iterations = cost[0] if cost else DEFAULT_PBKDF2_ITERATIONS
+        derived = hashlib.pbkdf2_hmac('sha256', secret_bytes, salt, iterations, dklen=HASH_SIZE)
+        return f"{PBKDF2}${iterations}${salt.hex()}${derived.hex()}"
+
+    raise ValueError(f"Unknown hashing scheme: {scheme}")
+
+
+# Splits a stored hash into (scheme, cost, salt)
+def parse_hash(stored_hash):
+    if is_legacy_hash(stored_hash):
+        return 'sha256', (), b''
+    parts = stored_hash.split('$')
+    if parts[0] == SCRYPT and len(parts) == 6:
+        return SCRYPT, (int(parts[1]), int(parts[2]), int(parts[3])), bytes.fromhex(parts[4])
+    if parts[0] == PBKDF2 and len(parts) == 4:
+        return PBKDF2, (int(parts[1]),), bytes.fromhex(parts[2])
+    raise ValueError("Unrecognised credential hash")
+
+
+# Checks a secret against a stored hash of any supported scheme, in constant time
+def verify_secret(secret, stored_hash):
+    try:
+        scheme, cost, salt = parse_hash(stored_hash)
+    except ValueError:
+        return False
+    if scheme == 'sha256':
+        expected = legacy_sha256(secret)
+    else:
+        expected = hash_secret(secret, scheme, cost, salt)
+    return hmac.compare_digest(expected, stored_hash)
+
+
+# Checks several (secret, stored_hash) pairs in one go; True only if all of them match
+# Every pair is checked even after a mismatch so timing doesn't show which factor was wrong
+def verify_all(pairs):
+    results = [verify_secret(secret, stored_hash) for secret, stored_hash in pairs]
+    return all(results)
+
+
+# This class will handle hashing and verifying credentials with configurable cost
+class CredentialHasher:
+    def __init__(self, scheme=DEFAULT_SCHEME, cost=None, workers=DEFAULT_HASH_WORKERS):
+        if scheme not in (SCRYPT, PBKDF2):
+            raise ValueError(f"Unknown hashing scheme: {scheme}")
+        self.scheme = scheme
+        if cost is None:
+            cost = ((DEFAULT_SCRYPT_N, DEFAULT_SCRYPT_R, DEFAULT_SCRYPT_P) if scheme == SCRYPT
+                    else (DEFAULT_PBKDF2_ITERATIONS,))
+        self.cost = tuple(cost)
+        self.workers = workers
+        # The thread pool is only started the first time it is needed
+        self.executor = None
+        self.executor_lock = threading.Lock()
+
+    # Returns the thread pool, or None when every secret is hashed on the calling thread
+    def get_executor(self):
+        if self.workers <= 0:
+            return None
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='hash')
+            return self.executor
+
+    # Runs function(*args) for every tuple of args, side by side on the thread pool,
+    # and returns the results in order
+    def run_all(self, function, arg_lists):
+        executor = self.get_executor() if len(arg_lists) > 1 else None
+        if executor is None:
+            return [function(*args) for args in arg_lists]
+        futures = [executor.submit(function, *args) for args in arg_lists]
+        return [future.result() for future in futures]
+
+    # Hashes one secret with the configured scheme and cost
+    def hash(self, secret):
+        return hash_secret(secret, self.scheme, self.cost)
+
+    # Hashes several secrets at the same time
+    def hash_many(self, secrets):
+        return self.run_all(hash_secret, [(secret, self.scheme, self.cost) for secret in secrets])
+
+    # Checks one secret against a stored hash
+    def verify(self, secret, stored_hash):
+        return verify_secret(secret, stored_hash)
+
+    # Checks several (secret, stored_hash) pairs at the same time; True only if all of them match
+    # Every pair is checked even after a mismatch so timing doesn't show which factor was wrong
+    def verify_many(self, pairs):
+        return all(self.run_all(verify_secret, list(pairs)))
+
+    # Checks whether a stored hash was made with an old scheme or different cost settings
+    def needs_rehash(self, stored_hash):
+        try:
+            scheme, cost, salt = parse_hash(stored_hash)
+        except ValueError:
+            return True
+        return scheme != self.scheme or cost != self.cost
+
+    # Stops the worker threads
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
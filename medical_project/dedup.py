@@ -0,0 +1,61 @@
+# Content Deduplication
+# Referring clinics often send the same PDF or image again; without deduplication every
+# upload gets its own key and its own full-size .enc file
+#
+# With deduplication turned on, each record's plaintext is fingerprinted with a keyed hash
+# (HMAC-SHA256 with a secret kept next to the master keys, so the fingerprints in the key store
+# can't be checked against guessed contents). A record whose fingerprint matches an
+# existing record reuses that record's .enc file and data key instead of storing a new copy
+#
+# Every record keeps its own entry (patient, type, filename) and its own wrapped copy of the
+# shared data key, so access to a record is still checked per record; sharing a blob never
+# gives one patient's record access to another's. The number of records pointing at an
+# .enc file is its reference count, and the file is deleted with the last of them
+#
+# Who a blob may be shared with is set by the scope:
+#   patient - only with other records of the same patient (the default)
+#   global  - with any record, e.g. the same referral letter filed for several patients
+
+import hashlib
+import hmac
+
+SCOPE_PATIENT = 'patient'
+SCOPE_GLOBAL = 'global'
+SCOPES = (SCOPE_PATIENT, SCOPE_GLOBAL)
+
+# Key metadata copied from a stored record onto a record that shares its .enc file
+# (the contents are identical, so the content type is too)
+SHARED_FIELDS = ('encrypted_filename', 'format', 'compression', 'stored_size', 'fingerprint', 'content_type')
+
+
+# This class will handle fingerprinting record contents and deciding which blobs may be shared
+class ContentDeduplicator:
+    def __init__(self, fingerprint_key, scope=SCOPE_PATIENT):
+        if scope not in SCOPES:
+            raise ValueError(f"Unknown deduplication scope: {scope}")
+        self.fingerprint_key = fingerprint_key
+        self.scope = scope
+
+    # Returns a new HMAC to feed a record's plaintext into; hexdigest() is the fingerprint
+    def hasher(self):
+        return hmac.new(self.fingerprint_key, digestmod=hashlib.sha256)
+
+    # Fingerprints a file a chunk at a time
+    def fingerprint_file(self, path, chunk_size):
+        hasher = self.hasher()
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                hasher.update(data)
+        return hasher.hexdigest()
+
+    # Access check: may a new record of patient_id share the blob of an existing record?
+    def may_share(self, existing_record, patient_id):
+        return self.scope == SCOPE_GLOBAL or existing_record['patient_id'] == patient_id
+
+
+# Returns the key metadata a new record copies from the record whose blob it shares
+def shared_fields(record_info):
+    return {field: record_info[field] for field in SHARED_FIELDS if field in record_info}
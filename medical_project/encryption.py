@@ -4,159 +4,633 @@
 # Each file will be encrypted with a unique key
 
 from cryptography.fernet import Fernet
+import io
+import logging
 import os
-import json
+import secrets
+import time
+from blob_store import DEFAULT_BLOB_ROOT, AtomicFile, BlobStore
+from compression import NONE, CompressingWriter, CompressionPolicy, iter_decompressed
+from content_types import detect_content_type
+from dedup import ContentDeduplicator, shared_fields
+from event_log import elapsed_ms, get_logger, log_event
+from key_wrapping import DEFAULT_MASTER_KEYS_PATH, KeyEnvelope, KeyUnwrapError, MasterKeyStore
+from metrics import METRICS
+from record_cache import DecryptedRecordCache
+from record_keyring import RecordKeyring
+from storage import JsonKeyStore
+from stream_cipher import (DEFAULT_CHUNK_SIZE, StreamEncryptor, decrypt_stream, is_stream_file,
+                           iter_decrypted_chunks, iter_decrypted_range, slice_chunks)
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+# Default number of threads used to decrypt several records at once
+DEFAULT_DECRYPT_WORKERS = 4
+
+logger = get_logger('encryption')
+
+
+# Encrypts one file with a brand new key and writes it to encrypted_filename
+# The contents are compressed with the given codec first (see compression.py)
+# With a deduplicator the plaintext is fingerprinted on the way through (see dedup.py)
+# The content type is worked out from the file's name and first chunk (see content_types.py)
+# Kept outside the class so worker processes can run it (see bulk_ingest.py)
+# Returns (key as a string, content metadata for build_record)
+def encrypt_file_contents(input_file_path, encrypted_filename, chunk_size=DEFAULT_CHUNK_SIZE, compression=NONE,
+                          deduplicator=None):
+    encryption_key = Fernet.generate_key()
+    hasher = deduplicator.hasher() if deduplicator is not None else None
+    content_type = None
+    # Encrypting the file a chunk at a time so large files (e.g. imaging studies)
+    # never have to fit in memory; the file only appears at encrypted_filename once complete
+    with open(input_file_path, 'rb') as in_file, AtomicFile(encrypted_filename) as out_file:
+        stream = StreamEncryptor(encryption_key, out_file, chunk_size)
+        writer = CompressingWriter(compression, stream)
+        while True:
+            data = in_file.read(chunk_size)
+            if content_type is None:
+                content_type = detect_content_type(os.path.basename(input_file_path), data)
+            if not data:
+                break
+            if hasher is not None:
+                hasher.update(data)
+            writer.write(data)
+        writer.finish()
+        stream.finish()
+    content_info = writer.info(stream.bytes_in)
+    content_info['content_type'] = content_type
+    if hasher is not None:
+        content_info['fingerprint'] = hasher.hexdigest()
+    return encryption_key.decode(), content_info
+
+
+# Checks a byte range [start, end) of a record and fills in its end
+# end=None (or past the end of the record) means up to the end of the record
+# Returns (start, end); raises ValueError if start is negative or past end
+def byte_range(record_info, start=0, end=None):
+    file_size = record_info['file_size']
+    end = file_size if end is None else min(end, file_size)
+    if start < 0 or start > end:
+        raise ValueError(f"Invalid byte range {start}-{end} for a record of {file_size} bytes")
+    return start, end
+
+
+# Encrypts a new record whose contents arrive in pieces (e.g. an HTTP upload)
+# The whole file is never held in memory and the plaintext never touches the disk
+# Call write() for each piece, then close() to store the key, or abort() to throw it away
+class RecordWriter:
+    def __init__(self, encryptor, patient_id, record_type, file_name):
+        self.encryptor = encryptor
+        self.patient_id = patient_id
+        self.record_type = record_type
+        # Only the name is kept, so a path sent by a client can't point outside the folder
+        self.file_name = os.path.basename(file_name) or 'upload'
+        self.record_id = encryptor.store.allocate_record_id()
+        self.encryption_key = Fernet.generate_key()
+        # Record ids are unique, so uploads never overwrite each other
+        self.encrypted_filename = encryptor.blobs.path_for(self.record_id)
+        self.out_file = encryptor.blobs.open_blob(self.encrypted_filename)
+        self.stream = StreamEncryptor(self.encryption_key, self.out_file, encryptor.chunk_size)
+        # The codec and content type are picked when the first piece arrives, so it can be sampled
+        self.writer = None
+        self.content_type = None
+        # Fingerprints the contents as they arrive when deduplication is on
+        self.hasher = encryptor.dedup.hasher() if encryptor.dedup is not None else None
+
+    # Compresses and encrypts the next piece of the file
+    def write(self, data):
+        if self.writer is None:
+            codec = self.encryptor.compression.codec_for(self.record_type, data)
+            self.writer = CompressingWriter(codec, self.stream)
+            self.content_type = detect_content_type(self.file_name, data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        self.writer.write(data)
+
+    # Finishes the file and stores the record's key, returns the record information
+    def close(self):
+        if self.writer is None:
+            self.writer = CompressingWriter(NONE, self.stream)
+            self.content_type = detect_content_type(self.file_name, b'')
+        self.writer.finish()
+        self.stream.finish()
+        file_size = self.writer.bytes_in
+        content_info = self.writer.info(self.stream.bytes_in)
+        content_info['content_type'] = self.content_type
+
+        # The whole upload has to arrive before it can be recognised as a duplicate,
+        # so the copy just written is thrown away in favour of the stored one
+        # The store's lock keeps another process from deleting the shared file in between
+        if self.hasher is not None:
+            content_info['fingerprint'] = self.hasher.hexdigest()
+            with self.encryptor.store.locked():
+                shared_record, data_key = self.encryptor.find_shared_blob(content_info['fingerprint'],
+                                                                          self.patient_id)
+                if shared_record is not None:
+                    self.out_file.abort()
+                    return self.encryptor.add_shared_record(self.record_id, self.patient_id, self.record_type,
+                                                            self.file_name, file_size, shared_record, data_key)
+
+        self.out_file.commit()
+        record_info = self.encryptor.build_record(
+            self.record_id, self.patient_id, self.record_type, self.file_name,
+            self.encryption_key.decode(), self.encrypted_filename, file_size, content_info)
+        with self.encryptor.metrics.timer('key_store_write'):
+            self.encryptor.store.put(record_info)
+        self.encryptor.count_encrypted(1, file_size)
+        log_event(logger, 'record.encrypted', f"Encrypted upload {self.file_name} as record {self.record_id}",
+                  record_id=self.record_id, patient_id=self.patient_id, record_type=self.record_type,
+                  bytes=file_size, stored_bytes=self.stream.bytes_in)
+        return record_info
+
+    # Throws away a partly written record
+    def abort(self):
+        self.out_file.abort()
+
+
+# A read-only binary stream over a record's decrypted chunks (see MedicalFileEncryptor.open_record)
+# readinto() copies straight from the current chunk into the caller's buffer
+class RecordStream(io.RawIOBase):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.chunk:
+            next_chunk = next(self.chunks, None)
+            if next_chunk is None:
+                return 0
+            self.chunk = memoryview(next_chunk)
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+    # Closing early also closes the encrypted file underneath
+    def close(self):
+        if not self.closed:
+            self.chunks.close()
+            self.chunk = memoryview(b'')
+        super().close()
+
+
 # This class will handle the encrypting and decrypting of files
 class MedicalFileEncryptor:
-    def __init__(self):
+    # Timings and counters go to metrics (the shared registry by default, see metrics.py)
+    # Record keys are wrapped with master_keys (master_keys.json next to keys_path by default,
+    # see key_wrapping.py), so the key store never holds them in the clear
+    # dedup turns on content deduplication with the given scope ('patient' or 'global', see dedup.py)
+    # Encrypted files are written under blob_root (blobs/ next to keys_path by default, see blob_store.py)
+    def __init__(self, keys_path='encryption_keys.json', store=None, metrics=None, master_keys=None,
+                 dedup=None, blob_root=None):
         # This will store the keys, in real practice this would be stored in a detabase. 
-        self.key_storage = {}
+        # Keys live in a store (JSON snapshot + journal by default, or SQLite - see storage.py)
+        self.store = store if store is not None else JsonKeyStore(keys_path)
+        # Read-only dict-like view of record_id -> record information
+        self.key_storage = self.store
+        # Size of each encrypted chunk in the streaming container format
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+        # Recently decrypted records, so reopening a record doesn't decrypt it again
+        self.cache = DecryptedRecordCache()
+        # Parsed cipher objects per record, so keys aren't decoded again on every decrypt
+        self.keyring = RecordKeyring()
+        # Chooses how each record is compressed before encryption (see compression.py)
+        self.compression = CompressionPolicy()
+        if master_keys is None:
+            master_keys = MasterKeyStore(os.path.join(os.path.dirname(keys_path), DEFAULT_MASTER_KEYS_PATH))
+        self.envelope = KeyEnvelope(master_keys)
+        if blob_root is None:
+            blob_root = os.path.join(os.path.dirname(keys_path), DEFAULT_BLOB_ROOT)
+        # Where encrypted files are written, in sharded folders
+        self.blobs = BlobStore(blob_root)
+        # Fingerprints contents so identical records share one .enc file; None when turned off
+        self.dedup = None
+        if dedup is not None:
+            self.enable_dedup(dedup)
+        self.metrics = metrics if metrics is not None else METRICS
+        self.metrics.register_collector('decrypt_cache', self.cache.stats)
+        self.metrics.register_collector('keyring', self.keyring.stats)
         self.load_keys()
 
+    # Turns on content deduplication; scope says who an identical blob may be shared with
+    def enable_dedup(self, scope):
+        self.dedup = ContentDeduplicator(self.envelope.master_keys.fingerprint_key(), scope)
+
+    # Returns the record ids belonging to a patient, optionally of one record type
+    def record_ids_for_patient(self, patient_id, record_type=None):
+        return self.store.record_ids_for_patient(patient_id, record_type)
+
+    # Returns the record information for a patient's records, optionally of one record type
+    def records_for_patient(self, patient_id, record_type=None):
+        return self.store.records_for_patient(patient_id, record_type)
+
     # This function will encrypt the file 
     # Recieves the input file path, pateint id, and the record type
     def encrypt_file(self, input_file_path, patient_id, record_type):
-        print(f"\n{'='*40}")
-        print(f"Encrypting file: {input_file_path}")
-        print(f"\n{'='*40}")
+        start = time.perf_counter()
 
         # Check if the file exists
         if not os.path.exists(input_file_path):
-            print(f"Error: File not found: {input_file_path}")
+            log_event(logger, 'encrypt.file_not_found', f"Error: File not found: {input_file_path}",
+                      logging.WARNING, patient_id=patient_id, path=input_file_path)
             return None
     
         # Getting the file size and name
         file_size = os.path.getsize(input_file_path)
         file_name = os.path.basename(input_file_path)
 
-        # Printing the file information
-        print(f"\n File: {file_name}")
-        print(f"\n\tSize: {file_size} bytes")
-        print(f"\n\tPatient ID: {patient_id}")
-        print(f"\n\tRecord Type: {record_type}")
-
-        # Reading the file contents
-        print(f"\n\tReading file contents...")
-        with open(input_file_path, 'rb') as f:
-            file_contents = f.read()
-
-        # Generating a key for the file and is unique to the file
-        print(f"\n Generating key...")
-        encryption_key = Fernet.generate_key()
-        cipher = Fernet(encryption_key)
-
-        print(f"\nKey generated successfully")
-
-        print(f"\nEncrypting file contents...")
-        encrypted_contents = cipher.encrypt(file_contents)
-
-        print(f"\nFile contents encrypted successfully")
-
-        # Saving the encrypted file
-        encrypted_filename = f"encrypted_{file_name}.enc" 
-        with open(encrypted_filename, 'wb') as f:
-            f.write(encrypted_contents)
-
-        print(f"\nEncrypted file saved as: {encrypted_filename}")
+        record_id = self.store.allocate_record_id()
+
+        # With deduplication on, identical contents that are already stored are not encrypted again
+        fingerprint = None
+        if self.dedup is not None:
+            with self.metrics.timer('fingerprint', patient_id=patient_id, bytes=file_size):
+                fingerprint = self.dedup.fingerprint_file(input_file_path, self.chunk_size)
+            # The store's lock keeps another process from deleting the shared file in between
+            with self.store.locked():
+                shared_record, data_key = self.find_shared_blob(fingerprint, patient_id)
+                if shared_record is not None:
+                    return self.add_shared_record(record_id, patient_id, record_type,
+                                                  file_name, file_size, shared_record, data_key)
+
+        # Generating a key for the file (unique to the file) and encrypting with it
+        # Record ids are unique, so two files with the same name never overwrite each other
+        encrypted_filename = self.blobs.path_for(record_id)
+        codec = self.compression.codec_for_file(record_type, input_file_path)
+        with self.metrics.timer('file_encrypt', patient_id=patient_id, bytes=file_size):
+            encryption_key, content_info = encrypt_file_contents(input_file_path, encrypted_filename,
+                                                                 self.chunk_size, codec)
+        if fingerprint is not None:
+            content_info['fingerprint'] = fingerprint
 
         # Storing the encryption key
         # In real practice this would be stored in a database
-        record_id = len(self.key_storage) + 1
-        self.key_storage[record_id] = {
+        record_info = self.build_record(record_id, patient_id, record_type, file_name,
+                                        encryption_key, encrypted_filename, file_size, content_info)
+        # With the JSON store this is one journal append, no matter how many keys are stored
+        with self.metrics.timer('key_store_write', record_id=record_id):
+            self.store.put(record_info)
+        self.count_encrypted(1, file_size)
+
+        log_event(logger, 'record.encrypted', f"Encrypted {file_name} as record {record_id}",
+                  record_id=record_id, patient_id=patient_id, record_type=record_type,
+                  bytes=file_size, stored_bytes=content_info['stored_size'],
+                  compression=content_info['compression'], duration_ms=elapsed_ms(start))
+        return record_info
+    
+    # Builds the key store entry for an encrypted file
+    # The record's key is stored wrapped with the active master key ('wrapped_key' + 'kek_id')
+    # content_info is the metadata returned by encrypt_file_contents / CompressingWriter
+    # (codec and stored size, plus the fingerprint when deduplicating)
+    def build_record(self, record_id, patient_id, record_type, file_name, encryption_key,
+                     encrypted_filename, file_size, content_info=None):
+        record_info = {
             'record_id': record_id,
             'patient_id': patient_id,
             'record_type': record_type,
             'original_filename': file_name,
-            'encryption_key': encryption_key.decode(),
             'encrypted_filename': encrypted_filename,
             'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             'file_size': file_size,
+            'format': 'stream',
         }
+        if content_info is not None:
+            record_info.update(content_info)
+        record_info.update(self.envelope.wrap_fields(record_id, encryption_key.encode()))
+        return record_info
+
+    # Finds a stored record with the same contents whose .enc file a new record of patient_id may share
+    # pending holds records built but not stored yet (e.g. earlier files of the same bulk batch)
+    # Returns (record, its data key) or (None, None)
+    def find_shared_blob(self, fingerprint, patient_id, pending=()):
+        candidates = self.store.records_with_fingerprint(fingerprint)
+        candidates += [record_info for record_info in pending if record_info.get('fingerprint') == fingerprint]
+        for record_info in candidates:
+            if not self.dedup.may_share(record_info, patient_id):
+                continue
+            if not os.path.exists(record_info['encrypted_filename']):
+                continue
+            try:
+                return record_info, self.record_key(record_info)
+            except KeyUnwrapError:
+                continue
+        return None, None
+
+    # Builds the key store entry for a record that shares another record's .enc file
+    # It gets its own wrapped copy of the shared data key, bound to its own record id
+    def build_shared_record(self, record_id, patient_id, record_type, file_name, file_size,
+                            shared_record, data_key):
+        record_info = self.build_record(record_id, patient_id, record_type, file_name, data_key.decode(),
+                                        shared_record['encrypted_filename'], file_size,
+                                        shared_fields(shared_record))
+        record_info['shared_from'] = shared_record['record_id']
+        return record_info
+
+    # Stores a record that shares another record's .enc file, returns the record information
+    def add_shared_record(self, record_id, patient_id, record_type, file_name, file_size,
+                          shared_record, data_key):
+        record_info = self.build_shared_record(record_id, patient_id, record_type, file_name, file_size,
+                                               shared_record, data_key)
+        with self.metrics.timer('key_store_write', record_id=record_id):
+            self.store.put(record_info)
+        self.count_encrypted(1, file_size)
+        self.count_deduplicated(1, record_info.get('stored_size', file_size))
+        log_event(logger, 'record.deduplicated',
+                  f"Stored {file_name} as record {record_id}, sharing the file of record {shared_record['record_id']}",
+                  record_id=record_id, patient_id=patient_id, record_type=record_type, bytes=file_size,
+                  shared_from=shared_record['record_id'])
+        return record_info
+
+    # Returns a record's data key as bytes, unwrapping it with the master key if needed
+    def record_key(self, record_info):
+        return self.envelope.data_key(record_info)
+
+    # Yields a record's plaintext from an open streaming container, decompressing it if needed
+    def iter_plaintext(self, record_info, cipher, in_file):
+        return iter_decompressed(iter_decrypted_chunks(cipher, in_file), record_info.get('compression', NONE))
+
+    # Stores several already-encrypted records in one batch
+    # (one journal write with the JSON store, one transaction with SQLite)
+    def add_records(self, records):
+        if records:
+            with self.metrics.timer('key_store_write', records=len(records)):
+                self.store.put_many(records)
+            self.count_encrypted(len(records), sum(record_info['file_size'] for record_info in records))
+            # An existing record may have been given a new key, so forget any cached plaintext
+            for record_info in records:
+                self.cache.invalidate(record_info['record_id'])
+                self.keyring.invalidate(record_info['record_id'])
+
+    # Counts records and plaintext bytes encrypted
+    def count_encrypted(self, records, byte_count):
+        self.metrics.increment('records_encrypted', records)
+        self.metrics.increment('bytes_encrypted', byte_count)
+
+    # Counts records that reuse an existing .enc file and the stored bytes that saved
+    def count_deduplicated(self, records, stored_bytes):
+        self.metrics.increment('dedup_hits', records)
+        self.metrics.increment('dedup_bytes_saved', stored_bytes)
+
+    # Counts a successful decrypt and times it under stage
+    def count_decrypted(self, stage, start, byte_count, **fields):
+        self.metrics.record_call(stage, time.perf_counter() - start, bytes=byte_count, **fields)
+        self.metrics.increment('records_decrypted')
+        self.metrics.increment('bytes_decrypted', byte_count)
+
+    # Logs and counts a failed decrypt of a record
+    def decrypt_failed(self, record_info, error):
+        self.metrics.increment('decrypt_failures')
+        record_id = record_info['record_id']
+        if isinstance(error, FileNotFoundError):
+            log_event(logger, 'record.file_missing',
+                      f"Error: Encrypted file '{record_info['encrypted_filename']}' not found!",
+                      logging.ERROR, record_id=record_id, patient_id=record_info['patient_id'])
+        elif isinstance(error, KeyUnwrapError):
+            log_event(logger, 'record.key_unavailable', f"Error: {error}", logging.ERROR,
+                      record_id=record_id, patient_id=record_info['patient_id'])
+        else:
+            log_event(logger, 'record.decrypt_failed', f"Error: Could not decrypt record {record_id}: {error}",
+                      logging.ERROR, record_id=record_id, patient_id=record_info['patient_id'],
+                      error=type(error).__name__)
+
+    # Yields a record's decrypted contents one chunk at a time (older Fernet records come as one chunk)
+    # Nothing is counted or logged here; raises if the file, key or decryption fails
+    def decrypted_chunks(self, record_info):
+        record_id = record_info['record_id']
+        encrypted_filename = record_info['encrypted_filename']
+        encryption_key = self.record_key(record_info)
+        with open(encrypted_filename, 'rb') as f:
+            if is_stream_file(encrypted_filename):
+                cipher = self.keyring.stream_cipher(record_id, encryption_key)
+                yield from self.iter_plaintext(record_info, cipher, f)
+            else:
+                yield self.keyring.fernet(record_id, encryption_key).decrypt(f.read())
+
+    # Yields the decrypted bytes in the range [start, end) of a record (see byte_range)
+    # Uncompressed streaming records go straight to the chunks holding the range; compressed and
+    # older Fernet records have to be decrypted from the start, dropping the bytes before start
+    def decrypted_range(self, record_info, start, end):
+        if start >= end:
+            return
+        if start == 0 and end == record_info['file_size']:
+            yield from self.decrypted_chunks(record_info)
+            return
+        encrypted_filename = record_info['encrypted_filename']
+        if record_info.get('compression', NONE) != NONE or not is_stream_file(encrypted_filename):
+            yield from slice_chunks(self.decrypted_chunks(record_info), start, end)
+            return
+        record_id = record_info['record_id']
+        cipher = self.keyring.stream_cipher(record_id, self.record_key(record_info))
+        with open(encrypted_filename, 'rb') as f:
+            yield from iter_decrypted_range(cipher, f, start, end)
 
-        print(f"\nKey stored successfully")
-
-        print(f"\n{'='*40}")
-        print(f"\nEncryption complete")
-        print(f"\n{'='*40}")
-
-        self.save_keys()
-
-        return self.key_storage[record_id]
-    
     # This function will decrypt the file
-    # Recieves the record id and the output file path
-    def decrypt_file(self, record_id, output_file_path=None):
-        print(f"\n{'='*40}")
-        print(f"Decrypting file: {record_id}")
-        print(f"\n{'='*40}")
+    # Recieves the record id and, optionally, the output file path
+    # Without an output path nothing is written to disk and the decrypted bytes are returned (see read_record)
+    # With one the plaintext is written there and the decrypted bytes are returned, or just the
+    # output path when return_data is False (use that for large files so they are never loaded into memory)
+    def decrypt_file(self, record_id, output_file_path=None, return_data=True):
+        if output_file_path is None:
+            return self.read_record(record_id)
+        start = time.perf_counter()
 
         # Check if the record id is valid
         if record_id not in self.key_storage:
-            print(f"Error: Record id not found: {record_id}")
+            log_event(logger, 'record.not_found', f"Error: Record id not found: {record_id}",
+                      logging.WARNING, record_id=record_id)
             return None
 
         # Get the record information
         record_info = self.key_storage[record_id]
+        patient_id = record_info['patient_id']
 
-        print(f"\nRecord information:")
-        print(f"\n\tPatient ID: {record_info['patient_id']}")
-        print(f"\n\tRecord Type: {record_info['record_type']}")
-        print(f"\n\tOriginal Filename: {record_info['original_filename']}")
-        print(f"\n\tEncrypted: {record_info['created_at']}")  # ← FIXED
+        # Serve repeated opens from the cache instead of re-reading and re-decrypting the file
+        cached_data = self.cache.get(record_id)
+        chunks = [cached_data] if cached_data is not None else self.decrypted_chunks(record_info)
 
-        # Read the encrypted file
-        encrypted_filename = record_info['encrypted_filename']
-        
-        if not os.path.exists(encrypted_filename):
-            print(f"Error: Encrypted file '{encrypted_filename}' not found!")
+        # Decrypt to a temporary file first so a failed chunk never leaves partial plaintext behind
+        # The temporary name is unique, so decrypts of same-named records never share it
+        temp_path = f"{output_file_path}.{os.getpid()}.{secrets.token_hex(4)}.part"
+        parts = []
+        byte_count = 0
+        try:
+            with open(temp_path, 'wb') as out_file:
+                for chunk in chunks:
+                    out_file.write(chunk)
+                    byte_count += len(chunk)
+                    # Kept as they are written rather than reading the output file back
+                    if return_data:
+                        parts.append(chunk)
+            os.replace(temp_path, output_file_path)
+        except Exception as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            self.decrypt_failed(record_info, e)
             return None
-        
-        print(f"\nReading encrypted file...")
-        with open(encrypted_filename, 'rb') as f:
-            encrypted_data = f.read()
 
-        # Getting the encryption key (need to encode it back to bytes)
-        encryption_key = record_info['encryption_key'].encode()  # ← FIXED
-        cipher = Fernet(encryption_key)
+        decrypted_data = output_file_path
+        if return_data:
+            decrypted_data = b''.join(parts)
+            if cached_data is None:
+                self.cache.put(record_id, patient_id, decrypted_data)
+
+        self.count_decrypted('file_decrypt', start, byte_count, record_id=record_id,
+                             cached=cached_data is not None)
+        log_event(logger, 'record.decrypted', f"Decrypted record {record_id} to {output_file_path}",
+                  record_id=record_id, patient_id=patient_id, bytes=byte_count,
+                  cached=cached_data is not None, duration_ms=elapsed_ms(start))
+        return decrypted_data
+
+    # Decrypts a record to decrypted_<original filename> in the working directory
+    # Returns the decrypted bytes, or None if the record can't be decrypted
+    def decrypt_to_file(self, record_id):
+        record_info = self.key_storage.get(record_id)
+        if record_info is None:
+            log_event(logger, 'record.not_found', f"Error: Record id not found: {record_id}",
+                      logging.WARNING, record_id=record_id)
+            return None
+        return self.decrypt_file(record_id, f"decrypted_{record_info['original_filename']}")
+
+    # Decrypts a record into memory without writing anything to disk
+    # Returns the decrypted bytes, or None if the record can't be decrypted
+    def read_record(self, record_id):
+        start = time.perf_counter()
+        record_info = self.key_storage.get(record_id)
+        if record_info is None:
+            log_event(logger, 'record.not_found', f"Error: Record id not found: {record_id}",
+                      logging.WARNING, record_id=record_id)
+            return None
+
+        cached_data = self.cache.get(record_id)
+        if cached_data is not None:
+            self.count_decrypted('record_read', start, len(cached_data), record_id=record_id, cached=True)
+            log_event(logger, 'record.read', f"Read record {record_id} from cache", logging.DEBUG,
+                      record_id=record_id, patient_id=record_info['patient_id'],
+                      bytes=len(cached_data), cached=True, duration_ms=elapsed_ms(start))
+            return cached_data
 
-        # Decrypting the file
-        print(f"\nDecrypting file contents...")
         try:
-            decrypted_data = cipher.decrypt(encrypted_data)  # ← Fixed typo
-            print(f"\nFile contents decrypted successfully")
+            decrypted_data = b''.join(self.decrypted_chunks(record_info))
         except Exception as e:
-            print(f"\nDecryption failed: {e}")
+            self.decrypt_failed(record_info, e)
             return None
 
-        # Saving the decrypted file
-        if output_file_path is None:
-            output_file_path = f"decrypted_{record_info['original_filename']}"
-        
-        with open(output_file_path, 'wb') as f:
-            f.write(decrypted_data)
-        print(f"\nDecrypted file saved as: {output_file_path}")
+        self.cache.put(record_id, record_info['patient_id'], decrypted_data)
+        self.count_decrypted('record_read', start, len(decrypted_data), record_id=record_id, cached=False)
+        log_event(logger, 'record.read', f"Read record {record_id}", logging.DEBUG,
+                  record_id=record_id, patient_id=record_info['patient_id'],
+                  bytes=len(decrypted_data), cached=False, duration_ms=elapsed_ms(start))
+        return decrypted_data
 
-        print(f"\n{'='*40}")
-        print(f"\nDecryption complete")
-        print(f"\n{'='*40}")
+    # Decrypts a record straight into a caller-provided file object (anything with write())
+    # or writable buffer (bytearray, memoryview, mmap...), so no extra copy is made
+    # A buffer needs room for the whole record (its file_size); ValueError if it is too small
+    # Returns the number of bytes written, or None if the record can't be decrypted
+    # (the target may then hold part of the plaintext)
+    def decrypt_into(self, record_id, target):
+        start = time.perf_counter()
+        record_info = self.key_storage.get(record_id)
+        if record_info is None:
+            log_event(logger, 'record.not_found', f"Error: Record id not found: {record_id}",
+                      logging.WARNING, record_id=record_id)
+            return None
 
-        return decrypted_data
+        if hasattr(target, 'write'):
+            write = target.write
+        else:
+            view = memoryview(target).cast('B')
+            if len(view) < record_info['file_size']:
+                raise ValueError(f"Buffer of {len(view)} bytes is too small for record {record_id} "
+                                 f"({record_info['file_size']} bytes)")
+            position = 0
+
+            def write(chunk):
+                nonlocal position
+                view[position:position + len(chunk)] = chunk
+                position += len(chunk)
+
+        cached_data = self.cache.get(record_id)
+        chunks = [cached_data] if cached_data is not None else self.decrypted_chunks(record_info)
+        byte_count = 0
+        try:
+            for chunk in chunks:
+                write(chunk)
+                byte_count += len(chunk)
+        except Exception as e:
+            self.decrypt_failed(record_info, e)
+            return None
+
+        self.count_decrypted('record_decrypt_into', start, byte_count, record_id=record_id,
+                             cached=cached_data is not None)
+        log_event(logger, 'record.read', f"Decrypted record {record_id} into a caller's buffer", logging.DEBUG,
+                  record_id=record_id, patient_id=record_info['patient_id'], bytes=byte_count,
+                  cached=cached_data is not None, duration_ms=elapsed_ms(start))
+        return byte_count
+
+    # Opens a record as a read-only binary file object that decrypts as it is read
+    # Nothing is written to disk and only about one chunk of plaintext is held at a time
+    # range_start/range_end open just the byte range [range_start, range_end) (see byte_range)
+    # Raises KeyError for an unknown record and ValueError for a bad range;
+    # reads raise if decryption fails part way
+    def open_record(self, record_id, range_start=0, range_end=None):
+        range_start, range_end = byte_range(self.key_storage[record_id], range_start, range_end)
+        cached_data = self.cache.get(record_id)
+        if cached_data is not None:
+            return io.BytesIO(cached_data[range_start:range_end])
+        return io.BufferedReader(RecordStream(self.iter_record_chunks(record_id, range_start, range_end)))
+
+    # Starts a new record that is encrypted piece by piece as its contents arrive
+    def open_record_writer(self, patient_id, record_type, file_name):
+        return RecordWriter(self, patient_id, record_type, file_name)
+
+    # Yields a record's decrypted contents one chunk at a time, without writing anything to disk
+    # range_start/range_end yield just the byte range [range_start, range_end) (see byte_range)
+    # Raises KeyError for an unknown record, ValueError for a bad range and an exception
+    # if decryption fails part way
+    def iter_record_chunks(self, record_id, range_start=0, range_end=None):
+        record_info = self.key_storage[record_id]
+        range_start, range_end = byte_range(record_info, range_start, range_end)
+        start = time.perf_counter()
+        byte_count = 0
+        for chunk in self.decrypted_range(record_info, range_start, range_end):
+            byte_count += len(chunk)
+            yield chunk
+        # Only counted once the whole record (or range) has been streamed
+        self.count_decrypted('record_stream', start, byte_count, record_id=record_id)
+
+    # Decrypts several records at once on a bounded pool of worker threads
+    # Results come back in the same order as record_ids (None for any that failed)
+    # The plaintext only lives in memory unless write_files=True, which also writes each record
+    # to decrypted_<original filename> (see decrypt_to_file)
+    def decrypt_many(self, record_ids, max_workers=DEFAULT_DECRYPT_WORKERS, write_files=False):
+        decrypt = self.decrypt_to_file if write_files else self.read_record
+        if max_workers <= 1 or len(record_ids) <= 1:
+            return [decrypt(record_id) for record_id in record_ids]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(record_ids))) as pool:
+            return list(pool.map(decrypt, record_ids))
 
-        
     # This function will display the encrypted files
     def list_encrypted_files(self, patient_id=None):
         print(f"\n{'='*40}")
         print(f"Encrypted Files Database")
         print(f"\n{'='*40}")
 
-        if not self.key_storage:
+        # Only look at the requested patient's records when a patient id is given
+        if patient_id is None:
+            records = self.key_storage.values()
+        else:
+            records = self.records_for_patient(patient_id)
+
+        if not records:
             print(f"\nNo encrypted files found")
             return
 
     
-        for record_id, info in self.key_storage.items():
+        for info in records:
+            record_id = info['record_id']
             print(f"\nRecord ID: {record_id}")
             print(f"\n\tPatient ID: {info['patient_id']}")
             print(f"\n\tRecord Type: {info['record_type']}")
@@ -164,6 +638,33 @@ class MedicalFileEncryptor:
             print(f"\n\tEncrypted: {info['created_at']}")
             print()
     
+    # This function will delete a record and its key
+    # Without the key the encrypted file can never be read again, so the file is removed too
+    def delete_record(self, record_id, remove_file=True):
+        if record_id not in self.key_storage:
+            log_event(logger, 'record.not_found', f"Error: Record id not found: {record_id}",
+                      logging.WARNING, record_id=record_id)
+            return False
+
+        # Another record may still point at the same file (a deduplicated copy, or an older
+        # record with the same original filename); the file goes with its last reference
+        # The store's lock keeps other processes from adding a reference while we check
+        with self.store.locked():
+            record_info = self.store.delete(record_id)
+            if record_info is None:
+                return False
+            encrypted_filename = record_info['encrypted_filename']
+            references = self.store.file_reference_count(encrypted_filename)
+            if remove_file and references == 0 and os.path.exists(encrypted_filename):
+                self.blobs.remove(encrypted_filename)
+                self.metrics.increment('blobs_removed')
+        self.cache.invalidate(record_id)
+        self.keyring.invalidate(record_id)
+        self.metrics.increment('records_deleted')
+        log_event(logger, 'record.deleted', f"Record {record_id} deleted",
+                  record_id=record_id, patient_id=record_info['patient_id'], file_references=references)
+        return True
+
     def demonstrate_wrong_key(self, record_id):
         # Shows what happens when you try to decrypt with wrong key
         print(f"\n{'='*40}")
@@ -180,22 +681,23 @@ class MedicalFileEncryptor:
         print(f"\n Scenario: Attacker tries to decrypt without the correct key")
         print(f"\n\tTarget file: {encrypted_filename}")
 
-        # Read encrypted data
-        with open(encrypted_filename, 'rb') as f:
-            encrypted_data = f.read()
-
         print(f"\nAttacker generates their own key...")
         wrong_key = Fernet.generate_key()
-        wrong_cipher = Fernet(wrong_key)
 
-        correct_key = record_info['encryption_key']
-        print(f"\n\tCorrect key: {correct_key[:30]}...")
+        # Only the wrapped key is stored, so that is all an attacker reading the key store gets
+        stored_key = record_info.get('wrapped_key') or record_info['encryption_key']
+        print(f"\n\tStored key: {stored_key[:30]}...")
         print(f"\n\tAttacker's key: {wrong_key.decode()[:30]}...")
 
         print(f"\nAttacker attempts decryption...")
 
         try:
-            wrong_cipher.decrypt(encrypted_data)
+            with open(encrypted_filename, 'rb') as f:
+                if is_stream_file(encrypted_filename):
+                    # Only the first chunk needs to be tried; it fails authentication straight away
+                    decrypt_stream(wrong_key, f, io.BytesIO())
+                else:
+                    Fernet(wrong_key).decrypt(f.read())
             print(f"\n\tERROR: This should not work!")
         except Exception as e:
             print(f"\n\tGOOD: Decryption failed!")
@@ -205,34 +707,44 @@ class MedicalFileEncryptor:
         print(f"\n{'='*40}")
 
     # Save encryption keys to file.
+    # With the JSON store this writes a full snapshot and empties the journal
     def save_keys(self):
-        
-        # Convert bytes to strings for JSON
-        data_to_save = {}
-        for record_id, record_info in self.key_storage.items():
-            data_to_save[record_id] = {
-                'record_id': record_info['record_id'],
-                'patient_id': record_info['patient_id'],
-                'record_type': record_info['record_type'],
-                'original_filename': record_info['original_filename'],
-                'encrypted_filename': record_info['encrypted_filename'],
-                'encryption_key': record_info['encryption_key'],
-                'created_at': record_info['created_at'],
-                'file_size': record_info['file_size']
-            }
-        
-        with open('encryption_keys.json', 'w') as f:
-            json.dump(data_to_save, f, indent=2)
+        with self.metrics.timer('keys_save', records=len(self.key_storage)):
+            self.store.save()
     
     # Load encryption keys from file
+    # With the JSON store this reads the snapshot and replays the journal written since it
+    # Records still holding a plaintext key are wrapped straight away (see wrap_legacy_keys)
     def load_keys(self):
+        start = time.perf_counter()
         try:
-            with open('encryption_keys.json', 'r') as f:
-                data = json.load(f)
-                # Convert string keys back to integers
-                self.key_storage = {int(k): v for k, v in data.items()}
-            print(f"Loaded {len(self.key_storage)} encryption keys from file")
+            self.store.load()
+            self.metrics.record_call('keys_load', time.perf_counter() - start, records=len(self.key_storage))
+            log_event(logger, 'keys.loaded', f"Loaded {len(self.key_storage)} encryption keys from file",
+                      records=len(self.key_storage), duration_ms=elapsed_ms(start))
         except FileNotFoundError:
-            print("No existing encryption keys found, starting fresh")
+            log_event(logger, 'keys.not_found', "No existing encryption keys found, starting fresh")
+            return
         except Exception as e:
-            print(f"Error loading keys: {e}")
\ No newline at end of file
+            log_event(logger, 'keys.load_failed', f"Error loading keys: {e}", logging.ERROR,
+                      error=type(e).__name__)
+            return
+        self.wrap_legacy_keys()
+
+    # Wraps the keys of records stored before envelope encryption, which still carry a plaintext
+    # 'encryption_key', with the active master key
+    # The wrapped records are journaled and a fresh snapshot is written, so the plaintext keys
+    # leave the snapshot and journal without running a key rotation
+    # Returns the number of records wrapped
+    def wrap_legacy_keys(self):
+        start = time.perf_counter()
+        with self.store.locked():
+            legacy = self.store.records_with_plaintext_key()
+            if not legacy:
+                return 0
+            # The data keys are unchanged, so cached ciphers and decrypted records stay valid
+            self.store.put_many([self.envelope.rewrap(record_info) for record_info in legacy])
+            self.save_keys()
+        log_event(logger, 'keys.legacy_wrapped', f"Wrapped {len(legacy)} plaintext record keys",
+                  records=len(legacy), duration_ms=elapsed_ms(start))
+        return len(legacy)
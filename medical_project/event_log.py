@@ -0,0 +1,86 @@
+# Event Logging
+# This module gives the core classes a logger instead of printing to the terminal
+# By default nothing is written anywhere (library mode), so bulk jobs and the HTTP service
+# don't pay for console output on every encrypt, decrypt or login
+#
+# Events carry structured fields (record_id, patient_id, bytes, duration_ms, ...) that can be
+# written as one JSON object per line, or as plain text for someone watching a terminal
+# Never pass a PIN, password, SSN or encryption key as a field
+
+import json
+import logging
+import sys
+import time
+
+LOGGER_NAME = 'medical'
+
+# Output modes for configure_logging()
+SILENT = 'silent'
+CONSOLE = 'console'
+JSON = 'json'
+LOG_MODES = (SILENT, CONSOLE, JSON)
+
+# A NullHandler keeps library mode silent, even for warnings
+# (without it Python would print warnings and errors to stderr on its own)
+logging.getLogger(LOGGER_NAME).addHandler(logging.NullHandler())
+
+
+# Returns the logger for one part of the system, e.g. get_logger('encryption')
+def get_logger(name):
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+# Logs a named event with structured fields
+# message is the human readable text; the event name is used when there isn't one
+def log_event(logger, event, message=None, level=logging.INFO, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, message or event, extra={'event': event, 'fields': fields})
+
+
+# Milliseconds since a time.perf_counter() start, for duration_ms fields
+def elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+# Formats a log record as one JSON object per line
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': getattr(record, 'event', None),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        entry['message'] = record.getMessage()
+        if record.exc_info:
+            entry['error'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Sets up where the system's log events go
+#   silent  - nothing is written (the default when the modules are imported)
+#   console - plain messages, for interactive use
+#   json    - one JSON object per event, for bulk jobs and services
+def configure_logging(mode=SILENT, level=logging.INFO, stream=None):
+    if mode not in LOG_MODES:
+        raise ValueError(f"Unknown logging mode: {mode}")
+
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    # Events are handled here only, so an application's root logger doesn't print them twice
+    logger.propagate = False
+
+    if mode == SILENT:
+        logger.addHandler(logging.NullHandler())
+        return logger
+
+    handler = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    if mode == JSON:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    return logger
@@ -0,0 +1,157 @@
+# Cross-Process Locking
+# This module lets several processes on one host (ingest workers, portal processes, the HTTP
+# service) share the JSON stores without handing out the same id twice or overwriting each
+# other's changes
+#
+# FileLock is an exclusive lock on a <path>.lock file (fcntl.flock, or msvcrt on Windows)
+# It is also reentrant within a process, so a store method can take it while its caller holds it
+# The reentrancy count and the open lock file are kept per path, not per FileLock: two stores
+# opened on the same files in one process share them, so taking one's lock inside the other's
+# doesn't block on a second file descriptor
+#
+# IdAllocator hands out ids from a counter file kept under such a lock; each process reserves
+# a block of ids at a time, so ids are unique and increasing per process but may leave gaps
+# The counter is written to a temporary file, fsynced and renamed into place, so a crash never
+# loses a reservation and the same block is never handed out twice
+
+import json
+import os
+import threading
+
+from blob_store import AtomicFile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+DEFAULT_ID_BLOCK_SIZE = 1
+
+# Lock state per lock file (by real path), shared by every FileLock on that file in this process
+LOCK_STATES = {}
+LOCK_STATES_GUARD = threading.Lock()
+
+
+# The threads' lock, reentrancy count and open file of one lock file
+class LockState:
+    def __init__(self):
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.fd = None
+
+
+# Returns the shared state for a lock file, creating it on first use
+def lock_state(path):
+    key = os.path.realpath(path)
+    with LOCK_STATES_GUARD:
+        state = LOCK_STATES.get(key)
+        if state is None:
+            state = LOCK_STATES[key] = LockState()
+        return state
+
+
+# Makes a rename in a folder durable
+def sync_directory(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# This class will handle an exclusive lock shared between processes
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.state = lock_state(path)
+
+    def acquire(self):
+        state = self.state
+        state.thread_lock.acquire()
+        if state.depth == 0:
+            try:
+                state.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                if fcntl is not None:
+                    fcntl.flock(state.fd, fcntl.LOCK_EX)
+                else:
+                    msvcrt.locking(state.fd, msvcrt.LK_LOCK, 1)
+            except BaseException:
+                if state.fd is not None:
+                    os.close(state.fd)
+                    state.fd = None
+                state.thread_lock.release()
+                raise
+        state.depth += 1
+
+    def release(self):
+        state = self.state
+        state.depth -= 1
+        if state.depth == 0:
+            if fcntl is not None:
+                fcntl.flock(state.fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(state.fd, 0, os.SEEK_SET)
+                msvcrt.locking(state.fd, msvcrt.LK_UNLCK, 1)
+            os.close(state.fd)
+            state.fd = None
+        state.thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.release()
+
+
+# This class will handle allocating ids that are unique across processes
+# counter_path holds the next id no process has reserved yet: {"next": 42}
+class IdAllocator:
+    def __init__(self, counter_path, file_lock, block_size=DEFAULT_ID_BLOCK_SIZE):
+        self.counter_path = counter_path
+        self.file_lock = file_lock
+        self.block_size = block_size
+        # The ids this process has reserved: next_id up to (not including) block_end
+        self.next_id = None
+        self.block_end = None
+        self.lock = threading.Lock()
+
+    # Returns a new id, at least minimum (callers pass one more than the largest id they know of,
+    # which also covers stores written before the counter file existed)
+    def allocate(self, minimum=1):
+        with self.lock:
+            if self.next_id is None or self.next_id >= self.block_end or self.next_id < minimum:
+                self.next_id = self.reserve(minimum)
+                self.block_end = self.next_id + self.block_size
+            allocated = self.next_id
+            self.next_id += 1
+            return allocated
+
+    # Returns the first id no process has reserved yet (1 if nothing was ever reserved)
+    def next_unreserved(self):
+        with self.file_lock:
+            return self.read_counter()
+
+    # Reads the counter file; the file lock must be held
+    def read_counter(self):
+        try:
+            with open(self.counter_path, 'r') as f:
+                return json.load(f)['next']
+        except (FileNotFoundError, ValueError, KeyError):
+            return 1
+
+    # Reserves the next block in the counter file, returns its first id
+    # The new counter is on disk (file and rename fsynced) before any id of the block is used
+    def reserve(self, minimum):
+        with self.file_lock:
+            first_id = max(self.read_counter(), minimum)
+            with AtomicFile(self.counter_path) as f:
+                f.write(json.dumps({'next': first_id + self.block_size}).encode())
+            sync_directory(self.counter_path)
+            return first_id
@@ -0,0 +1,460 @@
+# Medical Record HTTP Service
+# This module serves the medical record system over HTTP/JSON using asyncio,
+# so many patients and staff can use one process at the same time (e.g. behind a load balancer)
+# Slow work (credential hashing, encryption, decryption, storage) runs on a thread pool
+# so the event loop keeps answering other requests
+# Expired sessions and cached plaintext are swept out every minute, even with no traffic
+#
+# Endpoints:
+#   POST /patients                      register a patient   {"ssn", "name", "email", "password"}
+#   POST /login                         log in               {"ssn", "pin", "password"} -> {"token"}
+#   POST /logout                        end the session      (Authorization: Bearer <token>)
+#   POST /patients/<id>/records         upload a record      body = file bytes, streamed
+#                                       ?record_type=blood_test&filename=report.txt
+#   GET  /records                       list my records      ?page=1&page_size=10&newest_first=true
+#   GET  /records/<id>                  download my record   streamed back as it is decrypted
+#                                       with its content type; a Range header fetches part of it
+#   GET  /metrics                       timings and counters (Prometheus text, or ?format=json)
+#
+# Staff endpoints (register, upload, metrics) need a shared key sent as X-Staff-Key; without a
+# configured key they refuse every request, and run_service won't start
+#
+# Usage:
+#   python http_service.py --port 8080 --staff-key secret
+#   python main_system.py --serve --port 8080
+
+import argparse
+import asyncio
+import hmac
+import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from content_types import is_text_type, record_content_type
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+DEFAULT_WORKERS = 8
+MAX_HEADER_BYTES = 16 * 1024
+MAX_JSON_BYTES = 64 * 1024
+DEFAULT_MAX_UPLOAD_BYTES = 4 * 1024 * 1024 * 1024
+UPLOAD_PIECE_SIZE = 256 * 1024
+# How often expired sessions and cached records are dropped while the service is idle
+HOUSEKEEPING_INTERVAL = 60
+
+STATUS_TEXT = {
+    200: 'OK', 201: 'Created', 206: 'Partial Content', 400: 'Bad Request', 401: 'Unauthorized',
+    403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed', 409: 'Conflict',
+    411: 'Length Required', 413: 'Payload Too Large', 416: 'Range Not Satisfiable',
+    500: 'Internal Server Error',
+}
+
+
+# Makes a value safe to put inside a quoted header (no quotes, backslashes or control characters)
+def header_safe(value):
+    return ''.join(c for c in value if c.isprintable() and c not in '"\\' and ord(c) < 256)
+
+
+# Raised inside a handler to send an error response (with any extra headers)
+class HTTPError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers
+
+
+# Parses a Range header for a body of file_size bytes: bytes=<start>-<end>, bytes=<start>- or bytes=-<suffix>
+# Returns (start, end) with end exclusive, or None to send the whole body (no header, a header we
+# don't understand, or several ranges); raises HTTPError 416 if the range is outside the body
+def parse_range(value, file_size):
+    if not value or not value.startswith('bytes=') or ',' in value:
+        return None
+    first, dash, last = value[len('bytes='):].strip().partition('-')
+    if not dash or not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+        return None
+    if not first:
+        # The last <suffix> bytes
+        start = max(file_size - int(last), 0) if int(last) > 0 else file_size
+        end = file_size
+    else:
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        end = min(int(last) + 1, file_size) if last else file_size
+    if start >= file_size:
+        raise HTTPError(416, "Range not satisfiable", {'Content-Range': f"bytes */{file_size}"})
+    return start, end
+
+
+# One parsed HTTP request; the body is read by the handler from `reader`
+class Request:
+    def __init__(self, method, path, query, headers, reader):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.reader = reader
+        try:
+            self.content_length = int(headers.get('content-length', 0) or 0)
+        except ValueError:
+            raise ConnectionError("Invalid Content-Length")
+        if self.content_length < 0:
+            raise ConnectionError("Invalid Content-Length")
+        self.body_read = False
+
+    # Returns a query string value (or the default)
+    def param(self, name, default=None):
+        values = self.query.get(name)
+        return values[0] if values else default
+
+    # Returns the bearer token from the Authorization header, or None
+    def token(self):
+        authorization = self.headers.get('authorization', '')
+        if authorization.lower().startswith('bearer '):
+            return authorization[7:].strip()
+        return None
+
+    # Reads and parses a JSON body
+    async def json(self):
+        if self.content_length > MAX_JSON_BYTES:
+            raise HTTPError(413, "Request body too large")
+        body = await self.reader.readexactly(self.content_length) if self.content_length else b''
+        self.body_read = True
+        try:
+            return json.loads(body or b'{}')
+        except ValueError:
+            raise HTTPError(400, "Body must be JSON")
+
+
+# This class will handle serving MedicalRecordSystem over HTTP
+class MedicalRecordService:
+    def __init__(self, system, staff_key=None, workers=DEFAULT_WORKERS,
+                 max_upload_bytes=DEFAULT_MAX_UPLOAD_BYTES):
+        self.system = system
+        self.staff_key = staff_key
+        self.max_upload_bytes = max_upload_bytes
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Changes to the stores (new patients, new records) are made one at a time
+        self.write_lock = asyncio.Lock()
+
+    # Runs blocking work on the thread pool
+    async def run_blocking(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: function(*args, **kwargs))
+
+    # Starts listening; returns the asyncio server
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.housekeeping_task = asyncio.create_task(self.housekeeping())
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    # Drops expired sessions and cached records even while no requests come in
+    async def housekeeping(self, interval=HOUSEKEEPING_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            await self.run_blocking(self.system.purge_expired)
+
+    # Serves requests on one connection until the client closes it
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                keep_alive = await self.dispatch(request, writer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    # Reads the request line and headers, returns None when the connection is closed
+    async def read_request(self, reader):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            raise ConnectionError("Request headers too large")
+        if len(head) > MAX_HEADER_BYTES:
+            raise ConnectionError("Request headers too large")
+
+        lines = head.decode('latin-1').split('\r\n')
+        parts = lines[0].split()
+        if len(parts) != 3:
+            raise ConnectionError("Malformed request line")
+        method, target, version = parts
+
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+
+        url = urlsplit(target)
+        return Request(method.upper(), unquote(url.path), parse_qs(url.query), headers, reader)
+
+    # Routes a request to its handler and sends the response
+    # Returns whether the connection can be used for another request
+    async def dispatch(self, request, writer):
+        headers = None
+        try:
+            handler, args = self.route(request)
+            status, payload = await handler(request, writer, *args)
+        except HTTPError as e:
+            status, payload, headers = e.status, {'error': e.message}, e.headers
+        except (ConnectionError, asyncio.IncompleteReadError):
+            raise
+        except Exception as e:
+            status, payload = 500, {'error': f"Internal error: {type(e).__name__}"}
+
+        # Streaming handlers write their own response and return None
+        if payload is not None:
+            await self.send_json(writer, status, payload, headers)
+
+        # A body nobody read is still on the socket, so the connection can't be reused
+        if request.content_length and not request.body_read:
+            return False
+        return request.headers.get('connection', '').lower() != 'close'
+
+    # Finds the handler for a method and path
+    def route(self, request):
+        segments = [segment for segment in request.path.split('/') if segment]
+        routes = {
+            ('POST', ('patients',)): self.handle_register,
+            ('POST', ('login',)): self.handle_login,
+            ('POST', ('logout',)): self.handle_logout,
+            ('GET', ('records',)): self.handle_list_records,
+            ('GET', ('metrics',)): self.handle_metrics,
+        }
+        handler = routes.get((request.method, tuple(segments)))
+        if handler is not None:
+            return handler, ()
+
+        if len(segments) == 2 and segments[0] == 'records' and segments[1].isdigit():
+            if request.method != 'GET':
+                raise HTTPError(405, "Method not allowed")
+            return self.handle_fetch_record, (int(segments[1]),)
+        if len(segments) == 3 and segments[0] == 'patients' and segments[1].isdigit() and segments[2] == 'records':
+            if request.method != 'POST':
+                raise HTTPError(405, "Method not allowed")
+            return self.handle_upload_record, (int(segments[1]),)
+
+        raise HTTPError(404, "Not found")
+
+    # Checks the staff key on staff-only endpoints; with no key configured they stay closed
+    def require_staff(self, request):
+        if not self.staff_key:
+            raise HTTPError(403, "Staff endpoints are disabled: no staff key is configured")
+        if not hmac.compare_digest(request.headers.get('x-staff-key', ''), self.staff_key):
+            raise HTTPError(403, "Staff key required")
+
+    # Returns the patient id for the request's session token, or raises 401
+    async def require_patient(self, request):
+        token = request.token()
+        patient_id = self.system.sessions.validate(token) if token else None
+        if patient_id is None:
+            raise HTTPError(401, "Session expired or invalid. Please login again.")
+        return token, patient_id
+
+    async def handle_register(self, request, writer):
+        self.require_staff(request)
+        data = await request.json()
+        for field in ('ssn', 'name', 'email', 'password'):
+            if not isinstance(data.get(field), str) or not data[field]:
+                raise HTTPError(400, f"Missing field: {field}")
+
+        async with self.write_lock:
+            success, patient_id, pin, message = await self.run_blocking(
+                self.system.register_patient, data['ssn'], data['name'], data['email'], data['password'])
+        if not success:
+            raise HTTPError(409, message)
+        return 201, {'patient_id': patient_id, 'pin': pin, 'message': message}
+
+    async def handle_login(self, request, writer):
+        data = await request.json()
+        for field in ('ssn', 'pin', 'password'):
+            if not isinstance(data.get(field), str):
+                raise HTTPError(400, f"Missing field: {field}")
+
+        success, token, message = await self.run_blocking(
+            self.system.login_session, data['ssn'], data['pin'], data['password'])
+        if not success:
+            raise HTTPError(401, message)
+        return 200, {'token': token, 'message': message}
+
+    async def handle_logout(self, request, writer):
+        token, patient_id = await self.require_patient(request)
+        await self.run_blocking(self.system.logout, token)
+        return 200, {'message': "Logged out"}
+
+    async def handle_list_records(self, request, writer):
+        token, patient_id = await self.require_patient(request)
+        try:
+            page = int(request.param('page', 1))
+            page_size = int(request.param('page_size', 10))
+        except ValueError:
+            raise HTTPError(400, "page and page_size must be numbers")
+        newest_first = request.param('newest_first', 'true').lower() != 'false'
+        record_type = request.param('record_type')
+
+        success, page_info, message = await self.run_blocking(
+            self.system.list_my_records, page, page_size, newest_first, record_type, token=token)
+        if not success:
+            raise HTTPError(400, message)
+        return 200, page_info
+
+    # Streams the upload into the encryptor piece by piece; nothing is buffered whole or spooled to disk
+    async def handle_upload_record(self, request, writer, patient_id):
+        self.require_staff(request)
+        record_type = request.param('record_type')
+        file_name = request.param('filename', 'upload')
+        if not record_type:
+            raise HTTPError(400, "record_type is required")
+        if 'content-length' not in request.headers:
+            raise HTTPError(411, "Content-Length is required")
+        if request.content_length > self.max_upload_bytes:
+            raise HTTPError(413, "Upload too large")
+        exists = await self.run_blocking(lambda: patient_id in self.system.authenticator.patients)
+        if not exists:
+            raise HTTPError(404, "Patient not found")
+
+        async with self.write_lock:
+            record_writer = await self.run_blocking(
+                self.system.encryptor.open_record_writer, patient_id, record_type, file_name)
+        try:
+            remaining = request.content_length
+            while remaining > 0:
+                piece = await request.reader.readexactly(min(UPLOAD_PIECE_SIZE, remaining))
+                remaining -= len(piece)
+                await self.run_blocking(record_writer.write, piece)
+            request.body_read = True
+            async with self.write_lock:
+                record_info = await self.run_blocking(record_writer.close)
+        except BaseException:
+            await self.run_blocking(record_writer.abort)
+            raise
+
+        return 201, {'record_id': record_info['record_id'], 'file_size': record_info['file_size'],
+                     'message': f"Medical record created successfully (Record ID {record_info['record_id']})"}
+
+    # Metrics hold ids and timings but no record contents; still staff only
+    async def handle_metrics(self, request, writer):
+        self.require_staff(request)
+        metrics = self.system.metrics
+        if request.param('format') == 'json':
+            return 200, metrics.snapshot()
+        body = metrics.to_prometheus().encode('utf-8')
+        await self.send_headers(writer, 200, {'Content-Type': 'text/plain; version=0.0.4',
+                                              'Content-Length': str(len(body))})
+        writer.write(body)
+        await writer.drain()
+        return 200, None
+
+    # Streams a record back as it is decrypted, one chunk at a time
+    # With a Range header only that part is decrypted and sent (206 Partial Content)
+    async def handle_fetch_record(self, request, writer, record_id):
+        token, patient_id = await self.require_patient(request)
+        record_info = await self.run_blocking(self.system.encryptor.key_storage.get, record_id)
+        # Patients may only open their own records
+        if record_info is None or record_info['patient_id'] != patient_id:
+            raise HTTPError(404, "Record not found")
+
+        file_size = record_info['file_size']
+        byte_range = parse_range(request.headers.get('range'), file_size)
+        start, end = byte_range if byte_range is not None else (0, file_size)
+        content_type = record_content_type(record_info)
+        if is_text_type(content_type):
+            content_type += '; charset=utf-8'
+        headers = {
+            'Content-Type': content_type,
+            'Content-Length': str(end - start),
+            'Accept-Ranges': 'bytes',
+            'Content-Disposition': f'attachment; filename="{header_safe(record_info["original_filename"])}"',
+        }
+        if byte_range is not None:
+            headers['Content-Range'] = f"bytes {start}-{end - 1}/{file_size}"
+
+        chunks = self.system.encryptor.iter_record_chunks(record_id, start, end)
+        # Closing the generator closes the .enc file, also when the client goes away part way through
+        try:
+            # Decrypt the first chunk before sending headers, so a bad key or missing file is a clean error
+            try:
+                first_chunk = await self.run_blocking(next, chunks, None)
+            except Exception:
+                raise HTTPError(500, "Decryption failed")
+
+            await self.send_headers(writer, 206 if byte_range is not None else 200, headers)
+            chunk = first_chunk
+            while chunk is not None:
+                writer.write(chunk)
+                await writer.drain()
+                try:
+                    chunk = await self.run_blocking(next, chunks, None)
+                except Exception:
+                    # Headers are already sent; dropping the connection tells the client the body is incomplete
+                    raise ConnectionError("Decryption failed part way through")
+        finally:
+            await self.run_blocking(chunks.close)
+        return 200, None
+
+    # Writes a status line and headers
+    async def send_headers(self, writer, status, headers):
+        lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    # Writes a complete JSON response
+    async def send_json(self, writer, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        await self.send_headers(writer, status, dict({'Content-Type': 'application/json',
+                                                      'Content-Length': str(len(body))}, **(headers or {})))
+        writer.write(body)
+        await writer.drain()
+
+
+# Runs the service until interrupted
+# Raises ValueError without a staff key, since the staff endpoints would be unusable
+def run_service(system, host=DEFAULT_HOST, port=DEFAULT_PORT, staff_key=None, workers=DEFAULT_WORKERS):
+    if not staff_key:
+        raise ValueError("A staff key is required to run the service")
+
+    async def serve():
+        service = MedicalRecordService(system, staff_key, workers)
+        server = await service.start(host, port)
+        print(f"Medical Record Service listening on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print("\nService stopped")
+
+
+if __name__ == "__main__":
+    from dedup import SCOPES
+    from main_system import MedicalRecordSystem
+    from storage import DEFAULT_DB_PATH
+
+    parser = argparse.ArgumentParser(description="Medical Record HTTP service")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--staff-key', required=True, help="shared key required for the staff endpoints")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="threads for blocking work")
+    parser.add_argument('--storage', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help="SQLite database path")
+    parser.add_argument('--blob-root', help="folder encrypted files are written under (default blobs/)")
+    parser.add_argument('--dedup', choices=SCOPES,
+                        help="store identical uploads once, shared within one patient or across all patients")
+    args = parser.parse_args()
+
+    run_service(MedicalRecordSystem(storage=args.storage, db_path=args.db, dedup=args.dedup,
+                                    blob_root=args.blob_root),
+                args.host, args.port, args.staff_key, args.workers)
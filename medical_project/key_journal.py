@@ -0,0 +1,217 @@
+# Append-only Key Journal
+# This module persists the encryption key store as a snapshot plus a write-ahead journal
+# Adding a record appends one line to the journal instead of rewriting the whole key file
+# Every so often the journal is compacted into a fresh snapshot
+#
+# encryption_keys.json          snapshot, same format as before (record_id -> record)
+# encryption_keys.json.journal  one JSON object per line:
+#                                 {"op": "put", "record": {...}}
+#                                 {"op": "delete", "record_id": 3}
+#
+# Several processes may share the files (see storage.JsonKeyStore, which serialises writers
+# with a file lock); each remembers how far into the journal it has read and which snapshot
+# it loaded, so it can pick up entries other processes appended, or reload after a compaction
+
+import json
+import os
+
+from compact_records import json_default
+
+# Compact once the journal holds at least this many entries and
+# at least as many entries as the snapshot, so compaction cost stays constant per record
+DEFAULT_COMPACT_MIN_ENTRIES = 1000
+
+
+# This class will handle reading and writing the key snapshot and journal
+# record_factory turns each record read from disk into the form kept in memory
+# (e.g. compact_records.KeyRecord); records stay plain dicts without one
+class KeyJournal:
+    def __init__(self, snapshot_path='encryption_keys.json', journal_path=None,
+                 compact_min_entries=DEFAULT_COMPACT_MIN_ENTRIES, record_factory=None):
+        self.snapshot_path = snapshot_path
+        self.record_factory = record_factory
+        self.journal_path = journal_path or snapshot_path + '.journal'
+        self.compact_min_entries = compact_min_entries
+        self.journal_entries = 0
+        self.journal_file = None
+        # How many bytes of the journal have been read or written by this process
+        self.offset = 0
+        # Identity of the snapshot file that was loaded (see snapshot_identity)
+        self.snapshot_id = None
+
+    # Loads the snapshot and replays the journal on top of it
+    # Returns a dict of record_id -> record, raises FileNotFoundError if neither file exists
+    # Only call this while holding the store's lock, since a torn last entry is cut off the journal
+    def load(self):
+        records = {}
+        found = False
+
+        self.snapshot_id = self.snapshot_identity()
+        if os.path.exists(self.snapshot_path):
+            found = True
+            with open(self.snapshot_path, 'r') as f:
+                # Records are converted as they are parsed, so all of them are never held as dicts at once
+                data = json.load(f, object_hook=self.snapshot_object)
+            # Convert string keys back to integers
+            records = {int(k): v for k, v in data.items()}
+
+        self.journal_entries = 0
+        self.offset = 0
+        if os.path.exists(self.journal_path):
+            found = True
+            with open(self.journal_path, 'rb') as f:
+                data = f.read()
+            entries = self.read_entries(data)
+            for entry in entries:
+                self.apply(records, entry)
+            self.journal_entries = len(entries)
+
+        if not found:
+            raise FileNotFoundError(self.snapshot_path)
+        return records
+
+    # json object_hook for the snapshot: every object with a record_id is a record
+    def snapshot_object(self, value):
+        if self.record_factory is not None and 'record_id' in value:
+            return self.record_factory(value)
+        return value
+
+    # Identity of the snapshot file on disk; it changes whenever any process compacts
+    def snapshot_identity(self):
+        try:
+            stat = os.stat(self.snapshot_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    # Size of the journal on disk
+    def journal_size(self):
+        try:
+            return os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            return 0
+
+    # Checks whether another process has appended or compacted since this one last read
+    def has_changed(self):
+        return self.journal_size() != self.offset or self.snapshot_identity() != self.snapshot_id
+
+    # Returns the journal entries other processes appended since this one last read,
+    # or None if the journal was compacted meanwhile and everything has to be loaded again
+    # Only call this while holding the store's lock, so nobody is appending at the same time
+    def read_new_entries(self):
+        if self.snapshot_identity() != self.snapshot_id or self.journal_size() < self.offset:
+            return None
+        with open(self.journal_path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        entries = self.read_entries(data)
+        self.journal_entries += len(entries)
+        return entries
+
+    # Parses journal data read from self.offset and moves the offset past the complete entries
+    # A crash in the middle of an append can leave a torn last line; that entry was never
+    # acknowledged, so it is dropped and cut off the file, otherwise the next append would be
+    # written straight after it and be lost with it
+    def read_entries(self, data):
+        entries = []
+        lines = data.splitlines(keepends=True)
+        complete = 0
+        for line_number, line in enumerate(lines, 1):
+            try:
+                # Every append ends with a newline, so a line without one is torn
+                if not line.endswith(b'\n'):
+                    raise ValueError("Missing newline")
+                entry = json.loads(line) if line.strip() else None
+            except ValueError:
+                if line_number == len(lines):
+                    self.truncate(self.offset + complete)
+                    break
+                raise ValueError(f"Corrupt journal entry at byte {self.offset + complete}")
+            if entry is not None:
+                entries.append(entry)
+            complete += len(line)
+        self.offset += complete
+        return entries
+
+    # Cuts the journal back to its first length bytes
+    def truncate(self, length):
+        with open(self.journal_path, 'r+b') as f:
+            f.truncate(length)
+            f.flush()
+            os.fsync(f.fileno())
+
+    # Applies one journal entry to a dict of records
+    def apply(self, records, entry):
+        if entry['op'] == 'put':
+            record = entry['record']
+            if self.record_factory is not None:
+                record = self.record_factory(record)
+            records[int(record['record_id'])] = record
+        elif entry['op'] == 'delete':
+            records.pop(int(entry['record_id']), None)
+        else:
+            raise ValueError(f"Unknown journal operation: {entry['op']}")
+
+    # Appends entries to the journal and makes sure they are on disk before returning
+    def append(self, entries):
+        if self.journal_file is None:
+            self.journal_file = open(self.journal_path, 'ab')
+        data = ''.join(json.dumps(entry, default=json_default) + '\n' for entry in entries).encode()
+        self.journal_file.write(data)
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+        self.journal_entries += len(entries)
+        self.offset += len(data)
+
+    # Records a new or updated record
+    def append_put(self, record):
+        self.append([{'op': 'put', 'record': record}])
+
+    # Records a deleted record
+    def append_delete(self, record_id):
+        self.append([{'op': 'delete', 'record_id': record_id}])
+
+    # Checks whether the journal has grown enough to be worth compacting
+    def needs_compaction(self, record_count):
+        return self.journal_entries >= max(self.compact_min_entries, record_count)
+
+    # Writes a full snapshot of the records and empties the journal
+    # The snapshot is written to a temporary file and renamed, so a crash never truncates it
+    def compact(self, records):
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(records, f, indent=2, default=json_default)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        self.sync_directory()
+        self.snapshot_id = self.snapshot_identity()
+
+        # Replaying the old journal over the new snapshot would be harmless, so a crash
+        # between the rename and this truncate loses nothing
+        self.close()
+        with open(self.journal_path, 'w') as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_entries = 0
+        self.offset = 0
+
+    # Makes the rename of the snapshot durable
+    def sync_directory(self):
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    # Closes the journal file handle
+    def close(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
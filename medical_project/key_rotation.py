@@ -0,0 +1,170 @@
+# Master Key Rotation
+# This module replaces the master key-encryption key (see key_wrapping.py) by rewrapping every
+# record's data key with a new one; only key metadata is rewritten, the .enc files are untouched
+#
+# Records are rewrapped in batches on a thread pool, with one key store write per batch
+# Progress is kept in a checkpoint file next to the master keys, so an interrupted rotation
+# carries on with the same new master key instead of starting again
+# Records still holding a plaintext key (stored before envelope encryption) are wrapped too
+#
+# Usage:
+#   python key_rotation.py
+#   python key_rotation.py --workers 8 --batch-size 5000 --storage sqlite
+#   python key_rotation.py --retire      # afterwards, delete master keys no record uses any more
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from key_wrapping import KeyUnwrapError, write_private_file
+
+DEFAULT_WORKERS = 4
+DEFAULT_BATCH_SIZE = 1000
+
+
+# Where the progress of a rotation is kept
+def checkpoint_path_for(master_keys):
+    return master_keys.path + '.rotation'
+
+
+# Reads a rotation checkpoint, returns None if there is no rotation in progress
+def read_checkpoint(checkpoint_path):
+    try:
+        with open(checkpoint_path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+# Rewraps one record, returns (record_id, updated record or None, error message or None)
+def rewrap_job(envelope, record_info, kek_id):
+    try:
+        return record_info['record_id'], envelope.rewrap(record_info, kek_id), None
+    except KeyUnwrapError as e:
+        return record_info['record_id'], None, str(e)
+
+
+# Rewraps every record of an encryptor with a new master key
+# progress, if given, is called as progress(done, total) after each batch
+# Returns a report dict; failed records keep their old wrapping and the checkpoint is kept
+# so running again retries them
+def rotate_master_key(encryptor, workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+    start = time.perf_counter()
+    envelope = encryptor.envelope
+    master_keys = envelope.master_keys
+    checkpoint_path = checkpoint_path_for(master_keys)
+
+    # Carry on with an interrupted rotation, or start a new one with a fresh master key
+    checkpoint = read_checkpoint(checkpoint_path)
+    resumed = checkpoint is not None and checkpoint['target_kek_id'] in master_keys.key_ids()
+    if not resumed:
+        checkpoint = {
+            'target_kek_id': master_keys.add_key(),
+            'started_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'rewrapped': 0,
+        }
+        write_private_file(checkpoint_path, checkpoint)
+    target = checkpoint['target_kek_id']
+
+    # Records already wrapped with the new key were done before an interruption
+    pending = [record_id for record_id, record_info in encryptor.key_storage.items()
+               if not envelope.is_current(record_info, target)]
+    failed = {}
+    done = 0
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for batch_start in range(0, len(pending), batch_size):
+            # Records deleted since the list was made are skipped
+            batch = [encryptor.key_storage.get(record_id)
+                     for record_id in pending[batch_start:batch_start + batch_size]]
+            batch = [record_info for record_info in batch if record_info is not None]
+
+            updated = []
+            for record_id, record_info, error in pool.map(lambda info: rewrap_job(envelope, info, target), batch):
+                if error is None:
+                    updated.append(record_info)
+                else:
+                    failed[record_id] = error
+
+            # One journal append / transaction per batch; the data keys are unchanged,
+            # so cached ciphers and decrypted records stay valid
+            if updated:
+                with encryptor.metrics.timer('key_store_write', records=len(updated)):
+                    encryptor.store.put_many(updated)
+            done += len(batch)
+            checkpoint['rewrapped'] += len(updated)
+            write_private_file(checkpoint_path, checkpoint)
+            if progress is not None:
+                progress(done, len(pending))
+
+    if not failed:
+        # A fresh snapshot drops any plaintext keys still sitting in the old snapshot or journal
+        encryptor.save_keys()
+        os.remove(checkpoint_path)
+    envelope.clear()
+
+    elapsed = time.perf_counter() - start
+    return {
+        'target_kek_id': target,
+        'resumed': resumed,
+        'records': len(pending),
+        'rewrapped': len(pending) - len(failed),
+        'failed': failed,
+        'seconds': round(elapsed, 6),
+        'records_per_second': round(len(pending) / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+
+# Deletes master keys that are neither active nor used by any record, returns their ids
+# Refuses while a rotation is still in progress
+def retire_unused_master_keys(encryptor):
+    master_keys = encryptor.envelope.master_keys
+    if read_checkpoint(checkpoint_path_for(master_keys)) is not None:
+        raise RuntimeError("A key rotation is still in progress; run it to completion first")
+
+    in_use = {record_info.get('kek_id') for record_info in encryptor.key_storage.values()}
+    retired = []
+    for kek_id in master_keys.key_ids():
+        if kek_id != master_keys.active_kek_id and kek_id not in in_use:
+            master_keys.remove_key(kek_id)
+            retired.append(kek_id)
+    return retired
+
+
+if __name__ == "__main__":
+    from encryption import MedicalFileEncryptor
+    from key_wrapping import DEFAULT_MASTER_KEYS_PATH, MasterKeyStore
+    from storage import DEFAULT_DB_PATH, open_stores
+
+    parser = argparse.ArgumentParser(description="Rewrap every record key with a new master key")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="number of rewrapping threads")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="records rewrapped per key store write")
+    parser.add_argument('--master-keys', default=DEFAULT_MASTER_KEYS_PATH, help="master key file")
+    parser.add_argument('--retire', action='store_true',
+                        help="after rotating, delete master keys that no record uses any more")
+    parser.add_argument('--storage', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help="SQLite database path")
+    args = parser.parse_args()
+
+    patient_store, key_store = open_stores(args.storage, args.db)
+    encryptor = MedicalFileEncryptor(store=key_store, master_keys=MasterKeyStore(args.master_keys))
+
+    def show_progress(done, total):
+        print(f"\rRewrapped {done}/{total} records", end='', flush=True)
+
+    report = rotate_master_key(encryptor, args.workers, args.batch_size, show_progress)
+    print(f"\n{'Resumed' if report['resumed'] else 'New'} master key {report['target_kek_id']}: "
+          f"{report['rewrapped']} of {report['records']} records rewrapped in {report['seconds']:.2f}s "
+          f"({report['records_per_second']} records/s)")
+    for record_id, error in report['failed'].items():
+        print(f"FAILED record {record_id}: {error}")
+
+    if report['failed']:
+        print("Some records could not be rewrapped; run again to retry them")
+    elif args.retire:
+        retired = retire_unused_master_keys(encryptor)
+        print(f"Retired {len(retired)} old master key(s)")
@@ -0,0 +1,267 @@
+# Envelope Encryption
+# This module keeps per-record data keys out of the key store in the clear
+# Each record's data key is wrapped (encrypted) with a master key-encryption key (KEK) and only
+# the wrapped key plus the KEK's id are stored; the .enc files never change
+#
+# The master keys live in master_keys.json, a file-based stand-in for a KMS:
+#   {"active": "<kek id>", "keys": {"<kek id>": {"key": "<base64>", "created_at": "..."}},
+#    "fingerprint_key": "<base64>", "ssn_lookup_key": "<base64>"}
+# fingerprint_key is the secret used to fingerprint record contents for deduplication (see dedup.py)
+# and ssn_lookup_key the one the SSN lookup hash is keyed with (see credential_hashing.py);
+# each is created the first time it is needed and is never rotated
+# New records are wrapped with the active KEK; older KEKs are kept so existing records
+# still unwrap until they are rewrapped (see key_rotation.py)
+#
+# Wrapped keys are AES-256-GCM: base64(nonce + ciphertext), with the record id as associated data
+# so a wrapped key copied onto another record fails to unwrap
+# Unwrapped keys are cached for a short time so opening a record again doesn't unwrap again
+#
+# Several processes may share master_keys.json: changes are made under a file lock after
+# reading the file again, and a process picks up keys added elsewhere (e.g. by a rotation)
+
+import base64
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from file_lock import FileLock
+
+DEFAULT_MASTER_KEYS_PATH = 'master_keys.json'
+DEFAULT_UNWRAP_TTL_SECONDS = 60
+DEFAULT_UNWRAP_CACHE_SIZE = 4096
+NONCE_SIZE = 12
+# Secrets kept in the master key file besides the KEKs
+SECRET_NAMES = ('fingerprint_key', 'ssn_lookup_key')
+
+
+# Raised when a wrapped key can't be unwrapped (unknown KEK, tampered or misplaced key)
+class KeyUnwrapError(Exception):
+    pass
+
+
+# Associated data binding a wrapped key to its record
+def record_aad(record_id):
+    return f"record:{record_id}".encode()
+
+
+# Writes a file so it is either fully replaced or left as it was, readable only by the owner
+def write_private_file(path, data):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+# This class will handle the master key-encryption keys
+class MasterKeyStore:
+    def __init__(self, path=DEFAULT_MASTER_KEYS_PATH):
+        self.path = path
+        self.active_kek_id = None
+        # kek_id -> {'key': base64 key, 'created_at': ...}
+        self.keys = {}
+        # Secret name (see SECRET_NAMES) -> base64 secret, missing until first asked for
+        self.secrets = {}
+        # kek_id -> AESGCM, built on first use
+        self.ciphers = {}
+        # Identity of the file as last read or written (see _identity)
+        self.file_id = None
+        self.lock = threading.RLock()
+        # Shared with other processes using the same file
+        self.file_lock = FileLock(path + '.lock')
+        self.load()
+
+    # Reads the master key file, creating it with a first KEK if there isn't one yet
+    def load(self):
+        with self.lock, self.file_lock:
+            if not os.path.exists(self.path):
+                self.keys = {}
+                self.active_kek_id = self._new_key()
+                self._save()
+                return
+            self._read()
+
+    # Reads the file again if another process has changed it since
+    def refresh(self):
+        if self._identity() != self.file_id:
+            with self.lock, self.file_lock:
+                self._read()
+
+    # Creates a new KEK and makes it the active one, returns its id
+    def add_key(self):
+        with self.lock, self.file_lock:
+            self._read()
+            kek_id = self._new_key()
+            self.active_kek_id = kek_id
+            self._save()
+            return kek_id
+
+    # Forgets a KEK; records still wrapped with it can no longer be opened
+    def remove_key(self, kek_id):
+        with self.lock, self.file_lock:
+            self._read()
+            if kek_id == self.active_kek_id:
+                raise ValueError("The active master key can't be removed")
+            self.keys.pop(kek_id, None)
+            self.ciphers.pop(kek_id, None)
+            self._save()
+
+    # Returns the secret used to fingerprint record contents, creating it on first use
+    # Changing it would make every stored fingerprint useless, so it is kept for good
+    def fingerprint_key(self):
+        return self.secret('fingerprint_key')
+
+    # Returns the secret the SSN lookup hash is keyed with, creating it on first use
+    # Changing it would make every patient impossible to find, so it is kept for good
+    def ssn_lookup_key(self):
+        return self.secret('ssn_lookup_key')
+
+    # Returns one of the SECRET_NAMES secrets as bytes, creating it on first use
+    def secret(self, name):
+        with self.lock, self.file_lock:
+            self._read()
+            if name not in self.secrets:
+                self.secrets[name] = base64.b64encode(secrets.token_bytes(32)).decode()
+                self._save()
+            return base64.b64decode(self.secrets[name])
+
+    # Ids of every KEK that is still kept
+    def key_ids(self):
+        self.refresh()
+        with self.lock:
+            return list(self.keys)
+
+    # Wraps a data key for a record with the active KEK, returns (kek_id, wrapped key string)
+    def wrap(self, record_id, data_key, kek_id=None):
+        self.refresh()
+        kek_id = kek_id or self.active_kek_id
+        nonce = os.urandom(NONCE_SIZE)
+        wrapped = nonce + self._cipher(kek_id).encrypt(nonce, data_key, record_aad(record_id))
+        return kek_id, base64.b64encode(wrapped).decode()
+
+    # Unwraps a record's data key, raises KeyUnwrapError if it can't
+    def unwrap(self, record_id, kek_id, wrapped_key):
+        try:
+            wrapped = base64.b64decode(wrapped_key)
+            cipher = self._cipher(kek_id)
+            return cipher.decrypt(wrapped[:NONCE_SIZE], wrapped[NONCE_SIZE:], record_aad(record_id))
+        except KeyUnwrapError:
+            raise
+        except Exception as e:
+            raise KeyUnwrapError(f"Could not unwrap the key for record {record_id}") from e
+
+    # Returns the AES-GCM cipher for a KEK
+    def _cipher(self, kek_id):
+        cipher = self.ciphers.get(kek_id)
+        if cipher is None:
+            entry = self.keys.get(kek_id)
+            if entry is None:
+                # The key may have been added by another process (e.g. a rotation)
+                self.refresh()
+                entry = self.keys.get(kek_id)
+            if entry is None:
+                raise KeyUnwrapError(f"Unknown master key: {kek_id}")
+            cipher = self.ciphers[kek_id] = AESGCM(base64.b64decode(entry['key']))
+        return cipher
+
+    # Adds a new random KEK; the lock must already be held
+    def _new_key(self):
+        kek_id = f"kek-{datetime.now().strftime('%Y%m%d%H%M%S')}-{secrets.token_hex(4)}"
+        self.keys[kek_id] = {
+            'key': base64.b64encode(AESGCM.generate_key(bit_length=256)).decode(),
+            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        return kek_id
+
+    # Identity of the master key file on disk; it changes whenever any process writes it
+    def _identity(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    # Reads the master key file; the locks must already be held
+    def _read(self):
+        file_id = self._identity()
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        self.keys = data['keys']
+        self.active_kek_id = data['active']
+        self.secrets = {name: data[name] for name in SECRET_NAMES if name in data}
+        self.ciphers = {}
+        self.file_id = file_id
+
+    # Writes the master key file; the locks must already be held
+    def _save(self):
+        data = {'active': self.active_kek_id, 'keys': self.keys}
+        data.update(self.secrets)
+        write_private_file(self.path, data)
+        self.file_id = self._identity()
+
+
+# This class will handle wrapping and unwrapping record keys, caching unwrapped keys briefly
+class KeyEnvelope:
+    def __init__(self, master_keys, ttl_seconds=DEFAULT_UNWRAP_TTL_SECONDS,
+                 max_keys=DEFAULT_UNWRAP_CACHE_SIZE):
+        self.master_keys = master_keys
+        self.ttl_seconds = ttl_seconds
+        self.max_keys = max_keys
+        # (record_id, kek_id, wrapped key) -> (data key, expires_at), oldest use first
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Returns the wrapping fields stored with a record in place of its plaintext key
+    def wrap_fields(self, record_id, data_key, kek_id=None):
+        kek_id, wrapped_key = self.master_keys.wrap(record_id, data_key, kek_id)
+        return {'wrapped_key': wrapped_key, 'kek_id': kek_id}
+
+    # Returns a record's data key as bytes
+    # Records stored before envelope encryption may still carry a plaintext 'encryption_key'
+    # until they are wrapped (see MedicalFileEncryptor.wrap_legacy_keys)
+    def data_key(self, record_info):
+        if 'wrapped_key' not in record_info:
+            return record_info['encryption_key'].encode()
+
+        cache_key = (record_info['record_id'], record_info['kek_id'], record_info['wrapped_key'])
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(cache_key)
+            if entry is not None and entry[1] > now:
+                self.cache.move_to_end(cache_key)
+                return entry[0]
+
+        data_key = self.master_keys.unwrap(*cache_key)
+        with self.lock:
+            self.cache[cache_key] = (data_key, now + self.ttl_seconds)
+            self.cache.move_to_end(cache_key)
+            while len(self.cache) > self.max_keys:
+                self.cache.popitem(last=False)
+        return data_key
+
+    # Returns a copy of a record wrapped with the given KEK (the active one by default);
+    # plaintext keys are removed
+    # Only the key metadata changes; the record's data key and .enc file stay the same
+    def rewrap(self, record_info, kek_id=None):
+        data_key = self.data_key(record_info)
+        updated = dict(record_info)
+        updated.pop('encryption_key', None)
+        updated.update(self.wrap_fields(record_info['record_id'], data_key, kek_id))
+        return updated
+
+    # Checks whether a record is already wrapped with the given KEK (the active one by default)
+    def is_current(self, record_info, kek_id=None):
+        return record_info.get('kek_id') == (kek_id or self.master_keys.active_kek_id)
+
+    # Forgets every unwrapped key
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
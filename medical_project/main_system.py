@@ -1,22 +1,72 @@
-from encryption import MedicalFileEncryptor
+from encryption import DEFAULT_DECRYPT_WORKERS, MedicalFileEncryptor, byte_range
 from authentication import PatientAuthenticator
+from content_types import OCTET_STREAM, is_text_type, record_content_type
+from dedup import SCOPES
+from event_log import CONSOLE, LOG_MODES, configure_logging, get_logger, log_event
+from metrics import METRICS
+from session_manager import SessionManager
+from storage import DEFAULT_DB_PATH, open_stores
+import argparse
+import logging
 import os 
 
+# Number of records per page in the patient portal
+DEFAULT_PAGE_SIZE = 10
+
+logger = get_logger('system')
+
 
 class MedicalRecordSystem:
     # Initializing the system
-    def __init__(self):
-        self.encryptor = MedicalFileEncryptor()
-        self.authenticator = PatientAuthenticator()
+    # storage is 'json' (patients_data.json / encryption_keys.json) or 'sqlite' (db_path)
+    # metrics collects timings and counters from every part of the system (see metrics.py)
+    # dedup is None, or the scope identical uploads are shared within (see dedup.py)
+    # blob_root is the folder encrypted files are written under (blobs/ by default, see blob_store.py)
+    def __init__(self, storage='json', db_path=DEFAULT_DB_PATH, metrics=None, dedup=None, blob_root=None):
+        self.metrics = metrics if metrics is not None else METRICS
+        patient_store, key_store = open_stores(storage, db_path)
+        self.encryptor = MedicalFileEncryptor(store=key_store, metrics=self.metrics, dedup=dedup,
+                                              blob_root=blob_root)
+        self.authenticator = PatientAuthenticator(store=patient_store, metrics=self.metrics,
+                                                  lookup_key=self.encryptor.envelope.master_keys.ssn_lookup_key())
+        # Sessions for any number of logged-in patients, identified by token
+        self.sessions = SessionManager(on_expired=self.session_expired)
+        self.metrics.register_collector('sessions', lambda: {'active': self.sessions.active_count()})
+        # The interactive menus serve one patient at a time; they remember that patient's token here
         self.current_user_id = None
+        self.current_token = None
+
+    # Works out which patient a request is for
+    # With a token the session must be valid; without one the interactive menu's patient is used
+    def resolve_patient(self, token=None):
+        if token is not None:
+            return self.sessions.validate(token)
+        if self.current_token is not None and self.sessions.validate(self.current_token) is None:
+            # The menu's session expired, so the menu patient is logged out too
+            self.current_user_id = None
+            self.current_token = None
+        return self.current_user_id
+
+    # Called when a patient's last session times out
+    # Drops the patient's decrypted records from memory, as logging out does
+    def session_expired(self, patient_id):
+        self.encryptor.cache.invalidate_patient(patient_id)
+        log_event(logger, 'session.expired', f"Session of patient {patient_id} expired", patient_id=patient_id)
+
+    # Drops expired sessions and expired cached records (a long-running service calls this periodically)
+    def purge_expired(self):
+        self.sessions.purge_expired()
+        self.encryptor.cache.purge_expired()
+
+    # Message returned when a request has no valid session
+    def not_logged_in_message(self, token=None):
+        if token is not None:
+            return "Session expired or invalid. Please login again."
+        return "No one is logged in. Please login first."
 
     # Registers a new patient
     def register_patient(self, ssn, name, email, password):
         
-        print(f"\n{'='*60}")
-        print(f"HOSPITAL: Registering Patient")
-        print(f"{'='*60}")
-        
         # Call the authenticator's register_patient function
         success, patient_id, pin, message = self.authenticator.register_patient(ssn, name, email, password)
 
@@ -27,39 +77,66 @@ class MedicalRecordSystem:
         return success, patient_id, pin, message
 
     # Logs in user
-    def login(self, ssn, pin, password):
+    # Returns (success, token, message); the token identifies this session in later calls
+    def login_session(self, ssn, pin, password):
 
-        print(f"\n{'='*60}")
-        print(f"PATIENT PORTAL: Login")
-        print(f"{'='*60}")
-        
         # Call the authenticator's authenticate_patient function
-        
-        success, patient_id, message = self.authenticator.authenticate_patient(ssn,pin,password)
+        with self.metrics.timer('login'):
+            success, patient_id, message = self.authenticator.authenticate_patient(ssn,pin,password)
+        if not success:
+            return False, None, message
+
+        token = self.sessions.create_session(patient_id)
+        log_event(logger, 'session.created', f"Session started for patient {patient_id}",
+                  patient_id=patient_id, active_sessions=self.sessions.active_count())
+        return True, token, message
+
+    # Logs in user for the interactive menu
+    def login(self, ssn, pin, password):
+        success, token, message = self.login_session(ssn, pin, password)
         # Checking if it is the same user
         if success:
-            self.current_user_id = patient_id
+            # Logging in over someone else's session ends it, so drop their cached records too
+            if self.current_token is not None:
+                self.logout(self.current_token)
+            self.current_user_id = self.sessions.validate(token)
+            self.current_token = token
             
     
         return success, message
 
         
     # Logs out user
-    def logout(self):
-        # Check if someone is logged in
-        if self.current_user_id == None:
-            return print(f"\n No one is logged in")
-        
-        # Clear the current_user_id
-        self.current_user_id = None
+    # With a token that session is ended; without one the interactive menu's patient is logged out
+    # Returns a message for the caller to show
+    def logout(self, token=None):
+        if token is None:
+            # Check if someone is logged in
+            if self.current_user_id == None:
+                return "No one is logged in"
+            token = self.current_token
+            patient_id = self.current_user_id
+            # Clear the current_user_id
+            self.current_user_id = None
+            self.current_token = None
+            self.sessions.revoke(token)
+        else:
+            patient_id = self.sessions.revoke(token)
+            if patient_id is None:
+                return "No one is logged in"
+            if token == self.current_token:
+                self.current_user_id = None
+                self.current_token = None
+
+        # Drop the patient's decrypted records from memory once their last session is gone
+        if not self.sessions.has_sessions(patient_id):
+            self.encryptor.cache.invalidate_patient(patient_id)
+        log_event(logger, 'session.ended', f"Patient {patient_id} logged out", patient_id=patient_id)
+        return "Logged out successfully"
 
     # Creating a medical record 
     def create_medical_record(self, patient_id, file_path, record_type):
         
-        print(f"\n{'='*60}")
-        print(f"DOCTOR: Creating Medical Record")
-        print(f"{'='*60}")
-        
         #  Check if the patient exists
 
         if patient_id not in self.authenticator.patients:
@@ -80,52 +157,214 @@ class MedicalRecordSystem:
         return True, f"Medical record created successfully (Record ID {record_info['record_id']})"
 
     # View medical records for the current patient
-    def view_my_records(self):
+    # With parallel=True the records are decrypted concurrently (at most max_workers at a time)
+    # The decrypted content is kept in memory only; write_files=True also writes decrypted_* files
+    # Only text records are decrypted and shown inline; binary records (X-rays, PDFs...) are listed
+    # with content None and are fetched with retrieve_my_record
+    def view_my_records(self, parallel=False, max_workers=DEFAULT_DECRYPT_WORKERS, write_files=False, token=None):
 
-        print(f"\n{'='*60}")
-        print(f"PATIENT: Viewing My Medical Records")
-        print(f"{'='*60}")
-        
         # Check if anyone is logged in
-        if self.current_user_id is None:
-            return False, [], "No one is logged in. Please login first."
+        patient_id = self.resolve_patient(token)
+        if patient_id is None:
+            return False, [], self.not_logged_in_message(token)
         
-        my_records = []
         # Get all encrypted records for THIS patient
-        for record_id, record_info in self.encryptor.key_storage.items():
-            
-            if record_info['patient_id'] == self.current_user_id:
-                print(f"\nFound record: {record_info['original_filename']}")
-                print(f"\n\tDecrypting...")
-                
-                decrypted_data = self.encryptor.decrypt_file(record_id)
-                
-                if decrypted_data:
-                    my_records.append({
-                        'record_id': record_id,
-                        'filename': record_info['original_filename'],
-                        'record_type': record_info['record_type'],
-                        'created_at': record_info['created_at'],
-                        'content': decrypted_data.decode('utf-8')
-                    })
+        patient_records = self.encryptor.records_for_patient(patient_id)
+        log_event(logger, 'records.viewing', f"Decrypting {len(patient_records)} record(s)",
+                  logging.DEBUG, patient_id=patient_id, records=len(patient_records))
+
+        to_decrypt = [record_info for record_info in patient_records
+                      if write_files or self.is_inline(record_info)]
+        record_ids = [record_info['record_id'] for record_info in to_decrypt]
+        with self.metrics.timer('view_my_records', patient_id=patient_id, records=len(record_ids)):
+            decrypted = self.encryptor.decrypt_many(record_ids, max_workers if parallel else 1, write_files)
+        decrypted = dict(zip(record_ids, decrypted))
+
+        my_records = []
+        for record_info in patient_records:
+            record_id = record_info['record_id']
+            if record_id in decrypted and not decrypted[record_id]:
+                continue
+            my_records.append({
+                'record_id': record_id,
+                'filename': record_info['original_filename'],
+                'record_type': record_info['record_type'],
+                'created_at': record_info['created_at'],
+                'content_type': record_content_type(record_info),
+                'content': self.inline_content(record_info, decrypted.get(record_id))
+            })
         if len(my_records) == 0:
             return False, [], "No medical records found"
         
         return True, my_records, f"Found {len(my_records)} record(s)"
 
+    # Metadata for one record, as shown to the patient (never includes the key)
+    def record_summary(self, record_info):
+        return {
+            'record_id': record_info['record_id'],
+            'filename': record_info['original_filename'],
+            'record_type': record_info['record_type'],
+            'created_at': record_info['created_at'],
+            'file_size': record_info['file_size'],
+            'content_type': record_content_type(record_info),
+        }
+
+    # Checks whether a record is text that is shown inline (everything else is handed back as bytes)
+    def is_inline(self, record_info):
+        return is_text_type(record_content_type(record_info))
+
+    # Decodes a text record's decrypted bytes for showing inline
+    # Returns None for binary records, and for older records whose bytes turn out not to be UTF-8
+    def inline_content(self, record_info, decrypted_data):
+        if decrypted_data is None or not self.is_inline(record_info):
+            return None
+        try:
+            return decrypted_data.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+
+    # A patient's record metadata sorted by created_at (ties broken by record id)
+    # Only reads the key store, nothing is decrypted
+    def my_record_infos(self, patient_id, newest_first=True, record_type=None):
+        patient_records = self.encryptor.records_for_patient(patient_id, record_type)
+        patient_records.sort(key=lambda info: (info['created_at'], info['record_id']), reverse=newest_first)
+        return patient_records
+
+    # Lists one page of the current patient's records without decrypting anything
+    # Returns (success, page_info, message) where page_info holds 'records', 'page',
+    # 'page_size', 'total' and 'pages'
+    def list_my_records(self, page=1, page_size=DEFAULT_PAGE_SIZE, newest_first=True, record_type=None,
+                        token=None):
+        patient_id = self.resolve_patient(token)
+        if patient_id is None:
+            return False, None, self.not_logged_in_message(token)
+        if page < 1 or page_size < 1:
+            return False, None, "Page and page size must be at least 1"
+
+        patient_records = self.my_record_infos(patient_id, newest_first, record_type)
+        start = (page - 1) * page_size
+        page_info = {
+            'records': [self.record_summary(info) for info in patient_records[start:start + page_size]],
+            'page': page,
+            'page_size': page_size,
+            'total': len(patient_records),
+            'pages': (len(patient_records) + page_size - 1) // page_size,
+        }
+        return True, page_info, f"Page {page} of {page_info['pages']} ({page_info['total']} record(s))"
+
+    # Decrypts a single record belonging to the current patient
+    # Returns (success, record, message); record is the summary plus 'content'
+    # 'content' is None for binary records, which are only decrypted when write_file is set
+    # (see retrieve_my_record to stream them)
+    def get_my_record(self, record_id, write_file=False, token=None):
+        patient_id = self.resolve_patient(token)
+        if patient_id is None:
+            return False, None, self.not_logged_in_message(token)
+
+        record_info = self.encryptor.key_storage.get(record_id)
+        # Patients may only open their own records
+        if record_info is None or record_info['patient_id'] != patient_id:
+            return False, None, "Record not found"
+
+        record = self.record_summary(record_info)
+        if not write_file and not self.is_inline(record_info):
+            record['content'] = None
+            return True, record, "Binary record, use retrieve_my_record to read it"
+
+        if write_file:
+            decrypted_data = self.encryptor.decrypt_to_file(record_id)
+        else:
+            decrypted_data = self.encryptor.read_record(record_id)
+        if decrypted_data is None:
+            return False, None, "Decryption failed"
+
+        record['content'] = self.inline_content(record_info, decrypted_data)
+        return True, record, "Record decrypted"
+
+    # Retrieves a record belonging to the current patient according to its content type
+    # Text records come back whole and inline as 'content'; binary records (X-rays, PDFs...) and
+    # any byte range come back as 'stream', a file object that decrypts as it is read (close it
+    # when done), so large images are never loaded whole
+    # range_start/range_end fetch just the bytes [range_start, range_end) of the record;
+    # 'range' holds the (start, end) actually served
+    # Returns (success, record, message); record is the summary plus 'content' or 'stream'
+    def retrieve_my_record(self, record_id, range_start=0, range_end=None, token=None):
+        patient_id = self.resolve_patient(token)
+        if patient_id is None:
+            return False, None, self.not_logged_in_message(token)
+
+        record_info = self.encryptor.key_storage.get(record_id)
+        # Patients may only open their own records
+        if record_info is None or record_info['patient_id'] != patient_id:
+            return False, None, "Record not found"
+        try:
+            range_start, range_end = byte_range(record_info, range_start, range_end)
+        except ValueError as e:
+            return False, None, str(e)
+
+        record = self.record_summary(record_info)
+        record['range'] = (range_start, range_end)
+        whole = range_start == 0 and range_end == record_info['file_size']
+        if whole and self.is_inline(record_info):
+            decrypted_data = self.encryptor.read_record(record_id)
+            if decrypted_data is None:
+                return False, None, "Decryption failed"
+            content = self.inline_content(record_info, decrypted_data)
+            if content is not None:
+                record['content'] = content
+                return True, record, "Record decrypted"
+            # An older record named like text but holding binary data
+            record['content_type'] = OCTET_STREAM
+
+        record['stream'] = self.encryptor.open_record(record_id, range_start, range_end)
+        return True, record, f"Streaming bytes {range_start}-{range_end} of {record_info['file_size']}"
+
+    # Decrypts one page of the current patient's records (in memory, concurrently)
+    # Returns (success, page_info, message) like list_my_records, with 'content' filled in
+    # for text records (None for binary ones)
+    def get_my_records_page(self, page=1, page_size=DEFAULT_PAGE_SIZE, newest_first=True,
+                            record_type=None, max_workers=DEFAULT_DECRYPT_WORKERS, token=None):
+        success, page_info, message = self.list_my_records(page, page_size, newest_first, record_type, token)
+        if not success:
+            return success, page_info, message
+
+        # Binary records are left for retrieve_my_record; summaries carry their content type
+        inline_records = [record for record in page_info['records'] if is_text_type(record['content_type'])]
+        record_ids = [record['record_id'] for record in inline_records]
+        with self.metrics.timer('records_page', records=len(record_ids)):
+            decrypted = self.encryptor.decrypt_many(record_ids, max_workers, write_files=False)
+        for record, decrypted_data in zip(inline_records, decrypted):
+            record['content'] = self.inline_content(record, decrypted_data)
+        for record in page_info['records']:
+            record.setdefault('content', None)
+        return True, page_info, message
+
+    # Yields the current patient's records one at a time, decrypting each only when it is reached
+    def iter_my_records(self, newest_first=True, record_type=None, token=None):
+        patient_id = self.resolve_patient(token)
+        if patient_id is None:
+            return
+        for record_info in self.my_record_infos(patient_id, newest_first, record_type):
+            success, record, message = self.get_my_record(record_info['record_id'], token=token)
+            if success:
+                yield record
+
     # Incase someone forgot a pin
     def forgot_pin(self, ssn, email):
 
-        print(f"\n{'='*60}")
-        print(f"PATIENT: Forgot PIN Recovery")
-        print(f"{'='*60}")
-
         #  Call the authenticator's reset_pin function
         success, new_pin, message = self.authenticator.reset_pin(ssn, email)
         
-        # If successful, print an important reminder
+        # If successful, end the sessions opened with the old PIN
         if success: 
-            print(f"\nIMPORTANT: Your medical records are still encrypted")
+            # The old PIN no longer works, so neither do sessions opened with it
+            patient = self.authenticator.find_patient_by_ssn_hash(self.authenticator.hash_credential(ssn))
+            if patient is not None:
+                self.sessions.revoke_patient(patient['patient_id'])
+                if self.current_user_id == patient['patient_id']:
+                    self.current_user_id = None
+                    self.current_token = None
+                self.encryptor.cache.invalidate_patient(patient['patient_id'])
     
         return success, new_pin, message
 
@@ -281,22 +520,32 @@ def patient_portal(system):
             print("\nMedical Records")
             print("-"*60)
 
-            success, records, message = system.view_my_records()
+            success, page_info, message = system.list_my_records(page_size=DEFAULT_PAGE_SIZE)
 
-            if success and len(records) > 0:
-                print(f"\n{message}\n")
+            if success and page_info['total'] > 0:
+                print(f"\nFound {page_info['total']} record(s), newest first\n")
 
-                for i, record in enumerate(records, 1):
+                # Each record is only decrypted when it is about to be shown
+                for i, record in enumerate(system.iter_my_records(), 1):
                     print("="*60)
                     print(f"Record {i}: {record['filename']} ({record['record_type']})")
                     print("=" * 60)
                     print(f"Created: {record['created_at']} ")
                     print("\nContent:")
-                    print(record['content'])
+                    if record['content'] is not None:
+                        print(record['content'])
+                    else:
+                        # X-rays, PDFs and other binary records aren't printed as text
+                        print(f"[{record['content_type']}, {record['file_size']} bytes]")
                     print()
+
+                    if i % DEFAULT_PAGE_SIZE == 0 and i < page_info['total']:
+                        more = input("Show more records? (y/n): ").strip().lower()
+                        if more != 'y':
+                            break
             
-            elif success and len(records) == 0:
-                print(f"\n{message}")
+            elif success:
+                print(f"\nNo medical records found")
             else:
                 print(f"\n{message}")
 
@@ -315,6 +564,7 @@ def patient_portal(system):
                 print(f"\n{message}")
                 print(f"\tNew PIN: {new_pin}")
                 print(f"\t(this would be sent to your email)")
+                print(f"\nIMPORTANT: Your medical records are still encrypted")
             else: 
                 print(f"\n{message}")
             
@@ -332,8 +582,36 @@ def patient_portal(system):
             print("\nInvalid choice. Please try again.")
             
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Medical Record System")
+    parser.add_argument('--storage', choices=['json', 'sqlite'], default='json',
+                        help="where patients and encryption keys are stored")
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help="SQLite database path")
+    parser.add_argument('--serve', action='store_true', help="run the HTTP service instead of the menus")
+    parser.add_argument('--host', default='127.0.0.1', help="address the HTTP service listens on")
+    parser.add_argument('--port', type=int, default=8080, help="port the HTTP service listens on")
+    parser.add_argument('--staff-key', help="shared key required for the HTTP staff endpoints (needed with --serve)")
+    parser.add_argument('--blob-root', help="folder encrypted files are written under (default blobs/)")
+    parser.add_argument('--dedup', choices=SCOPES,
+                        help="store identical uploads once, shared within one patient or across all patients")
+    parser.add_argument('--log', choices=LOG_MODES, default=CONSOLE,
+                        help="where log events go: silent, console (plain text) or json (one object per line)")
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='WARNING',
+                        help="lowest level of log event to show")
+    args = parser.parse_args()
+    if args.serve and not args.staff_key:
+        parser.error("--serve needs --staff-key, otherwise the staff endpoints are left unusable")
+
+    # The menus print what the user needs; log events only show warnings and errors unless asked
+    configure_logging(args.log, getattr(logging, args.log_level))
+
     # Initialize the system
-    system = MedicalRecordSystem()
+    system = MedicalRecordSystem(storage=args.storage, db_path=args.db, dedup=args.dedup,
+                                 blob_root=args.blob_root)
+
+    if args.serve:
+        from http_service import run_service
+        run_service(system, args.host, args.port, args.staff_key)
+        exit(0)
     
     # Start the interactive menu
     main_menu(system)
\ No newline at end of file
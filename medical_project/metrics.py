@@ -0,0 +1,194 @@
+# Metrics
+# This module keeps timers, counters and latency histograms for the hot paths
+# (key store load/save, file encryption and decryption, credential hashing, logins, ...)
+# so we can see where the time goes in a running system
+#
+# Everything is kept in memory and can be exported as:
+#   Prometheus text format  - to_prometheus(), served at GET /metrics by http_service.py
+#   a JSON snapshot         - snapshot()
+#
+# An optional profiling hook is called after every timed stage with
+# (stage, seconds, fields), e.g. to log slow calls in production (see slow_call_hook)
+
+import bisect
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from event_log import get_logger, log_event
+
+METRIC_PREFIX = 'medical'
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = get_logger('metrics')
+
+
+# A latency histogram with fixed buckets
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One count per bucket plus one for values above the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    # Estimates a quantile (0-1) from the buckets; returns the bucket's upper bound
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        running = 0
+        for bound, count in zip(self.buckets, self.counts):
+            running += count
+            if running >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum_seconds': round(self.total, 6),
+            'mean_seconds': round(self.total / self.count, 6) if self.count else 0.0,
+            'p50_seconds': round(self.quantile(0.5), 6),
+            'p95_seconds': round(self.quantile(0.95), 6),
+            'p99_seconds': round(self.quantile(0.99), 6),
+            'max_seconds': round(self.max, 6),
+        }
+
+
+# This class will handle collecting and exporting metrics
+class MetricsRegistry:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # name -> value, e.g. 'bytes_encrypted' -> 12345
+        self.counters = {}
+        # stage -> Histogram of durations in seconds
+        self.timers = {}
+        # prefix -> function returning a dict of current values (e.g. cache.stats)
+        self.collectors = {}
+        self.profile_hook = None
+        self.lock = threading.Lock()
+
+    # Adds to a counter
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Records how long one call of a stage took and passes it to the profiling hook
+    def record_call(self, stage, seconds, **fields):
+        with self.lock:
+            histogram = self.timers.get(stage)
+            if histogram is None:
+                histogram = self.timers[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+        if self.profile_hook is not None:
+            self.call_profile_hook(stage, seconds, fields)
+
+    # Times the code inside a with block as one call of a stage
+    @contextmanager
+    def timer(self, stage, **fields):
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.record_call(stage, time.perf_counter() - start, **fields)
+
+    # Adds a source of point-in-time values (exported as gauges named <prefix>_<key>)
+    def register_collector(self, prefix, function):
+        self.collectors[prefix] = function
+
+    # Sets the function called after every timed stage with (stage, seconds, fields); None turns it off
+    def set_profile_hook(self, hook):
+        self.profile_hook = hook
+
+    # A broken hook must never break the call it is measuring
+    def call_profile_hook(self, stage, seconds, fields):
+        try:
+            self.profile_hook(stage, seconds, fields)
+        except Exception as e:
+            log_event(logger, 'metrics.hook_failed', f"Profiling hook failed: {e}", logging.ERROR,
+                      stage=stage, error=type(e).__name__)
+
+    # Current values from the collectors (only numbers are kept)
+    def collect_gauges(self):
+        gauges = {}
+        for prefix, function in list(self.collectors.items()):
+            try:
+                values = function()
+            except Exception:
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges[f"{prefix}_{key}"] = value
+        return gauges
+
+    # Returns every metric as a JSON-friendly dict
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            timers = {stage: histogram.summary() for stage, histogram in self.timers.items()}
+        return {'counters': counters, 'timers': timers, 'gauges': self.collect_gauges()}
+
+    # Returns the snapshot as a JSON string
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    # Returns every metric in the Prometheus text exposition format
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.counters):
+                metric = f"{METRIC_PREFIX}_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {self.counters[name]}")
+
+            if self.timers:
+                metric = f"{METRIC_PREFIX}_stage_duration_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                for stage in sorted(self.timers):
+                    histogram = self.timers[stage]
+                    running = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        running += count
+                        lines.append(f'{metric}_bucket{{stage="{stage}",le="{bound}"}} {running}')
+                    lines.append(f'{metric}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{metric}_sum{{stage="{stage}"}} {histogram.total:.6f}')
+                    lines.append(f'{metric}_count{{stage="{stage}"}} {histogram.count}')
+
+        for name, value in sorted(self.collect_gauges().items()):
+            metric = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return '\n'.join(lines) + '\n'
+
+    # Forgets every counter and timer (collectors and the hook are kept)
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+
+
+# Returns a profiling hook that logs any stage slower than threshold_ms
+# Only the fields passed by the caller (ids, byte counts) are logged, never record contents
+def slow_call_hook(threshold_ms=250, hook_logger=logger):
+    def hook(stage, seconds, fields):
+        if seconds * 1000 >= threshold_ms:
+            log_event(hook_logger, 'profile.slow_call', f"Slow {stage}: {seconds * 1000:.1f} ms",
+                      logging.WARNING, stage=stage, duration_ms=round(seconds * 1000, 3), **fields)
+    return hook
+
+
+# The registry shared by the whole process unless a component is given its own
+METRICS = MetricsRegistry()
@@ -0,0 +1,146 @@
+# Decrypted Record Cache
+# This module keeps recently decrypted records in memory so opening the same record again
+# doesn't re-read and re-decrypt the file
+# The cache is bounded by total size, evicts the least recently used record first and
+# forgets every record after a short time-to-live, because it holds patient data in the clear
+# Expired records are swept out on every get, put and stats call, not only when they are looked up
+#
+# Cached plaintext is kept in bytearrays and overwritten with zeros when it leaves the cache
+# (Copies handed back to callers are normal bytes objects and are not zeroized)
+
+import threading
+import time
+from collections import OrderedDict, deque
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 300
+
+
+# Overwrites a buffer with zeros
+def zeroize(buffer):
+    memoryview(buffer)[:] = bytes(len(buffer))
+
+
+# This class will handle caching decrypted record contents
+class DecryptedRecordCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl_seconds=DEFAULT_TTL_SECONDS, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        # record_id -> (plaintext bytearray, patient_id, expires_at), oldest use first
+        self.entries = OrderedDict()
+        # (expires_at, record_id) in the order records were cached, which is also the order they
+        # expire in, since every record gets the same TTL; items for records that were removed
+        # or cached again meanwhile are skipped by the sweep
+        self.expiry_queue = deque()
+        # patient_id -> set of cached record ids, so a patient's records can be dropped on logout
+        self.patient_records = {}
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+
+        # Counters for tuning the size and TTL
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    # Returns the cached plaintext for a record, or None if it isn't cached (or has expired)
+    def get(self, record_id):
+        with self.lock:
+            self._purge_expired(self.clock())
+            entry = self.entries.get(record_id)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(record_id)
+            self.hits += 1
+            return bytes(entry[0])
+
+    # Caches the plaintext of a record, evicting least recently used records to make room
+    def put(self, record_id, patient_id, data):
+        if self.max_bytes <= 0 or len(data) > self.max_bytes:
+            return
+        with self.lock:
+            now = self.clock()
+            self._purge_expired(now)
+            if record_id in self.entries:
+                self._remove(record_id)
+
+            while self.entries and self.current_bytes + len(data) > self.max_bytes:
+                oldest_id = next(iter(self.entries))
+                self._remove(oldest_id)
+                self.evictions += 1
+
+            expires_at = now + self.ttl_seconds
+            self.entries[record_id] = (bytearray(data), patient_id, expires_at)
+            self.expiry_queue.append((expires_at, record_id))
+            self.patient_records.setdefault(patient_id, set()).add(record_id)
+            self.current_bytes += len(data)
+
+    # Drops one record from the cache (e.g. when its key changes or it is deleted)
+    def invalidate(self, record_id):
+        with self.lock:
+            self._remove(record_id)
+
+    # Drops every cached record belonging to a patient (e.g. on logout)
+    def invalidate_patient(self, patient_id):
+        with self.lock:
+            for record_id in list(self.patient_records.get(patient_id, ())):
+                self._remove(record_id)
+
+    # Drops everything
+    def clear(self):
+        with self.lock:
+            for record_id in list(self.entries):
+                self._remove(record_id)
+            self.expiry_queue.clear()
+
+    # Drops (and zeroizes) every record whose TTL has run out, returns how many were dropped
+    def purge_expired(self):
+        with self.lock:
+            return self._purge_expired(self.clock())
+
+    # Returns the cache counters
+    def stats(self):
+        with self.lock:
+            self._purge_expired(self.clock())
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl_seconds,
+            }
+
+    # Removes expired entries; the lock must already be held
+    def _purge_expired(self, now):
+        purged = 0
+        while self.expiry_queue and self.expiry_queue[0][0] <= now:
+            expires_at, record_id = self.expiry_queue.popleft()
+            entry = self.entries.get(record_id)
+            if entry is not None and entry[2] == expires_at:
+                self._remove(record_id)
+                self.expirations += 1
+                purged += 1
+        return purged
+
+    # Removes an entry and zeroizes its plaintext; the lock must already be held
+    def _remove(self, record_id):
+        entry = self.entries.pop(record_id, None)
+        if entry is None:
+            return
+        data, patient_id, expires_at = entry
+        self.current_bytes -= len(data)
+        zeroize(data)
+
+        patient_records = self.patient_records.get(patient_id)
+        if patient_records is not None:
+            patient_records.discard(record_id)
+            if not patient_records:
+                del self.patient_records[patient_id]
@@ -0,0 +1,82 @@
+# Record Keyring
+# This module keeps ready-to-use cipher objects for recently used record keys
+# Building a cipher means base64-decoding the stored key and setting up the cipher,
+# so repeated decrypts of the same record reuse the objects built the first time
+# The keyring is bounded and forgets the least recently used keys first
+
+import threading
+from collections import OrderedDict
+
+from cryptography.fernet import Fernet
+
+from stream_cipher import cipher_from_key
+
+DEFAULT_MAX_KEYS = 4096
+
+
+# This class will handle caching parsed cipher objects per record
+class RecordKeyring:
+    def __init__(self, max_keys=DEFAULT_MAX_KEYS):
+        self.max_keys = max_keys
+        # record_id -> {'key': key string, 'fernet': Fernet or None, 'stream': AESGCM or None}
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the cached entry for a record, starting a new one if the key isn't known yet
+    # The stored key string is compared so a changed key never reuses an old cipher
+    def _entry(self, record_id, key):
+        entry = self.entries.get(record_id)
+        if entry is not None and entry['key'] == key:
+            self.entries.move_to_end(record_id)
+            return entry
+
+        entry = {'key': key, 'fernet': None, 'stream': None}
+        self.entries[record_id] = entry
+        self.entries.move_to_end(record_id)
+        while len(self.entries) > self.max_keys:
+            self.entries.popitem(last=False)
+        return entry
+
+    # Returns a Fernet cipher for a record (used by the older single-token format)
+    def fernet(self, record_id, key):
+        with self.lock:
+            entry = self._entry(record_id, key)
+            if entry['fernet'] is None:
+                self.misses += 1
+                entry['fernet'] = Fernet(key)
+            else:
+                self.hits += 1
+            return entry['fernet']
+
+    # Returns an AES-GCM cipher for a record (used by the streaming format)
+    def stream_cipher(self, record_id, key):
+        with self.lock:
+            entry = self._entry(record_id, key)
+            if entry['stream'] is None:
+                self.misses += 1
+                entry['stream'] = cipher_from_key(key)
+            else:
+                self.hits += 1
+            return entry['stream']
+
+    # Forgets the ciphers for a record (e.g. when it is deleted or its key changes)
+    def invalidate(self, record_id):
+        with self.lock:
+            self.entries.pop(record_id, None)
+
+    # Forgets every cipher
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # Returns the keyring counters
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'keys': len(self.entries),
+                'max_keys': self.max_keys,
+            }
@@ -0,0 +1,388 @@
+# Integrity Scrub
+# This module checks every record's encrypted file against its key metadata before a patient
+# runs into a problem, instead of finding out when decrypt_file fails in front of them
+#
+# For each record it checks that:
+#   - the .enc file exists and its key unwraps
+#   - every chunk passes authentication (the plaintext is counted and thrown away, never written)
+#   - the decrypted size matches 'stored_size' and, once decompressed, 'file_size'
+# and afterwards it looks for .enc files that no record points at (orphans) and temporary
+# files left behind by interrupted writes
+#
+# Records are checked on a bounded thread pool, reads can be limited to a number of MB/s so a
+# scrub can run beside production traffic, and progress is checkpointed after every batch so
+# an interrupted scrub carries on where it stopped (checking the problems it had already found
+# again, in case they were fixed in the meantime)
+# A file shared by several deduplicated records is decrypted once per pass, not once per record
+#
+# Usage:
+#   python scrub.py
+#   python scrub.py --workers 8 --rate-mb 50 --json scrub_report.json
+#   python scrub.py --restart          # ignore the checkpoint and start from the first record
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from cryptography.fernet import Fernet
+
+from compression import NONE, iter_decompressed
+from event_log import get_logger, log_event
+from key_wrapping import KeyUnwrapError, write_private_file
+from stream_cipher import is_stream_file, iter_decrypted_chunks
+
+DEFAULT_WORKERS = 4
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_CHECKPOINT_PATH = 'scrub_checkpoint.json'
+# Files younger than this are not reported as orphans; an upload may not have stored its key yet
+DEFAULT_ORPHAN_MIN_AGE_SECONDS = 3600
+
+# Kinds of problem found
+MISSING_FILE = 'missing_file'
+KEY_UNAVAILABLE = 'key_unavailable'
+CORRUPT = 'corrupt'
+SIZE_MISMATCH = 'size_mismatch'
+ORPHAN_FILE = 'orphan_file'
+STALE_TEMP_FILE = 'stale_temp_file'
+
+logger = get_logger('scrub')
+
+
+# Limits how many bytes per second all workers read together
+class RateLimiter:
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        # The time at which everything read so far is "paid for"
+        self.next_free = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Waits until byte_count more bytes may be read
+    def consume(self, byte_count):
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_free, now)
+            self.next_free = start + byte_count / self.bytes_per_second
+            wait = start - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Wraps a file so every read goes through a RateLimiter
+class ThrottledReader:
+    def __init__(self, in_file, limiter):
+        self.in_file = in_file
+        self.limiter = limiter
+
+    def read(self, size=-1):
+        data = self.in_file.read(size)
+        self.limiter.consume(len(data))
+        return data
+
+
+# Decrypts a file with a record's key, counting the plaintext and throwing it away
+# Returns (stored size, decrypted size, None), or (None, None, error message) if it fails
+# A fresh cipher keeps the scrub out of the keyring cache
+def verify_file(encrypted_filename, encryption_key, codec, limiter=None):
+    try:
+        with open(encrypted_filename, 'rb') as f:
+            in_file = ThrottledReader(f, limiter) if limiter is not None else f
+            if is_stream_file(encrypted_filename):
+                stored_size = 0
+                chunks = iter_decrypted_chunks(encryption_key, in_file)
+
+                def counted(chunks):
+                    nonlocal stored_size
+                    for chunk in chunks:
+                        stored_size += len(chunk)
+                        yield chunk
+
+                plaintext_size = sum(len(chunk) for chunk in iter_decompressed(counted(chunks), codec))
+            else:
+                plaintext_size = stored_size = len(Fernet(encryption_key).decrypt(in_file.read()))
+    except Exception as e:
+        return None, None, f"{type(e).__name__}: {e}"
+    return stored_size, plaintext_size, None
+
+
+# This class will remember, for one scrub pass, the outcome of decrypting files that several
+# deduplicated records point at, so each shared file is decrypted once instead of once per record
+# A record reuses the outcome only if its own key and codec are the ones the file was checked with
+class VerifiedFiles:
+    def __init__(self, store):
+        self.store = store
+        # encrypted_filename -> {'lock', 'source': (key, codec), 'outcome', 'left': references not seen yet}
+        self.entries = {}
+        self.lock = threading.Lock()
+        # Records whose file had already been decrypted this pass
+        self.reused = 0
+
+    # Returns verify_file's outcome for a file and whether it was decrypted for this call
+    def verify(self, encrypted_filename, encryption_key, codec, limiter=None):
+        references = self.store.file_reference_count(encrypted_filename)
+        if references < 2:
+            return verify_file(encrypted_filename, encryption_key, codec, limiter), True
+
+        with self.lock:
+            entry = self.entries.get(encrypted_filename)
+            if entry is None:
+                entry = self.entries[encrypted_filename] = {
+                    'lock': threading.Lock(), 'source': None, 'outcome': None, 'left': references,
+                }
+            # Forget the file once its last record has been checked, so memory stays bounded
+            entry['left'] -= 1
+            if entry['left'] <= 0:
+                del self.entries[encrypted_filename]
+
+        # Records of the same file checked at the same time wait for the first one's outcome
+        with entry['lock']:
+            if entry['source'] == (encryption_key, codec):
+                with self.lock:
+                    self.reused += 1
+                return entry['outcome'], False
+            outcome = verify_file(encrypted_filename, encryption_key, codec, limiter)
+            entry['source'], entry['outcome'] = (encryption_key, codec), outcome
+            return outcome, True
+
+
+# Checks one record's file, returns a problem dict or None, and the number of bytes read
+# With verified (a VerifiedFiles), a file shared with records checked earlier in the pass isn't
+# decrypted again; the record's own key and sizes are still checked
+def check_record(encryptor, record_info, limiter=None, verified=None):
+    record_id = record_info['record_id']
+    encrypted_filename = record_info['encrypted_filename']
+
+    def problem(kind, detail):
+        return {'kind': kind, 'record_id': record_id, 'patient_id': record_info['patient_id'],
+                'path': encrypted_filename, 'detail': detail}
+
+    if not os.path.exists(encrypted_filename):
+        return problem(MISSING_FILE, "Encrypted file not found"), 0
+    bytes_read = os.path.getsize(encrypted_filename)
+
+    try:
+        encryption_key = encryptor.record_key(record_info)
+    except KeyUnwrapError as e:
+        return problem(KEY_UNAVAILABLE, str(e)), 0
+
+    codec = record_info.get('compression', NONE)
+    if verified is None:
+        outcome = verify_file(encrypted_filename, encryption_key, codec, limiter)
+    else:
+        outcome, decrypted = verified.verify(encrypted_filename, encryption_key, codec, limiter)
+        if not decrypted:
+            bytes_read = 0
+    stored_size, plaintext_size, error = outcome
+    if error is not None:
+        return problem(CORRUPT, error), bytes_read
+
+    if 'stored_size' in record_info and stored_size != record_info['stored_size']:
+        return problem(SIZE_MISMATCH, f"Stored size is {stored_size} bytes, "
+                                      f"key metadata says {record_info['stored_size']}"), bytes_read
+    if 'file_size' in record_info and plaintext_size != record_info['file_size']:
+        return problem(SIZE_MISMATCH, f"Decrypted size is {plaintext_size} bytes, "
+                                      f"key metadata says {record_info['file_size']}"), bytes_read
+    return None, bytes_read
+
+
+# Checks the records behind problems carried over from an interrupted scrub again, since they
+# may have been repaired (or the records deleted) in the meantime
+# Returns (problems that are still there, bytes read)
+def recheck_problems(encryptor, problems, pool, limiter=None, verified=None):
+    records = [encryptor.key_storage.get(problem['record_id']) for problem in problems]
+    records = [record_info for record_info in records if record_info is not None]
+    results = pool.map(lambda info: check_record(encryptor, info, limiter, verified), records)
+    still_there = []
+    bytes_read = 0
+    for record_info, (problem, record_bytes) in zip(records, results):
+        bytes_read += record_bytes
+        if problem is not None:
+            still_there.append(problem)
+    resolved = len(problems) - len(still_there)
+    if resolved:
+        log_event(logger, 'scrub.problems_resolved', f"{resolved} problems from the checkpoint are gone",
+                  problems=resolved)
+    return still_there, bytes_read
+
+
+# Finds .enc files no record points at, and temporary files left by interrupted writes
+# Looks under the blob store root and, for files written before the blob store, at
+# encrypted_*.enc in the folder holding the blob root (where the keys and flat files live)
+# Files younger than min_age_seconds are skipped
+def find_orphans(encryptor, min_age_seconds=DEFAULT_ORPHAN_MIN_AGE_SECONDS):
+    referenced = {os.path.abspath(record_info['encrypted_filename'])
+                  for record_info in encryptor.key_storage.values()}
+    candidates = []
+    for folder, _, file_names in os.walk(encryptor.blobs.root):
+        candidates.extend(os.path.join(folder, file_name) for file_name in file_names)
+    legacy_folder = os.path.dirname(os.path.abspath(encryptor.blobs.root))
+    candidates.extend(os.path.join(legacy_folder, file_name) for file_name in os.listdir(legacy_folder)
+                      if file_name.startswith('encrypted_') and file_name.endswith('.enc'))
+
+    problems = []
+    now = time.time()
+    for path in candidates:
+        try:
+            age = now - os.path.getmtime(path)
+        except FileNotFoundError:
+            continue
+        if age < min_age_seconds:
+            continue
+        if path.endswith('.tmp'):
+            problems.append({'kind': STALE_TEMP_FILE, 'record_id': None, 'patient_id': None, 'path': path,
+                             'detail': "Left behind by an interrupted write"})
+        elif path.endswith('.enc') and os.path.abspath(path) not in referenced:
+            problems.append({'kind': ORPHAN_FILE, 'record_id': None, 'patient_id': None, 'path': path,
+                             'detail': "No record points at this file"})
+    return problems
+
+
+# Reads a scrub checkpoint, returns None if there is no scrub in progress
+def read_checkpoint(checkpoint_path):
+    try:
+        with open(checkpoint_path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+# Checks every record's file and looks for orphans
+# rate_limit_mb caps the combined read rate in MB/s (None for no limit)
+# progress, if given, is called as progress(done, total) after each batch
+# A resumed scrub checks the problems in its checkpoint again before carrying on, so the
+# report never lists a problem that was only true before the interruption
+# Returns a report dict; the checkpoint is removed once the scrub completes
+def scrub(encryptor, workers=DEFAULT_WORKERS, rate_limit_mb=None, checkpoint_path=DEFAULT_CHECKPOINT_PATH,
+          batch_size=DEFAULT_BATCH_SIZE, orphan_min_age_seconds=DEFAULT_ORPHAN_MIN_AGE_SECONDS, progress=None):
+    start = time.perf_counter()
+    limiter = RateLimiter(rate_limit_mb * 1024 * 1024) if rate_limit_mb else None
+
+    # Carry on after the last record of an interrupted scrub, or start from the first one
+    checkpoint = read_checkpoint(checkpoint_path)
+    resumed = checkpoint is not None
+    if not resumed:
+        checkpoint = {
+            'started_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'last_record_id': 0,
+            'records': 0,
+            'bytes': 0,
+            'problems': [],
+            'reused': 0,
+        }
+    pending = sorted(record_id for record_id in encryptor.key_storage
+                     if record_id > checkpoint['last_record_id'])
+    verified = VerifiedFiles(encryptor.store)
+    reused_before = checkpoint.get('reused', 0)
+    rechecked = 0
+
+    done = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        if resumed and checkpoint['problems']:
+            rechecked = len(checkpoint['problems'])
+            checkpoint['problems'], recheck_bytes = recheck_problems(encryptor, checkpoint['problems'],
+                                                                     pool, limiter, verified)
+            checkpoint['bytes'] += recheck_bytes
+            write_private_file(checkpoint_path, checkpoint)
+
+        for batch_start in range(0, len(pending), batch_size):
+            batch_ids = pending[batch_start:batch_start + batch_size]
+            # Records deleted since the list was made are skipped
+            batch = [encryptor.key_storage.get(record_id) for record_id in batch_ids]
+            batch = [record_info for record_info in batch if record_info is not None]
+
+            batch_bytes = 0
+            for problem, bytes_read in pool.map(lambda info: check_record(encryptor, info, limiter, verified),
+                                                batch):
+                batch_bytes += bytes_read
+                if problem is not None:
+                    checkpoint['problems'].append(problem)
+                    log_event(logger, 'scrub.problem', f"Record {problem['record_id']}: {problem['detail']}",
+                              logging.WARNING, kind=problem['kind'], record_id=problem['record_id'],
+                              patient_id=problem['patient_id'])
+            checkpoint['records'] += len(batch)
+            checkpoint['bytes'] += batch_bytes
+            checkpoint['last_record_id'] = batch_ids[-1]
+            checkpoint['reused'] = reused_before + verified.reused
+            write_private_file(checkpoint_path, checkpoint)
+
+            encryptor.metrics.increment('scrub_records', len(batch))
+            encryptor.metrics.increment('scrub_bytes', batch_bytes)
+            done += len(batch_ids)
+            if progress is not None:
+                progress(done, len(pending))
+
+    problems = checkpoint['problems'] + find_orphans(encryptor, orphan_min_age_seconds)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    encryptor.metrics.increment('scrub_problems', len(problems))
+
+    elapsed = time.perf_counter() - start
+    counts = {}
+    for problem in problems:
+        counts[problem['kind']] = counts.get(problem['kind'], 0) + 1
+    log_event(logger, 'scrub.finished', f"Scrubbed {checkpoint['records']} records, {len(problems)} problems",
+              records=checkpoint['records'], problems=len(problems), resumed=resumed,
+              duration_ms=round(elapsed * 1000, 3))
+    return {
+        'started_at': checkpoint['started_at'],
+        'resumed': resumed,
+        'records': checkpoint['records'],
+        'bytes': checkpoint['bytes'],
+        # Records whose shared (deduplicated) file had already been decrypted in this pass
+        'reused': checkpoint.get('reused', 0),
+        # Problems carried over from the checkpoint that were checked again
+        'rechecked': rechecked,
+        'problem_counts': counts,
+        'problems': problems,
+        'seconds': round(elapsed, 6),
+        'mb_per_second': round(checkpoint['bytes'] / (1024 * 1024) / elapsed, 2) if elapsed > 0 else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    from encryption import MedicalFileEncryptor
+    from storage import DEFAULT_DB_PATH, open_stores
+
+    parser = argparse.ArgumentParser(description="Check every encrypted record file against its key metadata")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="number of checking threads")
+    parser.add_argument('--rate-mb', type=float, help="limit reads to this many MB per second")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="records checked between checkpoints")
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT_PATH, help="where progress is kept")
+    parser.add_argument('--restart', action='store_true', help="ignore any checkpoint and start again")
+    parser.add_argument('--orphan-min-age', type=int, default=DEFAULT_ORPHAN_MIN_AGE_SECONDS,
+                        help="seconds a file must be old before it counts as an orphan")
+    parser.add_argument('--json', help="also write the report to this JSON file")
+    parser.add_argument('--blob-root', help="folder encrypted files are written under (default blobs/)")
+    parser.add_argument('--storage', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help="SQLite database path")
+    args = parser.parse_args()
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+    patient_store, key_store = open_stores(args.storage, args.db)
+    encryptor = MedicalFileEncryptor(store=key_store, blob_root=args.blob_root)
+
+    def show_progress(done, total):
+        print(f"\rChecked {done}/{total} records", end='', flush=True)
+
+    report = scrub(encryptor, args.workers, args.rate_mb, args.checkpoint, args.batch_size,
+                   args.orphan_min_age, show_progress)
+    print(f"\n{'Resumed scrub' if report['resumed'] else 'Scrub'}: {report['records']} records, "
+          f"{report['bytes']} bytes in {report['seconds']:.2f}s ({report['mb_per_second']} MB/s)")
+    for problem in report['problems']:
+        target = f"record {problem['record_id']}" if problem['record_id'] is not None else problem['path']
+        print(f"{problem['kind'].upper():<16} {target}: {problem['detail']}")
+    if not report['problems']:
+        print("No problems found")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    exit(1 if report['problems'] else 0)
@@ -0,0 +1,150 @@
+# Patient Session Manager
+# This module hands out session tokens after a successful login
+# Later requests show the token instead of sending SSN + PIN + password again,
+# so credentials are only hashed once per login and one process can serve many patients
+#
+# Sessions end when:
+#   they have been idle for too long (idle timeout)
+#   they are older than the absolute timeout, no matter how active they are
+#   the patient logs out (revoke)
+#   the patient's PIN is reset (revoke_patient)
+#
+# Expired sessions are also swept out of memory at most once every purge interval, when a
+# session is created or checked, so a long-running service doesn't keep every token it ever
+# handed out; on_expired is called with a patient id when that patient's last session expires
+
+import secrets
+import threading
+import time
+
+DEFAULT_IDLE_TIMEOUT = 15 * 60
+DEFAULT_ABSOLUTE_TIMEOUT = 8 * 60 * 60
+DEFAULT_PURGE_INTERVAL = 60
+
+
+# This class will handle creating, checking and revoking sessions
+class SessionManager:
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, absolute_timeout=DEFAULT_ABSOLUTE_TIMEOUT,
+                 clock=time.monotonic, purge_interval=DEFAULT_PURGE_INTERVAL, on_expired=None):
+        self.idle_timeout = idle_timeout
+        self.absolute_timeout = absolute_timeout
+        self.clock = clock
+        self.purge_interval = purge_interval
+        self.on_expired = on_expired
+        self.next_purge = clock() + purge_interval
+        # token -> {'patient_id', 'created_at', 'last_seen'}
+        self.sessions = {}
+        # patient_id -> set of tokens, so all of a patient's sessions can be revoked at once
+        self.patient_sessions = {}
+        self.lock = threading.Lock()
+
+    # Starts a new session for a patient and returns its token
+    # The token is random and carries no information about the patient
+    def create_session(self, patient_id):
+        token = secrets.token_urlsafe(32)
+        now = self.clock()
+        with self.lock:
+            ended = self._purge_if_due(now)
+            self.sessions[token] = {'patient_id': patient_id, 'created_at': now, 'last_seen': now}
+            self.patient_sessions.setdefault(patient_id, set()).add(token)
+        self.notify_expired(ended)
+        return token
+
+    # Returns the patient id for a valid token, or None if it is unknown or has expired
+    # A successful check counts as activity and resets the idle timer
+    def validate(self, token):
+        if token is None:
+            return None
+        now = self.clock()
+        patient_id = None
+        with self.lock:
+            ended = self._purge_if_due(now)
+            session = self.sessions.get(token)
+            if session is not None:
+                if self.is_expired(session, now):
+                    ended += self._remove_expired([token])
+                else:
+                    session['last_seen'] = now
+                    patient_id = session['patient_id']
+        self.notify_expired(ended)
+        return patient_id
+
+    # Checks a session against the idle and absolute timeouts
+    def is_expired(self, session, now):
+        return (now - session['last_seen'] >= self.idle_timeout or
+                now - session['created_at'] >= self.absolute_timeout)
+
+    # Ends one session, returns the patient id it belonged to (or None)
+    def revoke(self, token):
+        with self.lock:
+            session = self._remove(token)
+        return session['patient_id'] if session else None
+
+    # Ends every session of a patient, returns how many were ended
+    def revoke_patient(self, patient_id):
+        with self.lock:
+            tokens = list(self.patient_sessions.get(patient_id, ()))
+            for token in tokens:
+                self._remove(token)
+        return len(tokens)
+
+    # Checks whether a patient still has any session open
+    def has_sessions(self, patient_id):
+        with self.lock:
+            return bool(self.patient_sessions.get(patient_id))
+
+    # Removes every expired session, returns how many were removed
+    def purge_expired(self):
+        now = self.clock()
+        with self.lock:
+            expired = self._expired_tokens(now)
+            ended = self._remove_expired(expired)
+            self.next_purge = now + self.purge_interval
+        self.notify_expired(ended)
+        return len(expired)
+
+    # Tells on_expired about patients whose last session expired (called without the lock held)
+    def notify_expired(self, patient_ids):
+        if self.on_expired is None:
+            return
+        for patient_id in patient_ids:
+            self.on_expired(patient_id)
+
+    # Number of sessions currently open
+    def active_count(self):
+        with self.lock:
+            return len(self.sessions)
+
+    # Removes every expired session once the purge interval has passed; the lock must already be held
+    # Returns the ids of patients left without a session
+    def _purge_if_due(self, now):
+        if now < self.next_purge:
+            return []
+        self.next_purge = now + self.purge_interval
+        return self._remove_expired(self._expired_tokens(now))
+
+    # Tokens of every expired session; the lock must already be held
+    def _expired_tokens(self, now):
+        return [token for token, session in self.sessions.items() if self.is_expired(session, now)]
+
+    # Removes expired sessions; the lock must already be held
+    # Returns the ids of patients left without a session
+    def _remove_expired(self, tokens):
+        ended = []
+        for token in tokens:
+            session = self._remove(token)
+            if session is not None and session['patient_id'] not in self.patient_sessions:
+                ended.append(session['patient_id'])
+        return ended
+
+    # Removes a session from both maps; the lock must already be held
+    def _remove(self, token):
+        session = self.sessions.pop(token, None)
+        if session is None:
+            return None
+        tokens = self.patient_sessions.get(session['patient_id'])
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.patient_sessions[session['patient_id']]
+        return session
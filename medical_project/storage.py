@@ -0,0 +1,771 @@
+# Storage Backends
+# This module holds the places patients and encryption key metadata are stored
+# Both PatientAuthenticator and MedicalFileEncryptor talk to a store instead of a JSON file,
+# so the JSON files can be swapped for a SQLite database
+#
+# Every store behaves like a read-only dict (id -> record) and adds:
+#   load()   prepare the store (JSON stores read their files here)
+#   put()    add or update a record
+#   save()   make sure everything is written out
+#   close()  release files / connections
+#
+# JSON stores keep everything in memory with dict indexes (the original behaviour); each
+# record is held as a compact, dict-like object (see compact_records.py)
+# Several processes may share them: writes and id allocation happen under a file lock
+# (see file_lock.py) and each process picks up the others' changes before writing, and
+# whenever a lookup misses or a listing is asked for
+# SQLite stores keep nothing in memory and query indexed tables, so startup time
+# doesn't depend on how many patients or records there are
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+from compact_records import compact_key_record, compact_patient, json_default
+from file_lock import FileLock, IdAllocator
+from key_journal import KeyJournal
+
+DEFAULT_DB_PATH = 'medical_records.db'
+
+# Record ids each process reserves at a time from the JSON key store's counter file
+RECORD_ID_BLOCK_SIZE = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id INTEGER PRIMARY KEY,
+    ssn_hash TEXT NOT NULL,
+    email TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS patients_ssn_hash ON patients (ssn_hash);
+CREATE INDEX IF NOT EXISTS patients_email ON patients (email);
+
+CREATE TABLE IF NOT EXISTS encryption_keys (
+    record_id INTEGER PRIMARY KEY,
+    patient_id INTEGER NOT NULL,
+    record_type TEXT NOT NULL,
+    encrypted_filename TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS encryption_keys_patient ON encryption_keys (patient_id, record_type);
+CREATE INDEX IF NOT EXISTS encryption_keys_file ON encryption_keys (encrypted_filename);
+CREATE INDEX IF NOT EXISTS encryption_keys_fingerprint ON encryption_keys (json_extract(data, '$.fingerprint'))
+    WHERE json_extract(data, '$.fingerprint') IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+# Raised when a patient is stored with an SSN hash that another patient already has
+class DuplicatePatientError(Exception):
+    pass
+
+
+# ---------------------------------------------------------------------------
+# JSON stores
+# ---------------------------------------------------------------------------
+
+# Stores encryption key metadata in encryption_keys.json plus its append-only journal
+class JsonKeyStore(Mapping):
+    def __init__(self, keys_path='encryption_keys.json'):
+        self.records = {}
+        # Index of records per patient: patient_id -> {record_id: record_type}
+        # Lets us find a patient's records without walking the whole key store
+        self.patient_index = {}
+        # Number of records pointing at each encrypted file (several when deduplicated)
+        self.file_references = {}
+        # Content fingerprint -> {record_id: None}, in the order the records were added
+        self.fingerprint_index = {}
+        self.record_id_counter = 1
+        self.journal = KeyJournal(keys_path, record_factory=compact_key_record)
+        # Held while writing, so processes sharing the files never interleave or overwrite
+        self.file_lock = FileLock(keys_path + '.lock')
+        self.record_ids = IdAllocator(keys_path + '.ids', self.file_lock, RECORD_ID_BLOCK_SIZE)
+
+    # Reads the snapshot and replays the journal, raises FileNotFoundError if there is nothing yet
+    def load(self):
+        with self.file_lock:
+            self.records = self.journal.load()
+            self.build_index()
+
+    # Picks up changes other processes have written since this one last read or wrote
+    def refresh(self):
+        if not self.journal.has_changed():
+            return
+        with self.file_lock:
+            entries = self.journal.read_new_entries()
+            if entries is None:
+                # Another process compacted the journal, so start again from its snapshot
+                try:
+                    self.records = self.journal.load()
+                except FileNotFoundError:
+                    self.records = {}
+                self.build_index()
+                return
+            for entry in entries:
+                if entry['op'] == 'put':
+                    self.apply_put(entry['record'])
+                else:
+                    self.apply_delete(int(entry['record_id']))
+
+    # Holds the store's lock across several calls (e.g. checking a file's references, then deleting it)
+    def locked(self):
+        return self.file_lock
+
+    def __getitem__(self, record_id):
+        if record_id not in self.records:
+            self.refresh()
+        return self.records[record_id]
+
+    def __iter__(self):
+        self.refresh()
+        return iter(self.records)
+
+    def __len__(self):
+        self.refresh()
+        return len(self.records)
+
+    def __contains__(self, record_id):
+        if record_id not in self.records:
+            self.refresh()
+        return record_id in self.records
+
+    def keys(self):
+        self.refresh()
+        return self.records.keys()
+
+    def values(self):
+        self.refresh()
+        return self.records.values()
+
+    def items(self):
+        self.refresh()
+        return self.records.items()
+
+    # Rebuilds the indexes from the loaded records
+    def build_index(self):
+        self.patient_index = {}
+        self.file_references = {}
+        self.fingerprint_index = {}
+        for record_id, record_info in self.records.items():
+            self.index_record(record_id, record_info)
+        self.record_id_counter = max(self.records, default=0) + 1
+
+    # Adds a single record to the indexes
+    def index_record(self, record_id, record_info):
+        patient_records = self.patient_index.setdefault(record_info['patient_id'], {})
+        patient_records[record_id] = record_info['record_type']
+        encrypted_filename = record_info['encrypted_filename']
+        self.file_references[encrypted_filename] = self.file_references.get(encrypted_filename, 0) + 1
+        fingerprint = record_info.get('fingerprint')
+        if fingerprint is not None:
+            self.fingerprint_index.setdefault(fingerprint, {})[record_id] = None
+
+    # Removes a single record from the indexes
+    def unindex_record(self, record_id, record_info):
+        encrypted_filename = record_info['encrypted_filename']
+        references = self.file_references.get(encrypted_filename, 0) - 1
+        if references > 0:
+            self.file_references[encrypted_filename] = references
+        else:
+            self.file_references.pop(encrypted_filename, None)
+        fingerprint = record_info.get('fingerprint')
+        if fingerprint in self.fingerprint_index:
+            self.fingerprint_index[fingerprint].pop(record_id, None)
+            if not self.fingerprint_index[fingerprint]:
+                del self.fingerprint_index[fingerprint]
+
+        patient_records = self.patient_index.get(record_info['patient_id'])
+        if patient_records is None:
+            return
+        patient_records.pop(record_id, None)
+        if not patient_records:
+            del self.patient_index[record_info['patient_id']]
+
+    # Hands out the next unused record id; unique across processes sharing the store
+    def allocate_record_id(self):
+        return self.record_ids.allocate(self.record_id_counter)
+
+    # Adds or updates one record in memory and in the indexes
+    def apply_put(self, record_info):
+        record_info = compact_key_record(record_info)
+        record_id = record_info['record_id']
+        old_record = self.records.get(record_id)
+        if old_record is not None:
+            self.unindex_record(record_id, old_record)
+        self.records[record_id] = record_info
+        self.index_record(record_id, record_info)
+        self.record_id_counter = max(self.record_id_counter, record_id + 1)
+
+    # Removes a record from memory and the indexes, returns it (or None)
+    def apply_delete(self, record_id):
+        record_info = self.records.pop(record_id, None)
+        if record_info is not None:
+            self.unindex_record(record_id, record_info)
+        return record_info
+
+    # Adds or updates one record; costs one journal append
+    def put(self, record_info):
+        self.put_many([record_info])
+
+    # Adds or updates several records with a single journal write
+    def put_many(self, records):
+        with self.file_lock:
+            self.refresh()
+            for record_info in records:
+                self.apply_put(record_info)
+            self.journal.append([{'op': 'put', 'record': record_info} for record_info in records])
+            self.compact_if_needed()
+
+    # Removes a record and returns it, or returns None if it doesn't exist
+    def delete(self, record_id):
+        with self.file_lock:
+            self.refresh()
+            record_info = self.apply_delete(record_id)
+            if record_info is None:
+                return None
+            self.journal.append_delete(record_id)
+            self.compact_if_needed()
+            return record_info
+
+    # Returns the record ids belonging to a patient, optionally of one record type
+    def record_ids_for_patient(self, patient_id, record_type=None):
+        self.refresh()
+        patient_records = self.patient_index.get(patient_id, {})
+        return [record_id for record_id, r_type in patient_records.items()
+                if record_type is None or r_type == record_type]
+
+    # Returns the records belonging to a patient, optionally of one record type
+    def records_for_patient(self, patient_id, record_type=None):
+        return [self.records[record_id] for record_id in self.record_ids_for_patient(patient_id, record_type)]
+
+    # Checks whether any record still points at an encrypted file
+    def is_file_referenced(self, encrypted_filename):
+        self.refresh()
+        return encrypted_filename in self.file_references
+
+    # Returns how many records point at an encrypted file
+    def file_reference_count(self, encrypted_filename):
+        self.refresh()
+        return self.file_references.get(encrypted_filename, 0)
+
+    # Returns the records whose contents have the given fingerprint, oldest first
+    def records_with_fingerprint(self, fingerprint):
+        self.refresh()
+        return [self.records[record_id] for record_id in self.fingerprint_index.get(fingerprint, {})]
+
+    # Returns the records still holding a plaintext key (stored before envelope encryption)
+    def records_with_plaintext_key(self):
+        self.refresh()
+        return [record_info for record_info in self.records.values() if 'wrapped_key' not in record_info]
+
+    # Compacts the journal into a new snapshot once it has grown large enough
+    def compact_if_needed(self):
+        if self.journal.needs_compaction(len(self.records)):
+            self.save()
+
+    # Writes a full snapshot and empties the journal
+    # Other processes' latest changes are read first, so the snapshot never drops them
+    def save(self):
+        with self.file_lock:
+            self.refresh()
+            self.journal.compact(self.records)
+
+    def close(self):
+        self.journal.close()
+
+
+# Stores patients in patients_data.json
+# The file carries a version number that goes up with every save; a process whose copy is
+# out of date merges the changes on disk with its own unsaved ones before writing
+class JsonPatientStore(Mapping):
+    def __init__(self, patients_path='patients_data.json'):
+        self.path = patients_path
+        self.patients = {}
+        self.patient_id_counter = 1
+        # Secondary indexes so lookups don't scan every patient
+        # ssn_index maps ssn_hash -> patient_id, email_index maps email -> patient_id
+        self.ssn_index = {}
+        self.email_index = {}
+        # Version of the file this process last read or wrote, and the file's identity then
+        self.version = 0
+        self.file_id = None
+        # Patients put since the last save: patient_id -> patient
+        self.unsaved = {}
+        self.file_lock = FileLock(patients_path + '.lock')
+        self.patient_ids = IdAllocator(patients_path + '.ids', self.file_lock)
+
+    # Reads the patients file, raises FileNotFoundError if there is nothing yet
+    def load(self):
+        with self.file_lock:
+            self.read_file()
+
+    # Reads the patients file into memory
+    def read_file(self):
+        file_id = self.file_identity()
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        # Convert string keys back to integers
+        self.patients = {int(k): compact_patient(v) for k, v in data['patients'].items()}
+        self.patient_id_counter = data['patient_id_counter']
+        self.version = data.get('version', 0)
+        self.file_id = file_id
+        self.build_indexes()
+
+    # Identity of the patients file on disk; it changes whenever any process saves
+    def file_identity(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    # Picks up patients other processes have saved, keeping this process's unsaved changes on top
+    def refresh(self):
+        if self.file_identity() == self.file_id:
+            return
+        with self.file_lock:
+            try:
+                self.read_file()
+            except FileNotFoundError:
+                return
+            for patient in self.unsaved.values():
+                self.apply_put(patient)
+
+    def __getitem__(self, patient_id):
+        if patient_id not in self.patients:
+            self.refresh()
+        return self.patients[patient_id]
+
+    def __iter__(self):
+        self.refresh()
+        return iter(self.patients)
+
+    def __len__(self):
+        self.refresh()
+        return len(self.patients)
+
+    def __contains__(self, patient_id):
+        if patient_id not in self.patients:
+            self.refresh()
+        return patient_id in self.patients
+
+    def keys(self):
+        self.refresh()
+        return self.patients.keys()
+
+    def values(self):
+        self.refresh()
+        return self.patients.values()
+
+    def items(self):
+        self.refresh()
+        return self.patients.items()
+
+    # Rebuilds the lookup indexes from the loaded patients
+    def build_indexes(self):
+        self.ssn_index = {}
+        self.email_index = {}
+        for patient_id, patient in self.patients.items():
+            self.index_patient(patient_id, patient)
+
+    # Adds a single patient to the lookup indexes
+    def index_patient(self, patient_id, patient):
+        self.ssn_index[patient['ssn_hash']] = patient_id
+        self.email_index[patient['email']] = patient_id
+
+    # Hands out the next unused patient id; unique across processes sharing the file
+    def allocate_patient_id(self):
+        return self.patient_ids.allocate(self.patient_id_counter)
+
+    # Adds or updates a patient in memory and in the indexes, returns the patient as stored
+    def apply_put(self, patient):
+        patient = compact_patient(patient)
+        patient_id = patient['patient_id']
+        old_patient = self.patients.get(patient_id)
+        if old_patient is not None:
+            self.ssn_index.pop(old_patient['ssn_hash'], None)
+            self.email_index.pop(old_patient['email'], None)
+        self.patients[patient_id] = patient
+        self.index_patient(patient_id, patient)
+        self.patient_id_counter = max(self.patient_id_counter, patient_id + 1)
+        return patient
+
+    # Adds or updates a patient (written to disk by save())
+    def put(self, patient):
+        patient = self.apply_put(patient)
+        self.unsaved[patient['patient_id']] = patient
+
+    # Finds a patient by their hashed SSN, returns None if not found
+    # Reads the file again first if another process has saved since, so a patient registered
+    # or given a new PIN there is seen here too
+    def find_by_ssn_hash(self, ssn_hash):
+        self.refresh()
+        patient_id = self.ssn_index.get(ssn_hash)
+        if patient_id is None:
+            return None
+        return self.patients.get(patient_id)
+
+    # Finds a patient by their email, returns None if not found
+    def find_by_email(self, email):
+        self.refresh()
+        patient_id = self.email_index.get(email)
+        if patient_id is None:
+            return None
+        return self.patients.get(patient_id)
+
+    # Returns the patients whose SSN hash is an old unkeyed one (keyed hashes name their scheme with '$')
+    def patients_with_unkeyed_ssn_hash(self):
+        return [patient for patient in self.values() if '$' not in patient['ssn_hash']]
+
+    # Writes every patient to the JSON file
+    # Under the lock, patients saved by other processes are merged in first (this process's
+    # unsaved changes win for the same patient), so no process's save drops another's
+    # The file is written to a temporary file and renamed, so a crash never truncates it
+    def save(self):
+        with self.file_lock:
+            self.refresh()
+            data = {
+                'patients': self.patients,
+                'patient_id_counter': self.patient_id_counter,
+                'version': self.version + 1,
+            }
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(data, f, indent=2, default=json_default)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            self.version += 1
+            self.file_id = self.file_identity()
+            self.unsaved = {}
+
+    def close(self):
+        pass
+
+
+# ---------------------------------------------------------------------------
+# SQLite stores
+# ---------------------------------------------------------------------------
+
+# Opens a connection to the database in WAL mode and creates the tables
+# Autocommit mode is used so transactions are always started explicitly
+def connect(db_path=DEFAULT_DB_PATH):
+    db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute('PRAGMA busy_timeout=5000')
+    # Overwrite deleted and replaced rows, so old key metadata doesn't linger in free pages
+    db.execute('PRAGMA secure_delete=ON')
+    db.executescript(SCHEMA)
+    return db
+
+
+# Shared connection handling for the SQLite stores
+class SQLiteStore:
+    def __init__(self, db_path=DEFAULT_DB_PATH, db=None):
+        self.db_path = db_path
+        self.db = db if db is not None else connect(db_path)
+        # One connection is shared between threads, so only one may use it at a time
+        self.lock = threading.RLock()
+        # Single statements are already safe between processes; this is for callers that need
+        # several steps to happen together (see locked)
+        # An in-memory database belongs to this connection alone, so its thread lock is enough
+        # (and there is no file to put a .lock next to)
+        if db_path in (':memory:', ''):
+            self.file_lock = self.lock
+        else:
+            self.file_lock = FileLock(db_path + '.lock')
+
+    # Holds a lock shared with other processes across several calls
+    # (e.g. checking a file's references, then deleting it)
+    def locked(self):
+        return self.file_lock
+
+    # Runs a block of statements as one transaction
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    # Runs a query and returns all rows
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    # Increments a named counter and returns the value before incrementing
+    def next_counter_value(self, name, minimum):
+        with self.transaction() as db:
+            row = db.execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()
+            value = max(row[0] if row else 1, minimum)
+            db.execute('INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)', (name, value + 1))
+        return value
+
+    # The tables are created on connect and nothing is cached, so there is nothing to load
+    def load(self):
+        pass
+
+    # Every write is committed immediately, so there is nothing to save
+    def save(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# Stores encryption key metadata in the encryption_keys table
+class SQLiteKeyStore(SQLiteStore, Mapping):
+    def __getitem__(self, record_id):
+        rows = self.query('SELECT data FROM encryption_keys WHERE record_id = ?', (record_id,))
+        if not rows:
+            raise KeyError(record_id)
+        return json.loads(rows[0][0])
+
+    def __iter__(self):
+        return iter([row[0] for row in self.query('SELECT record_id FROM encryption_keys ORDER BY record_id')])
+
+    def __len__(self):
+        return self.query('SELECT COUNT(*) FROM encryption_keys')[0][0]
+
+    def __contains__(self, record_id):
+        return bool(self.query('SELECT 1 FROM encryption_keys WHERE record_id = ?', (record_id,)))
+
+    # Reads every record in one query instead of one query per record
+    def values(self):
+        return [json.loads(row[0]) for row in self.query('SELECT data FROM encryption_keys ORDER BY record_id')]
+
+    def items(self):
+        return [(record_info['record_id'], record_info) for record_info in self.values()]
+
+    # Every write is committed immediately; saving copies the write-ahead log into the database
+    # file and empties it, so replaced key metadata (e.g. plaintext keys) doesn't survive in the log
+    def save(self):
+        with self.lock:
+            self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    # Hands out the next unused record id
+    def allocate_record_id(self):
+        minimum = (self.query('SELECT MAX(record_id) FROM encryption_keys')[0][0] or 0) + 1
+        return self.next_counter_value('record_id', minimum)
+
+    # Adds or updates one record
+    def put(self, record_info):
+        self.put_many([record_info])
+
+    # Adds or updates several records in a single transaction
+    def put_many(self, records):
+        rows = [(record_info['record_id'], record_info['patient_id'], record_info['record_type'],
+                 record_info['encrypted_filename'], json.dumps(record_info, default=json_default))
+                for record_info in records]
+        with self.transaction() as db:
+            db.executemany('INSERT OR REPLACE INTO encryption_keys '
+                           '(record_id, patient_id, record_type, encrypted_filename, data) '
+                           'VALUES (?, ?, ?, ?, ?)', rows)
+
+    # Removes a record and returns it, or returns None if it doesn't exist
+    def delete(self, record_id):
+        with self.transaction() as db:
+            row = db.execute('SELECT data FROM encryption_keys WHERE record_id = ?', (record_id,)).fetchone()
+            if row is None:
+                return None
+            db.execute('DELETE FROM encryption_keys WHERE record_id = ?', (record_id,))
+        return json.loads(row[0])
+
+    # Returns the record ids belonging to a patient, optionally of one record type
+    def record_ids_for_patient(self, patient_id, record_type=None):
+        if record_type is None:
+            rows = self.query('SELECT record_id FROM encryption_keys WHERE patient_id = ? '
+                              'ORDER BY record_id', (patient_id,))
+        else:
+            rows = self.query('SELECT record_id FROM encryption_keys WHERE patient_id = ? AND record_type = ? '
+                              'ORDER BY record_id', (patient_id, record_type))
+        return [row[0] for row in rows]
+
+    # Returns the records belonging to a patient, optionally of one record type
+    def records_for_patient(self, patient_id, record_type=None):
+        if record_type is None:
+            rows = self.query('SELECT data FROM encryption_keys WHERE patient_id = ? '
+                              'ORDER BY record_id', (patient_id,))
+        else:
+            rows = self.query('SELECT data FROM encryption_keys WHERE patient_id = ? AND record_type = ? '
+                              'ORDER BY record_id', (patient_id, record_type))
+        return [json.loads(row[0]) for row in rows]
+
+    # Checks whether any record still points at an encrypted file
+    def is_file_referenced(self, encrypted_filename):
+        return bool(self.query('SELECT 1 FROM encryption_keys WHERE encrypted_filename = ? LIMIT 1',
+                               (encrypted_filename,)))
+
+    # Returns how many records point at an encrypted file
+    def file_reference_count(self, encrypted_filename):
+        return self.query('SELECT COUNT(*) FROM encryption_keys WHERE encrypted_filename = ?',
+                          (encrypted_filename,))[0][0]
+
+    # Returns the records whose contents have the given fingerprint, oldest first
+    def records_with_fingerprint(self, fingerprint):
+        rows = self.query("SELECT data FROM encryption_keys WHERE json_extract(data, '$.fingerprint') = ? "
+                          "ORDER BY record_id", (fingerprint,))
+        return [json.loads(row[0]) for row in rows]
+
+    # Returns the records still holding a plaintext key (stored before envelope encryption)
+    def records_with_plaintext_key(self):
+        rows = self.query("SELECT data FROM encryption_keys WHERE json_extract(data, '$.wrapped_key') IS NULL "
+                          "ORDER BY record_id")
+        return [json.loads(row[0]) for row in rows]
+
+
+# Stores patients in the patients table
+class SQLitePatientStore(SQLiteStore, Mapping):
+    def __getitem__(self, patient_id):
+        rows = self.query('SELECT data FROM patients WHERE patient_id = ?', (patient_id,))
+        if not rows:
+            raise KeyError(patient_id)
+        return json.loads(rows[0][0])
+
+    def __iter__(self):
+        return iter([row[0] for row in self.query('SELECT patient_id FROM patients ORDER BY patient_id')])
+
+    def __len__(self):
+        return self.query('SELECT COUNT(*) FROM patients')[0][0]
+
+    def __contains__(self, patient_id):
+        return bool(self.query('SELECT 1 FROM patients WHERE patient_id = ?', (patient_id,)))
+
+    # Reads every patient in one query instead of one query per patient
+    def values(self):
+        return [json.loads(row[0]) for row in self.query('SELECT data FROM patients ORDER BY patient_id')]
+
+    def items(self):
+        return [(patient['patient_id'], patient) for patient in self.values()]
+
+    # Hands out the next unused patient id
+    def allocate_patient_id(self):
+        minimum = (self.query('SELECT MAX(patient_id) FROM patients')[0][0] or 0) + 1
+        return self.next_counter_value('patient_id', minimum)
+
+    # Adds or updates a patient
+    def put(self, patient):
+        self.put_many([patient])
+
+    # Adds or updates several patients in a single transaction
+    # Raises DuplicatePatientError (and stores none of them) if one would take another patient's
+    # SSN hash, e.g. the same person registered by another process in the meantime
+    def put_many(self, patients):
+        rows = [(patient['patient_id'], patient['ssn_hash'], patient['email'],
+                 json.dumps(patient, default=json_default))
+                for patient in patients]
+        try:
+            with self.transaction() as db:
+                db.executemany('INSERT INTO patients (patient_id, ssn_hash, email, data) VALUES (?, ?, ?, ?) '
+                               'ON CONFLICT (patient_id) DO UPDATE SET ssn_hash = excluded.ssn_hash, '
+                               'email = excluded.email, data = excluded.data', rows)
+        except sqlite3.IntegrityError as e:
+            if 'patients.ssn_hash' not in str(e):
+                raise
+            raise DuplicatePatientError("Another patient already has this SSN hash") from e
+
+    # Finds a patient by their hashed SSN, returns None if not found
+    def find_by_ssn_hash(self, ssn_hash):
+        rows = self.query('SELECT data FROM patients WHERE ssn_hash = ?', (ssn_hash,))
+        return json.loads(rows[0][0]) if rows else None
+
+    # Finds a patient by their email, returns None if not found
+    def find_by_email(self, email):
+        rows = self.query('SELECT data FROM patients WHERE email = ? ORDER BY patient_id DESC LIMIT 1', (email,))
+        return json.loads(rows[0][0]) if rows else None
+
+    # Returns the patients whose SSN hash is an old unkeyed one (keyed hashes name their scheme with '$')
+    def patients_with_unkeyed_ssn_hash(self):
+        rows = self.query("SELECT data FROM patients WHERE instr(ssn_hash, '$') = 0 ORDER BY patient_id")
+        return [json.loads(row[0]) for row in rows]
+
+
+# ---------------------------------------------------------------------------
+# Choosing a backend and migrating
+# ---------------------------------------------------------------------------
+
+# Creates the patient and key stores for a backend name ('json' or 'sqlite')
+def open_stores(backend='json', db_path=DEFAULT_DB_PATH,
+                patients_path='patients_data.json', keys_path='encryption_keys.json'):
+    if backend == 'json':
+        return JsonPatientStore(patients_path), JsonKeyStore(keys_path)
+    if backend == 'sqlite':
+        return SQLitePatientStore(db_path), SQLiteKeyStore(db_path)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+# One-shot copy of the JSON files (and any key journal) into a SQLite database
+# Safe to run more than once: existing rows with the same id are replaced
+# Raises DuplicatePatientError, copying nothing, if two patients have the same SSN hash
+# Returns (number of patients, number of key records) copied
+def migrate_json_to_sqlite(db_path=DEFAULT_DB_PATH, patients_path='patients_data.json',
+                           keys_path='encryption_keys.json'):
+    json_patients = JsonPatientStore(patients_path)
+    json_keys = JsonKeyStore(keys_path)
+    sqlite_patients = SQLitePatientStore(db_path)
+    sqlite_keys = SQLiteKeyStore(db_path, db=sqlite_patients.db)
+
+    try:
+        try:
+            json_patients.load()
+        except FileNotFoundError:
+            pass
+        try:
+            json_keys.load()
+        except FileNotFoundError:
+            pass
+
+        sqlite_patients.put_many(list(json_patients.values()))
+        sqlite_keys.put_many(list(json_keys.values()))
+
+        # Carry the id counters over so ids are never handed out twice: past every stored id,
+        # every id block a running process has reserved (.ids files) and the database's own counter
+        counters = [
+            ('patient_id', max(json_patients.patient_id_counter, json_patients.patient_ids.next_unreserved())),
+            ('record_id', max(json_keys.record_id_counter, json_keys.record_ids.next_unreserved())),
+        ]
+        with sqlite_patients.transaction() as db:
+            db.executemany('INSERT INTO counters (name, value) VALUES (?, ?) '
+                           'ON CONFLICT (name) DO UPDATE SET value = MAX(value, excluded.value)', counters)
+    finally:
+        json_keys.close()
+        sqlite_patients.close()
+
+    return len(json_patients), len(json_keys)
+
+
+if __name__ == "__main__":
+    # Usage: python storage.py migrate [db_path] [patients_path] [keys_path]
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        print("Usage: python storage.py migrate [db_path] [patients_path] [keys_path]")
+        sys.exit(1)
+
+    args = sys.argv[2:]
+    db_path = args[0] if len(args) > 0 else DEFAULT_DB_PATH
+    patients_path = args[1] if len(args) > 1 else 'patients_data.json'
+    keys_path = args[2] if len(args) > 2 else 'encryption_keys.json'
+
+    if not os.path.exists(patients_path) and not os.path.exists(keys_path):
+        print("No JSON data found to migrate")
+        sys.exit(1)
+
+    try:
+        patient_count, key_count = migrate_json_to_sqlite(db_path, patients_path, keys_path)
+    except DuplicatePatientError as e:
+        print(f"Migration stopped: {e}; remove the duplicate patient from {patients_path} first")
+        sys.exit(1)
+    print(f"Migrated {patient_count} patients and {key_count} encryption keys into {db_path}")
@@ -0,0 +1,210 @@
+# Streaming Encryption Container
+# This module encrypts and decrypts large files (e.g. DICOM studies) in fixed-size chunks
+# so memory use stays constant no matter how big the file is
+# Each chunk is encrypted with AES-256-GCM, so every chunk is authenticated on its own
+#
+# File layout:
+#   header:  MAGIC (8 bytes) | chunk size (4 bytes) | nonce prefix (7 bytes)
+#   chunks:  length (4 bytes, top bit marks the final chunk) | ciphertext + 16 byte tag
+#
+# The nonce of each chunk is: nonce prefix | chunk index (4 bytes) | final flag (1 byte)
+# The header is passed as associated data, so chunks can't be reordered, dropped,
+# truncated or moved between files without decryption failing
+
+import base64
+import os
+import struct
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+MAGIC = b'MEDSTRM1'
+DEFAULT_CHUNK_SIZE = 64 * 1024
+NONCE_PREFIX_SIZE = 7
+TAG_SIZE = 16
+HEADER_SIZE = len(MAGIC) + 4 + NONCE_PREFIX_SIZE
+FINAL_FLAG = 0x80000000
+MAX_CHUNK_SIZE = FINAL_FLAG - 1 - TAG_SIZE
+
+
+# Raised when a container is malformed, truncated or fails authentication
+class StreamDecryptionError(Exception):
+    pass
+
+
+# Turns a Fernet-style key (url-safe base64 of 32 random bytes) into an AES-256-GCM cipher
+def cipher_from_key(key):
+    if isinstance(key, str):
+        key = key.encode()
+    raw_key = base64.urlsafe_b64decode(key)
+    if len(raw_key) != 32:
+        raise ValueError("Encryption key must be 32 bytes")
+    return AESGCM(raw_key)
+
+
+# Builds the nonce for one chunk
+def chunk_nonce(nonce_prefix, index, final):
+    return nonce_prefix + struct.pack('>I', index) + (b'\x01' if final else b'\x00')
+
+
+# Checks whether the first bytes of a file look like a streaming container
+def is_stream_container(first_bytes):
+    return first_bytes[:len(MAGIC)] == MAGIC
+
+
+# Checks whether the file at a path is a streaming container
+def is_stream_file(path):
+    with open(path, 'rb') as f:
+        return is_stream_container(f.read(len(MAGIC)))
+
+
+# Incrementally encrypts data written to it and writes the container to out_file
+# Call write() as many times as needed, then finish() exactly once
+class StreamEncryptor:
+    def __init__(self, key, out_file, chunk_size=DEFAULT_CHUNK_SIZE):
+        if chunk_size <= 0 or chunk_size > MAX_CHUNK_SIZE:
+            raise ValueError(f"Invalid chunk size: {chunk_size}")
+        self.cipher = key if isinstance(key, AESGCM) else cipher_from_key(key)
+        self.out_file = out_file
+        self.chunk_size = chunk_size
+        self.nonce_prefix = os.urandom(NONCE_PREFIX_SIZE)
+        self.header = MAGIC + struct.pack('>I', chunk_size) + self.nonce_prefix
+        self.buffer = bytearray()
+        self.index = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.finished = False
+
+        self.out_file.write(self.header)
+        self.bytes_out += len(self.header)
+
+    # Encrypts and writes one chunk
+    def _write_chunk(self, data, final):
+        nonce = chunk_nonce(self.nonce_prefix, self.index, final)
+        encrypted = self.cipher.encrypt(nonce, bytes(data), self.header)
+        length = len(encrypted) | (FINAL_FLAG if final else 0)
+        self.out_file.write(struct.pack('>I', length))
+        self.out_file.write(encrypted)
+        self.bytes_out += 4 + len(encrypted)
+        self.index += 1
+
+    # Adds plaintext; full chunks are written out as soon as we know they aren't the last one
+    def write(self, data):
+        if self.finished:
+            raise ValueError("Stream already finished")
+        self.buffer += data
+        self.bytes_in += len(data)
+        # Keep at least one byte buffered so the final chunk is always written by finish()
+        while len(self.buffer) > self.chunk_size:
+            self._write_chunk(self.buffer[:self.chunk_size], final=False)
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    # Writes the last chunk (possibly empty) marked as final
+    def finish(self):
+        if self.finished:
+            return
+        self._write_chunk(self.buffer, final=True)
+        self.buffer = bytearray()
+        self.finished = True
+
+
+# Reads a container's header from in_file
+# Returns (header, chunk size, nonce prefix)
+def read_header(in_file):
+    header = in_file.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or not is_stream_container(header):
+        raise StreamDecryptionError("Not a streaming container")
+    chunk_size = struct.unpack('>I', header[len(MAGIC):len(MAGIC) + 4])[0]
+    return header, chunk_size, header[len(MAGIC) + 4:]
+
+
+# Reads a container from in_file and yields the decrypted chunks one at a time
+# With first_chunk the chunks before it are skipped without being read (in_file must be seekable);
+# every chunk but the last holds exactly chunk_size bytes, so where each one starts is known
+def iter_decrypted_chunks(key, in_file, first_chunk=0):
+    cipher = key if isinstance(key, AESGCM) else cipher_from_key(key)
+
+    header, chunk_size, nonce_prefix = read_header(in_file)
+    if first_chunk:
+        in_file.seek(HEADER_SIZE + first_chunk * (4 + chunk_size + TAG_SIZE))
+
+    index = first_chunk
+    while True:
+        length_bytes = in_file.read(4)
+        if len(length_bytes) != 4:
+            raise StreamDecryptionError("Container is truncated")
+        length = struct.unpack('>I', length_bytes)[0]
+        final = bool(length & FINAL_FLAG)
+        length &= ~FINAL_FLAG
+        if length < TAG_SIZE or length > chunk_size + TAG_SIZE:
+            raise StreamDecryptionError("Invalid chunk length")
+
+        encrypted = in_file.read(length)
+        if len(encrypted) != length:
+            raise StreamDecryptionError("Container is truncated")
+
+        try:
+            chunk = cipher.decrypt(chunk_nonce(nonce_prefix, index, final), encrypted, header)
+        except InvalidTag:
+            raise StreamDecryptionError(f"Chunk {index} failed authentication")
+
+        yield chunk
+        index += 1
+
+        if final:
+            if in_file.read(1):
+                raise StreamDecryptionError("Unexpected data after final chunk")
+            return
+
+
+# Yields the bytes in the range [start, end) of a stream of chunks whose first chunk starts at
+# position (end=None for everything after start); no more chunks are read once end is reached
+def slice_chunks(chunks, start, end=None, position=0):
+    for chunk in chunks:
+        chunk_start = position
+        position += len(chunk)
+        if position <= start:
+            continue
+        low = max(start - chunk_start, 0)
+        high = len(chunk) if end is None else min(end - chunk_start, len(chunk))
+        if high > low:
+            yield chunk if low == 0 and high == len(chunk) else chunk[low:high]
+        if end is not None and position >= end:
+            return
+
+
+# Decrypts only the plaintext bytes in the range [start, end) of a container (end=None for the rest)
+# Only the chunks overlapping the range are read and decrypted, so in_file must be seekable
+# A start at or past the end of the contents still reads (and authenticates) the final chunk
+def iter_decrypted_range(key, in_file, start, end=None):
+    chunk_size = read_header(in_file)[1]
+    # When the contents fill whole chunks, start // chunk_size can point just past the final chunk
+    last_chunk = max(in_file.seek(0, os.SEEK_END) - HEADER_SIZE - 1, 0) // (4 + chunk_size + TAG_SIZE)
+    first_chunk = min(start // chunk_size, last_chunk)
+    in_file.seek(0)
+    chunks = iter_decrypted_chunks(key, in_file, first_chunk)
+    return slice_chunks(chunks, start, end, first_chunk * chunk_size)
+
+
+# Encrypts everything from in_file into out_file, reading chunk_size bytes at a time
+# Returns the number of plaintext bytes encrypted
+def encrypt_stream(key, in_file, out_file, chunk_size=DEFAULT_CHUNK_SIZE):
+    encryptor = StreamEncryptor(key, out_file, chunk_size)
+    while True:
+        data = in_file.read(chunk_size)
+        if not data:
+            break
+        encryptor.write(data)
+    encryptor.finish()
+    return encryptor.bytes_in
+
+
+# Decrypts a container from in_file into out_file one chunk at a time
+# Returns the number of plaintext bytes written
+def decrypt_stream(key, in_file, out_file):
+    total = 0
+    for chunk in iter_decrypted_chunks(key, in_file):
+        out_file.write(chunk)
+        total += len(chunk)
+    return total
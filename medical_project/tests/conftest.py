@@ -0,0 +1,39 @@
+# Shared test setup
+# The modules import each other by their flat names (as when run from medical_project/),
+# so that folder goes on the import path
+# Tests that need a whole system use the system fixture (or open_system) and add_patient
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from credential_hashing import PBKDF2, CredentialHasher
+from main_system import MedicalRecordSystem
+from metrics import MetricsRegistry
+
+
+# Opens a whole system on the files in the working directory, with a cheap credential hasher
+def open_system(tmp_path, dedup=None):
+    system = MedicalRecordSystem(metrics=MetricsRegistry(), dedup=dedup, blob_root=str(tmp_path / 'blobs'))
+    system.authenticator.hasher = CredentialHasher(PBKDF2, (1000,), workers=2)
+    return system
+
+
+# A whole system with its files in a fresh working directory
+@pytest.fixture
+def system(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    system = open_system(tmp_path)
+    yield system
+    system.authenticator.hasher.shutdown()
+
+
+# Registers a patient, returns (patient_id, pin)
+def add_patient(system, number=1, password='password'):
+    success, patient_id, pin, message = system.register_patient(
+        f"100-00-{number:04d}", f"Patient {number}", f"patient{number}@example.com", password)
+    assert success, message
+    return patient_id, pin
@@ -0,0 +1,142 @@
+# Tests for authentication.py and credential_hashing.py: keyed SSN lookup, upgrading stored
+# hashes, and hashing a login's secrets side by side
+
+import hashlib
+import json
+import threading
+
+import pytest
+
+from authentication import PatientAuthenticator
+from credential_hashing import PBKDF2, CredentialHasher, is_legacy_hash, ssn_lookup_hash
+from metrics import MetricsRegistry
+from storage import JsonPatientStore, SQLitePatientStore
+
+LOOKUP_KEY = b'test lookup key'
+SSN = '123-45-6789'
+
+
+# A cheap hasher so the tests don't spend their time in scrypt
+def fast_hasher(workers=2):
+    return CredentialHasher(PBKDF2, (1000,), workers=workers)
+
+
+def make_authenticator(store, lookup_key=LOOKUP_KEY):
+    return PatientAuthenticator(store=store, hasher=fast_hasher(), metrics=MetricsRegistry(),
+                                lookup_key=lookup_key)
+
+
+# A patient stored before the SSN hash was keyed (plain SHA-256 of the SSN and of the PIN/password)
+def legacy_patient(patient_id, ssn, pin, password):
+    return {
+        'patient_id': patient_id,
+        'name': f"Patient {patient_id}",
+        'ssn_hash': hashlib.sha256(ssn.encode()).hexdigest(),
+        'pin_hash': hashlib.sha256(pin.encode()).hexdigest(),
+        'password_hash': hashlib.sha256(password.encode()).hexdigest(),
+        'email': f"patient{patient_id}@example.com",
+        'registered_at': '2025-01-01 09:00:00',
+    }
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def store_factory(request, tmp_path):
+    if request.param == 'json':
+        return lambda: JsonPatientStore(str(tmp_path / 'patients.json'))
+    return lambda: SQLitePatientStore(str(tmp_path / 'records.db'))
+
+
+def test_ssn_lookup_hash_depends_on_the_key():
+    keyed = ssn_lookup_hash(SSN, LOOKUP_KEY)
+    assert keyed.startswith('hmac_sha256$')
+    assert keyed != ssn_lookup_hash(SSN, b'another key')
+    assert hashlib.sha256(SSN.encode()).hexdigest() not in keyed
+
+
+def test_register_and_login(store_factory):
+    authenticator = make_authenticator(store_factory())
+    success, patient_id, pin, message = authenticator.register_patient(SSN, 'Ann', 'ann@example.com', 'pw')
+    assert success
+    assert authenticator.patients[patient_id]['ssn_hash'] == ssn_lookup_hash(SSN, LOOKUP_KEY)
+    authenticator.save_patients()
+
+    reloaded = make_authenticator(store_factory())
+    assert reloaded.authenticate_patient(SSN, pin, 'pw')[0]
+    assert not reloaded.authenticate_patient(SSN, pin, 'wrong')[0]
+    # Without the right key the patient can't be found at all
+    assert not make_authenticator(store_factory(), b'wrong key').authenticate_patient(SSN, pin, 'pw')[0]
+
+
+# Another process registers the same SSN between this registration's lookup and its insert
+def test_registration_racing_another_process_keeps_the_first_patient(tmp_path, monkeypatch):
+    db_path = str(tmp_path / 'records.db')
+    first = make_authenticator(SQLitePatientStore(db_path))
+    second = make_authenticator(SQLitePatientStore(db_path))
+    assert first.register_patient(SSN, 'Ann', 'ann@example.com', 'pw')[0]
+    first_id = first.find_patient_by_ssn_hash(ssn_lookup_hash(SSN, LOOKUP_KEY))['patient_id']
+
+    # The second process's lookup ran before the first one's insert
+    lookups = [None]
+    find = second.find_patient_by_ssn_hash
+    monkeypatch.setattr(second, 'find_patient_by_ssn_hash',
+                        lambda ssn_hash: lookups.pop() if lookups else find(ssn_hash))
+    result = second.register_patient(SSN, 'Ann again', 'ann2@example.com', 'pw')
+    assert result == (False, first_id, None, "Patient already exists")
+    assert [patient['name'] for patient in SQLitePatientStore(db_path).values()] == ['Ann']
+
+
+def test_unkeyed_ssn_hashes_are_upgraded_on_load(store_factory):
+    store = store_factory()
+    try:
+        store.load()
+    except FileNotFoundError:
+        pass
+    store.put(legacy_patient(1, SSN, '123456', 'pw'))
+    store.put(legacy_patient(2, '987-65-4321', '654321', 'secret'))
+    store.save()
+
+    authenticator = make_authenticator(store_factory())
+    fresh = store_factory()
+    fresh.load()
+    assert fresh.patients_with_unkeyed_ssn_hash() == []
+    assert not any(is_legacy_hash(patient['ssn_hash']) for patient in fresh.values())
+
+    success, patient_id, message = authenticator.authenticate_patient(SSN, '123456', 'pw')
+    assert success and patient_id == 1
+    assert authenticator.find_patient_by_ssn_hash(hashlib.sha256(SSN.encode()).hexdigest()) is None
+
+
+def test_upgraded_patients_file_has_no_plain_ssn_hashes(tmp_path):
+    path = tmp_path / 'patients.json'
+    store = JsonPatientStore(str(path))
+    store.put(legacy_patient(1, SSN, '123456', 'pw'))
+    store.save()
+
+    make_authenticator(JsonPatientStore(str(path)))
+    with open(path) as f:
+        stored = json.load(f)['patients']['1']
+    assert stored['ssn_hash'] == ssn_lookup_hash(SSN, LOOKUP_KEY)
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_hash_many_and_verify_many(workers):
+    hasher = fast_hasher(workers)
+    pin_hash, password_hash = hasher.hash_many(['123456', 'password'])
+    assert pin_hash != password_hash
+    assert hasher.verify_many([('123456', pin_hash), ('password', password_hash)])
+    assert not hasher.verify_many([('123456', pin_hash), ('wrong', password_hash)])
+    assert not hasher.verify_many([('000000', pin_hash), ('password', password_hash)])
+    hasher.shutdown()
+
+
+def test_run_all_hashes_every_item_on_the_pool():
+    hasher = fast_hasher(2)
+    run_on = lambda i: (i, threading.current_thread().name)
+    results = hasher.run_all(run_on, [(i,) for i in range(5)])
+    assert [i for i, thread_name in results] == list(range(5))
+    assert all(thread_name.startswith('hash') for i, thread_name in results)
+
+    # A single item, or a hasher without workers, doesn't need the pool
+    assert hasher.run_all(run_on, [(0,)]) == [(0, threading.current_thread().name)]
+    hasher.shutdown()
+    assert fast_hasher(0).run_all(run_on, [(0,), (1,)]) == [(i, threading.current_thread().name) for i in range(2)]
@@ -0,0 +1,137 @@
+# Tests for blob_store.py: removing blobs, and migrating the flat encrypted_<name>.enc files of
+# older records into the sharded layout, including finishing an interrupted migration
+
+import os
+
+import pytest
+
+from blob_store import BlobStore, migrate_flat_files
+from encryption import MedicalFileEncryptor
+from key_wrapping import MasterKeyStore
+from metrics import MetricsRegistry
+
+
+def open_encryptor(tmp_path):
+    return MedicalFileEncryptor(keys_path=str(tmp_path / 'encryption_keys.json'), metrics=MetricsRegistry(),
+                                master_keys=MasterKeyStore(str(tmp_path / 'master_keys.json')),
+                                dedup='patient', blob_root=str(tmp_path / 'blobs'))
+
+
+# Stores records the way older versions did, each in a flat file named after its upload
+# Uploads with the same contents share one file (the name of the first one); returns {record_id: contents}
+def add_flat_records(encryptor, tmp_path, uploads):
+    contents_by_id = {}
+    for name, contents in uploads:
+        source = tmp_path / 'upload.bin'
+        source.write_bytes(contents)
+        record_info = encryptor.encrypt_file(str(source), patient_id=1, record_type='lab')
+        # A shared upload already points at the flat file it shares
+        if encryptor.blobs.contains(record_info['encrypted_filename']):
+            flat_path = str(tmp_path / f"encrypted_{name}.enc")
+            os.replace(record_info['encrypted_filename'], flat_path)
+            encryptor.store.put(dict(record_info, encrypted_filename=flat_path))
+        contents_by_id[record_info['record_id']] = contents
+    encryptor.save_keys()
+    encryptor.cache.clear()
+    return contents_by_id
+
+
+def assert_all_migrated(encryptor, tmp_path, contents_by_id):
+    encryptor.cache.clear()
+    for record_id, contents in contents_by_id.items():
+        assert encryptor.blobs.contains(encryptor.store[record_id]['encrypted_filename'])
+        assert encryptor.read_record(record_id) == contents
+    assert not list(tmp_path.glob('encrypted_*.enc'))
+
+
+def test_remove_keeps_shard_folders(tmp_path):
+    blobs = BlobStore(str(tmp_path / 'blobs'))
+    path = blobs.path_for(7)
+    with blobs.open_blob(path) as blob:
+        blob.write(b'data')
+    blobs.remove(path)
+    blobs.remove(path)
+    assert not os.path.exists(path)
+    # A writer that created the folder just before the remove can still open its file in it
+    assert os.path.isdir(os.path.dirname(path))
+
+
+def test_migration_moves_every_flat_file(tmp_path):
+    encryptor = open_encryptor(tmp_path)
+    contents_by_id = add_flat_records(encryptor, tmp_path, [(f"scan{i}.pdf", os.urandom(100)) for i in range(5)])
+
+    report = migrate_flat_files(encryptor, batch_size=2)
+    assert (report['files'], report['moved'], report['records'], report['missing']) == (5, 5, 5, [])
+    assert_all_migrated(encryptor, tmp_path, contents_by_id)
+    for record_id in contents_by_id:
+        assert encryptor.store[record_id]['encrypted_filename'] == encryptor.blobs.path_for(record_id)
+
+    # The new paths are saved, and a second run has nothing left to do
+    reloaded = open_encryptor(tmp_path)
+    assert_all_migrated(reloaded, tmp_path, contents_by_id)
+    assert migrate_flat_files(reloaded)['files'] == 0
+
+
+def test_records_sharing_a_file_move_together(tmp_path):
+    encryptor = open_encryptor(tmp_path)
+    contents_by_id = add_flat_records(encryptor, tmp_path, [('report.pdf', b'first'), ('other.pdf', b'other'),
+                                                            ('copy.pdf', b'first'), ('again.pdf', b'first')])
+    shared_ids = [record_id for record_id, contents in contents_by_id.items() if contents == b'first']
+    assert len(shared_ids) == 3
+
+    report = migrate_flat_files(encryptor)
+    assert (report['files'], report['moved'], report['records']) == (2, 2, 4)
+    new_path = encryptor.blobs.path_for(min(shared_ids))
+    assert {encryptor.store[record_id]['encrypted_filename'] for record_id in shared_ids} == {new_path}
+    assert encryptor.store.file_reference_count(new_path) == 3
+    assert_all_migrated(encryptor, tmp_path, contents_by_id)
+
+
+def test_interrupted_migration_is_finished_by_running_it_again(tmp_path, monkeypatch):
+    encryptor = open_encryptor(tmp_path)
+    contents_by_id = add_flat_records(encryptor, tmp_path, [('a.pdf', b'a'), ('b.pdf', b'b'), ('copy.pdf', b'a'),
+                                                            ('c.pdf', b'c'), ('d.pdf', b'd')])
+
+    # Crash while storing the second batch: its files are moved, its records still point at the old paths
+    put_many = encryptor.store.put_many
+    calls = []
+
+    def crash_on_second_batch(records):
+        calls.append(len(records))
+        if len(calls) == 2:
+            raise OSError("disk full")
+        put_many(records)
+
+    monkeypatch.setattr(encryptor.store, 'put_many', crash_on_second_batch)
+    with pytest.raises(OSError):
+        migrate_flat_files(encryptor, batch_size=2)
+    monkeypatch.undo()
+
+    # a.pdf (two records) was stored, b.pdf and c.pdf were moved but not stored, d.pdf wasn't reached
+    rerun = open_encryptor(tmp_path)
+    report = migrate_flat_files(rerun, batch_size=2)
+    assert (report['files'], report['moved'], report['records'], report['missing']) == (3, 1, 3, [])
+    assert_all_migrated(open_encryptor(tmp_path), tmp_path, contents_by_id)
+
+
+def test_dry_run_changes_nothing(tmp_path):
+    encryptor = open_encryptor(tmp_path)
+    contents_by_id = add_flat_records(encryptor, tmp_path, [('a.pdf', b'a'), ('b.pdf', b'b')])
+    before = {record_id: encryptor.store[record_id]['encrypted_filename'] for record_id in contents_by_id}
+
+    report = migrate_flat_files(encryptor, dry_run=True)
+    assert (report['moved'], report['records'], report['dry_run']) == (2, 2, True)
+    assert {record_id: encryptor.store[record_id]['encrypted_filename'] for record_id in contents_by_id} == before
+    assert all(os.path.exists(path) for path in before.values())
+
+
+def test_missing_flat_file_is_reported_and_left_alone(tmp_path):
+    encryptor = open_encryptor(tmp_path)
+    contents_by_id = add_flat_records(encryptor, tmp_path, [('a.pdf', b'a'), ('gone.pdf', b'b')])
+    gone = str(tmp_path / 'encrypted_gone.pdf.enc')
+    os.remove(gone)
+
+    report = migrate_flat_files(encryptor)
+    assert (report['moved'], report['records'], report['missing']) == (1, 1, [gone])
+    gone_id = next(record_id for record_id, contents in contents_by_id.items() if contents == b'b')
+    assert encryptor.store[gone_id]['encrypted_filename'] == gone
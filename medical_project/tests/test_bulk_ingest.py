@@ -0,0 +1,126 @@
+# Tests for bulk_ingest.py: manifest and directory input, per-file failures, the single batched
+# commit of the keys and deduplication of identical files inside one batch
+
+import os
+
+import pytest
+
+from bulk_ingest import bulk_ingest, read_manifest, scan_directory
+from conftest import add_patient, open_system
+
+
+def write(path, contents):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(contents)
+    return str(path)
+
+
+def test_read_manifest_resolves_paths_next_to_it(tmp_path):
+    manifest = tmp_path / 'batch' / 'nightly.csv'
+    manifest.parent.mkdir()
+    absolute = str(tmp_path / 'elsewhere.pdf')
+    manifest.write_text("file_path,patient_id,record_type\n"
+                        "labs/a.pdf,1, lab \n"
+                        f"{absolute},2,xray\n")
+    assert read_manifest(str(manifest)) == [(str(tmp_path / 'batch' / 'labs' / 'a.pdf'), 1, 'lab'),
+                                            (absolute, 2, 'xray')]
+
+
+def test_scan_directory_reads_patient_and_type_folders(tmp_path):
+    first = write(tmp_path / 'in' / '1' / 'lab' / 'a.pdf', b'a')
+    second = write(tmp_path / 'in' / '1' / 'lab' / 'b.pdf', b'b')
+    third = write(tmp_path / 'in' / '2' / 'xray' / 'c.png', b'c')
+    # Not laid out as <patient_id>/<record_type>/<files>
+    write(tmp_path / 'in' / 'notes' / 'lab' / 'd.pdf', b'd')
+    write(tmp_path / 'in' / '1' / 'stray.pdf', b'e')
+    assert scan_directory(str(tmp_path / 'in')) == [(first, 1, 'lab'), (second, 1, 'lab'), (third, 2, 'xray')]
+
+
+def test_ingest_from_a_manifest(system, tmp_path):
+    patient_id, _ = add_patient(system)
+    write(tmp_path / 'batch' / 'a.pdf', b'first report')
+    write(tmp_path / 'batch' / 'b.pdf', b'second report')
+    manifest = tmp_path / 'batch' / 'nightly.csv'
+    manifest.write_text(f"file_path,patient_id,record_type\na.pdf,{patient_id},lab\nb.pdf,{patient_id},lab\n")
+
+    report = bulk_ingest(system, read_manifest(str(manifest)), workers=2)
+    assert (report['files'], report['encrypted'], report['failed']) == (2, 2, 0)
+    assert report['bytes'] == len(b'first report') + len(b'second report')
+    record_ids = [result['record_id'] for result in report['results']]
+    assert [system.encryptor.read_record(record_id) for record_id in record_ids] == [b'first report',
+                                                                                    b'second report']
+    assert sorted(system.encryptor.store.record_ids_for_patient(patient_id, 'lab')) == sorted(record_ids)
+
+
+def test_ingest_from_a_directory(system, tmp_path):
+    first, _ = add_patient(system, 1)
+    second, _ = add_patient(system, 2)
+    write(tmp_path / 'in' / str(first) / 'lab' / 'a.pdf', b'lab result')
+    write(tmp_path / 'in' / str(second) / 'xray' / 'b.png', b'x-ray image')
+
+    report = bulk_ingest(system, scan_directory(str(tmp_path / 'in')))
+    assert report['encrypted'] == 2
+    by_patient = {result['patient_id']: result for result in report['results']}
+    record_info = system.encryptor.store[by_patient[second]['record_id']]
+    assert (record_info['record_type'], record_info['original_filename']) == ('xray', 'b.png')
+    assert system.encryptor.read_record(by_patient[first]['record_id']) == b'lab result'
+
+
+def test_failed_entries_are_reported_and_the_rest_stored(system, tmp_path):
+    patient_id, _ = add_patient(system)
+    good = write(tmp_path / 'good.pdf', b'contents')
+    missing = str(tmp_path / 'missing.pdf')
+
+    report = bulk_ingest(system, [(good, 999, 'lab'), (missing, patient_id, 'lab'), (good, patient_id, 'lab')])
+    assert (report['files'], report['encrypted'], report['failed']) == (3, 1, 2)
+    unknown, not_found, stored = report['results']
+    assert (unknown['status'], unknown['error'], unknown['record_id']) == ('failed', "Patient not found", None)
+    assert (not_found['status'], not_found['error']) == ('failed', f"File not found: {missing}")
+    assert stored['status'] == 'encrypted'
+    assert list(system.encryptor.store) == [stored['record_id']]
+
+
+def test_keys_are_committed_in_one_batch(system, tmp_path, monkeypatch):
+    patient_id, _ = add_patient(system)
+    entries = [(write(tmp_path / f"{i}.pdf", bytes([i]) * 100), patient_id, 'lab') for i in range(5)]
+    batches = []
+    add_records = system.encryptor.add_records
+    monkeypatch.setattr(system.encryptor, 'add_records',
+                        lambda records: batches.append(len(records)) or add_records(records))
+
+    report = bulk_ingest(system, entries, workers=3)
+    assert batches == [5]
+    assert report['encrypted'] == 5
+
+
+def test_identical_files_in_one_batch_share_a_blob(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    system = open_system(tmp_path, dedup='patient')
+    patient_id, _ = add_patient(system)
+    entries = [(write(tmp_path / name, contents), patient_id, 'lab')
+               for name, contents in [('a.pdf', b'same' * 500), ('b.pdf', b'other'), ('c.pdf', b'same' * 500)]]
+
+    report = bulk_ingest(system, entries, workers=3)
+    first, other, copy = report['results']
+    assert (report['encrypted'], report['deduplicated']) == (3, 1)
+    assert (first['shared_from'], other['shared_from'], copy['shared_from']) == (None, None, first['record_id'])
+
+    store = system.encryptor.store
+    assert store[copy['record_id']]['encrypted_filename'] == store[first['record_id']]['encrypted_filename']
+    assert store.file_reference_count(store[first['record_id']]['encrypted_filename']) == 2
+    # The copy's own blob is gone, and it reads back through the shared one
+    assert not os.path.exists(system.encryptor.blobs.path_for(copy['record_id']))
+    assert system.encryptor.read_record(copy['record_id']) == b'same' * 500
+    system.authenticator.hasher.shutdown()
+
+
+@pytest.mark.parametrize('use_processes', [False, True])
+def test_thread_and_process_pools_store_the_same_contents(system, tmp_path, use_processes):
+    patient_id, _ = add_patient(system)
+    contents = [os.urandom(1000 * (i + 1)) for i in range(4)]
+    entries = [(write(tmp_path / f"{i}.bin", data), patient_id, 'scan') for i, data in enumerate(contents)]
+
+    report = bulk_ingest(system, entries, workers=2, use_processes=use_processes)
+    assert report['encrypted'] == 4
+    system.encryptor.cache.clear()
+    assert [system.encryptor.read_record(result['record_id']) for result in report['results']] == contents
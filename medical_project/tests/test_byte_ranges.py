@@ -0,0 +1,139 @@
+# Tests for ranged retrieval: byte_range, slice_chunks, iter_decrypted_range, the encryptor's
+# ranged reads and the HTTP Range header, especially at chunk and record boundaries
+
+import io
+import os
+
+import pytest
+from cryptography.fernet import Fernet
+
+from compression import NONE, ZLIB, CompressionPolicy
+from encryption import MedicalFileEncryptor, byte_range
+from http_service import HTTPError, parse_range
+from key_wrapping import MasterKeyStore
+from metrics import MetricsRegistry
+from stream_cipher import encrypt_stream, iter_decrypted_range, slice_chunks
+
+CHUNK_SIZE = 16
+
+
+def all_ranges(size):
+    return [(start, end) for start in range(size + 1) for end in range(start, size + 1)]
+
+
+def test_byte_range_fills_in_and_clamps_the_end():
+    record_info = {'file_size': 10}
+    assert byte_range(record_info) == (0, 10)
+    assert byte_range(record_info, 3) == (3, 10)
+    assert byte_range(record_info, 3, 7) == (3, 7)
+    assert byte_range(record_info, 3, 100) == (3, 10)
+    assert byte_range(record_info, 10) == (10, 10)
+    assert byte_range(record_info, 4, 4) == (4, 4)
+
+
+@pytest.mark.parametrize('start, end', [(-1, None), (11, None), (5, 4)])
+def test_byte_range_rejects_bad_ranges(start, end):
+    with pytest.raises(ValueError):
+        byte_range({'file_size': 10}, start, end)
+
+
+@pytest.mark.parametrize('sizes', [[5, 5, 5], [1, 0, 7, 3], [16]])
+def test_slice_chunks_matches_slicing(sizes):
+    data = bytes(range(sum(sizes)))
+    chunks = []
+    offset = 0
+    for size in sizes:
+        chunks.append(data[offset:offset + size])
+        offset += size
+    for start, end in all_ranges(len(data)):
+        assert b''.join(slice_chunks(iter(chunks), start, end)) == data[start:end]
+    assert b''.join(slice_chunks(iter(chunks), 3)) == data[3:]
+
+
+def test_slice_chunks_stops_reading_at_the_end():
+    read = []
+
+    def chunks():
+        for i in range(10):
+            read.append(i)
+            yield bytes(4)
+
+    assert len(b''.join(slice_chunks(chunks(), 2, 8))) == 6
+    assert read == [0, 1]
+
+
+# Sizes on both sides of chunk boundaries; a whole number of chunks is the awkward case
+@pytest.mark.parametrize('size', [0, 1, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1, 4 * CHUNK_SIZE, 4 * CHUNK_SIZE + 3])
+def test_iter_decrypted_range_matches_slicing(size):
+    key = Fernet.generate_key()
+    data = os.urandom(size)
+    container = io.BytesIO()
+    encrypt_stream(key, io.BytesIO(data), container, CHUNK_SIZE)
+    for start, end in all_ranges(size):
+        assert b''.join(iter_decrypted_range(key, io.BytesIO(container.getvalue()), start, end)) == data[start:end]
+        assert b''.join(iter_decrypted_range(key, io.BytesIO(container.getvalue()), start)) == data[start:]
+
+
+@pytest.fixture
+def encryptor(tmp_path):
+    encryptor = MedicalFileEncryptor(keys_path=str(tmp_path / 'encryption_keys.json'), metrics=MetricsRegistry(),
+                                     master_keys=MasterKeyStore(str(tmp_path / 'master_keys.json')),
+                                     blob_root=str(tmp_path / 'blobs'))
+    encryptor.chunk_size = CHUNK_SIZE
+    return encryptor
+
+
+# Plain, compressed and cached records are read through different paths
+@pytest.mark.parametrize('codec, cached', [(NONE, False), (ZLIB, False), (NONE, True)])
+def test_ranged_reads_at_chunk_boundaries(encryptor, tmp_path, codec, cached):
+    encryptor.compression = CompressionPolicy({}, codec)
+    data = os.urandom(3 * CHUNK_SIZE) + bytes(2 * CHUNK_SIZE)
+    source = tmp_path / 'scan.bin'
+    source.write_bytes(data)
+    record_id = encryptor.encrypt_file(str(source), patient_id=1, record_type='xray')['record_id']
+    if cached:
+        assert encryptor.read_record(record_id) == data
+    else:
+        encryptor.cache.clear()
+
+    boundaries = sorted({0, 1, len(data) - 1, len(data)}
+                        | {edge + delta for edge in range(CHUNK_SIZE, len(data), CHUNK_SIZE) for delta in (-1, 0, 1)})
+    for start in boundaries:
+        for end in boundaries:
+            if end < start:
+                continue
+            assert b''.join(encryptor.iter_record_chunks(record_id, start, end)) == data[start:end]
+            assert encryptor.open_record(record_id, start, end).read() == data[start:end]
+    assert encryptor.open_record(record_id, 5, len(data) + 100).read() == data[5:]
+    with pytest.raises(ValueError):
+        encryptor.open_record(record_id, len(data) + 1)
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('bytes=0-0', (0, 1)),
+    ('bytes=0-9', (0, 10)),
+    ('bytes=9-9', (9, 10)),
+    ('bytes=5-', (5, 10)),
+    ('bytes=3-100', (3, 10)),
+    ('bytes=-1', (9, 10)),
+    ('bytes=-10', (0, 10)),
+    ('bytes=-100', (0, 10)),
+    (None, None),
+    ('', None),
+    ('items=0-5', None),
+    ('bytes=0-1,4-5', None),
+    ('bytes=5-3', None),
+    ('bytes=-', None),
+    ('bytes=a-b', None),
+])
+def test_parse_range(value, expected):
+    assert parse_range(value, 10) == expected
+
+
+@pytest.mark.parametrize('value, file_size', [('bytes=10-', 10), ('bytes=10-20', 10), ('bytes=-0', 10),
+                                              ('bytes=0-', 0)])
+def test_parse_range_outside_the_body_is_not_satisfiable(value, file_size):
+    with pytest.raises(HTTPError) as raised:
+        parse_range(value, file_size)
+    assert raised.value.status == 416
+    assert raised.value.headers == {'Content-Range': f"bytes */{file_size}"}
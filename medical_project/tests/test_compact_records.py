@@ -0,0 +1,141 @@
+# Tests for compact_records.py: every record reads back (and is written to JSON) exactly as it was
+# stored, whether or not its values fit their compact form
+
+import base64
+import hashlib
+import json
+
+import pytest
+
+from compact_records import KeyRecord, PatientRecord, compact_key_record, compact_patient, json_default
+
+DIGEST = hashlib.sha256(b'contents').hexdigest()
+WRAPPED_KEY = base64.b64encode(bytes(range(60))).decode()
+
+
+def key_record(**fields):
+    record_info = {
+        'record_id': 7,
+        'patient_id': 3,
+        'record_type': 'lab',
+        'original_filename': 'report.pdf',
+        'encrypted_filename': 'blobs/00/07/7.enc',
+        'created_at': '2025-03-01 12:00:00',
+        'file_size': 1234,
+        'fingerprint': DIGEST,
+        'wrapped_key': WRAPPED_KEY,
+        'kek_id': 'kek-1',
+    }
+    record_info.update(fields)
+    return record_info
+
+
+def patient(**fields):
+    record = {
+        'patient_id': 3,
+        'name': 'Ann',
+        'ssn_hash': f"hmac_sha256${DIGEST}",
+        'pin_hash': 'scrypt$16384$8$1$c2FsdA==$aGFzaA==',
+        'password_hash': 'scrypt$16384$8$1$c2FsdA==$aGFzaA==',
+        'email': 'ann@example.com',
+        'registered_at': '2025-03-01 12:00:00',
+    }
+    record.update(fields)
+    return record
+
+
+# Through a compact record, json_default and back
+def round_trip(record, compact):
+    stored = compact(record)
+    assert dict(stored) == record
+    assert stored.copy() == record
+    assert all(stored[name] == value for name, value in record.items())
+    return json.loads(json.dumps(stored, default=json_default))
+
+
+ODD_TIMESTAMPS = [
+    12345, 0, -1, 1.5, None, '', '2025-03-01', '2025-03-01T12:00:00', '2025-03-01 12:00:00.123456',
+    '2025-02-30 12:00:00', '2025-13-01 12:00:00', '2025-03-01 24:00:00', '0099-01-01 00:00:00',
+    '1969-12-31 23:59:59', '+025-03-01 12:00:00', '2025-03-01 12:00:0x', '２０２５-03-01 12:00:00',
+]
+
+
+@pytest.mark.parametrize('created_at', ['2025-03-01 12:00:00', '1970-01-01 00:00:00', '9999-12-31 23:59:59']
+                         + ODD_TIMESTAMPS)
+def test_key_record_timestamps_round_trip(created_at):
+    record = key_record(created_at=created_at)
+    assert round_trip(record, compact_key_record) == record
+
+
+@pytest.mark.parametrize('registered_at', ODD_TIMESTAMPS)
+def test_patient_timestamps_round_trip(registered_at):
+    record = patient(registered_at=registered_at)
+    assert round_trip(record, compact_patient) == record
+
+
+@pytest.mark.parametrize('fingerprint', [DIGEST.upper(), DIGEST[:-1], DIGEST + '0', 'g' * 64, '', 42, None])
+def test_odd_digests_round_trip(fingerprint):
+    record = key_record(fingerprint=fingerprint)
+    assert round_trip(record, compact_key_record) == record
+
+
+@pytest.mark.parametrize('ssn_hash', [f"hmac_sha256${DIGEST.upper()}", f"sha256${DIGEST}", DIGEST,
+                                      'hmac_sha256$', 'hmac_sha256$xyz', 12345])
+def test_odd_ssn_hashes_round_trip(ssn_hash):
+    record = patient(ssn_hash=ssn_hash)
+    assert round_trip(record, compact_patient) == record
+
+
+@pytest.mark.parametrize('wrapped_key', ['not base64!', 'AAA', 'AAAA=', WRAPPED_KEY.rstrip('='),
+                                         base64.urlsafe_b64encode(b'\xfb\xff' * 30).decode(), '', 42, None])
+def test_odd_wrapped_keys_round_trip(wrapped_key):
+    record = key_record(wrapped_key=wrapped_key)
+    assert round_trip(record, compact_key_record) == record
+
+
+def test_extra_fields_round_trip():
+    record = key_record(encryption_key='plaintext key', notes={'a': [1, 2]}, shared_from=2)
+    assert round_trip(record, compact_key_record) == record
+    patient_record = patient(legacy_flag=True)
+    assert round_trip(patient_record, compact_patient) == patient_record
+
+
+def test_missing_fields_are_absent():
+    record = {'record_id': 1, 'patient_id': 2, 'record_type': 'lab'}
+    stored = compact_key_record(record)
+    assert 'fingerprint' not in stored
+    assert stored.get('fingerprint') is None
+    assert len(stored) == 3
+    with pytest.raises(KeyError):
+        stored['created_at']
+
+
+# Setting a field again moves it between its compact slot and the extra dict as needed
+def test_changing_fields_in_place():
+    stored = KeyRecord(key_record())
+    stored['created_at'] = 12345
+    assert stored['created_at'] == 12345
+    stored['created_at'] = '2025-03-02 08:30:00'
+    assert stored['created_at'] == '2025-03-02 08:30:00'
+    assert 'created_at' not in (stored.extra or {})
+
+    stored['fingerprint'] = DIGEST.upper()
+    assert stored['fingerprint'] == DIGEST.upper()
+    del stored['fingerprint']
+    assert 'fingerprint' not in stored
+    with pytest.raises(KeyError):
+        del stored['fingerprint']
+
+    stored['wrapped_key'] = WRAPPED_KEY
+    expected = key_record(created_at='2025-03-02 08:30:00')
+    del expected['fingerprint']
+    assert dict(stored) == expected
+
+
+def test_compact_values_are_shared_and_packed():
+    first, second = KeyRecord(key_record()), KeyRecord(key_record(record_type=''.join(['l', 'ab'])))
+    assert first.record_type is second.record_type
+    assert first.created_at == 1740830400
+    assert first.fingerprint == bytes.fromhex(DIGEST)
+    assert PatientRecord(patient()).ssn_hash == bytes.fromhex(DIGEST)
+    assert first.extra is None
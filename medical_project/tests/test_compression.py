@@ -0,0 +1,56 @@
+# Tests for compression.py: decompression stays within bounded pieces
+
+import lzma
+import os
+import zlib
+
+import pytest
+
+from compression import LZMA, NONE, ZLIB, iter_decompressed
+
+PIECE_SIZE = 64 * 1024
+
+
+def compress(codec, data):
+    return zlib.compress(data, 9) if codec == ZLIB else lzma.compress(data)
+
+
+# Splits data into chunks the size the stream cipher hands back
+def split(data, size=PIECE_SIZE):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('codec', [ZLIB, LZMA])
+def test_highly_compressible_chunk_comes_out_in_bounded_pieces(codec):
+    # 64 MiB of zeros compress to far less than one 64 KiB chunk
+    original_size = 64 * 1024 * 1024
+    compressed = compress(codec, bytes(original_size))
+    assert len(compressed) < PIECE_SIZE
+
+    total = 0
+    for piece in iter_decompressed(split(compressed), codec, PIECE_SIZE):
+        assert len(piece) <= PIECE_SIZE
+        assert not piece.strip(b'\x00')
+        total += len(piece)
+    assert total == original_size
+
+
+@pytest.mark.parametrize('codec', [ZLIB, LZMA])
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096, PIECE_SIZE])
+def test_round_trip_for_any_chunking(codec, chunk_size):
+    data = os.urandom(100 * 1024) + b'lab result line\n' * 20000
+    pieces = list(iter_decompressed(split(compress(codec, data), chunk_size), codec, 1000))
+    assert b''.join(pieces) == data
+    assert max(len(piece) for piece in pieces) <= 1000
+
+
+@pytest.mark.parametrize('codec', [ZLIB, LZMA])
+def test_truncated_data_is_an_error(codec):
+    compressed = compress(codec, os.urandom(200 * 1024))
+    with pytest.raises(ValueError):
+        list(iter_decompressed(split(compressed[:-100]), codec))
+
+
+def test_uncompressed_chunks_pass_through():
+    chunks = [b'abc', b'def']
+    assert list(iter_decompressed(chunks, NONE)) == chunks
@@ -0,0 +1,124 @@
+# Tests for MedicalFileEncryptor.decrypt_into and read_record: plaintext goes only to the caller's
+# buffer or file object (or comes back as bytes), never to a decrypted_* file on disk
+
+import array
+import io
+import mmap
+import os
+
+import pytest
+
+from compression import NONE, ZLIB, CompressionPolicy
+from encryption import MedicalFileEncryptor
+from key_wrapping import MasterKeyStore
+from metrics import MetricsRegistry
+
+CONTENTS = b'blood panel results\n' * 5000
+
+
+@pytest.fixture
+def encryptor(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    encryptor = MedicalFileEncryptor(keys_path=str(tmp_path / 'encryption_keys.json'), metrics=MetricsRegistry(),
+                                     master_keys=MasterKeyStore(str(tmp_path / 'master_keys.json')),
+                                     blob_root=str(tmp_path / 'blobs'))
+    encryptor.chunk_size = 4096
+    return encryptor
+
+
+def add_record(encryptor, tmp_path, codec=NONE, contents=CONTENTS):
+    encryptor.compression = CompressionPolicy({}, codec)
+    source = tmp_path / 'uploads' / 'results.txt'
+    source.parent.mkdir(exist_ok=True)
+    source.write_bytes(contents)
+    record_id = encryptor.encrypt_file(str(source), patient_id=1, record_type='lab')['record_id']
+    encryptor.cache.clear()
+    return record_id
+
+
+def decrypted_files(tmp_path):
+    return [path for path in tmp_path.rglob('*') if 'decrypted' in path.name]
+
+
+@pytest.mark.parametrize('codec', [NONE, ZLIB])
+@pytest.mark.parametrize('cached', [False, True])
+def test_decrypt_into_buffers(encryptor, tmp_path, codec, cached):
+    record_id = add_record(encryptor, tmp_path, codec)
+    if cached:
+        encryptor.read_record(record_id)
+
+    exact = bytearray(len(CONTENTS))
+    assert encryptor.decrypt_into(record_id, exact) == len(CONTENTS)
+    assert exact == CONTENTS
+
+    # A larger buffer is filled from the start and the rest is left alone
+    larger = bytearray(b'\xff' * (len(CONTENTS) + 10))
+    assert encryptor.decrypt_into(record_id, memoryview(larger)) == len(CONTENTS)
+    assert larger == CONTENTS + b'\xff' * 10
+
+    # Buffers of wider items are written as bytes
+    words = array.array('I', bytes(len(CONTENTS)))
+    assert encryptor.decrypt_into(record_id, words) == len(CONTENTS)
+    assert words.tobytes()[:len(CONTENTS)] == CONTENTS
+
+    with mmap.mmap(-1, len(CONTENTS)) as mapped:
+        assert encryptor.decrypt_into(record_id, mapped) == len(CONTENTS)
+        assert mapped[:] == CONTENTS
+    assert decrypted_files(tmp_path) == []
+
+
+@pytest.mark.parametrize('size', [0, len(CONTENTS) - 1])
+def test_buffer_too_small_is_refused(encryptor, tmp_path, size):
+    record_id = add_record(encryptor, tmp_path)
+    buffer = bytearray(b'\xff' * size)
+    with pytest.raises(ValueError, match='too small'):
+        encryptor.decrypt_into(record_id, buffer)
+    # Nothing is written before the check
+    assert buffer == b'\xff' * size
+
+
+def test_decrypt_into_file_objects(encryptor, tmp_path):
+    record_id = add_record(encryptor, tmp_path)
+    target = io.BytesIO()
+    target.write(b'header:')
+    assert encryptor.decrypt_into(record_id, target) == len(CONTENTS)
+    assert target.getvalue() == b'header:' + CONTENTS
+
+    # A real file object the caller opened, written in chunks
+    writes = []
+    with open(tmp_path / 'chosen by caller.bin', 'wb') as f:
+        write = f.write
+        f.write = lambda chunk: writes.append(len(chunk)) or write(chunk)
+        assert encryptor.decrypt_into(record_id, f) == len(CONTENTS)
+    assert (tmp_path / 'chosen by caller.bin').read_bytes() == CONTENTS
+    assert len(writes) > 1 and max(writes) <= encryptor.chunk_size
+    assert decrypted_files(tmp_path) == []
+
+
+def test_empty_record(encryptor, tmp_path):
+    record_id = add_record(encryptor, tmp_path, contents=b'')
+    assert encryptor.decrypt_into(record_id, bytearray()) == 0
+    assert encryptor.read_record(record_id) == b''
+
+
+def test_failures_return_none(encryptor, tmp_path):
+    assert encryptor.decrypt_into(999, bytearray(10)) is None
+    assert encryptor.read_record(999) is None
+
+    record_id = add_record(encryptor, tmp_path)
+    with open(encryptor.store[record_id]['encrypted_filename'], 'r+b') as f:
+        f.seek(-5, os.SEEK_END)
+        f.write(b'\x00' * 5)
+    assert encryptor.decrypt_into(record_id, bytearray(len(CONTENTS))) is None
+    assert encryptor.decrypt_into(record_id, io.BytesIO()) is None
+    assert encryptor.read_record(record_id) is None
+
+
+@pytest.mark.parametrize('codec', [NONE, ZLIB])
+def test_read_record_writes_nothing_to_disk(encryptor, tmp_path, codec):
+    record_id = add_record(encryptor, tmp_path, codec)
+    before = sorted(tmp_path.rglob('*'))
+    assert encryptor.read_record(record_id) == CONTENTS
+    # Again, from the cache
+    assert encryptor.read_record(record_id) == CONTENTS
+    assert sorted(tmp_path.rglob('*')) == before
@@ -0,0 +1,88 @@
+# Tests for MedicalFileEncryptor.decrypt_many: results in the order asked for, None for records
+# that can't be decrypted, and never more threads than max_workers
+
+import os
+import threading
+import time
+
+import pytest
+
+from encryption import MedicalFileEncryptor
+from key_wrapping import MasterKeyStore
+from metrics import MetricsRegistry
+
+
+@pytest.fixture
+def encryptor(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return MedicalFileEncryptor(keys_path=str(tmp_path / 'encryption_keys.json'), metrics=MetricsRegistry(),
+                                master_keys=MasterKeyStore(str(tmp_path / 'master_keys.json')),
+                                blob_root=str(tmp_path / 'blobs'))
+
+
+# Stores one record per contents, returns {record_id: contents}
+def add_records(encryptor, tmp_path, count):
+    contents_by_id = {}
+    for i in range(count):
+        source = tmp_path / f"report{i}.pdf"
+        source.write_bytes(os.urandom(100 + i))
+        record_info = encryptor.encrypt_file(str(source), patient_id=1, record_type='lab')
+        contents_by_id[record_info['record_id']] = source.read_bytes()
+    encryptor.cache.clear()
+    return contents_by_id
+
+
+@pytest.mark.parametrize('max_workers', [1, 3, 8])
+def test_results_follow_the_order_of_the_record_ids(encryptor, tmp_path, monkeypatch, max_workers):
+    contents_by_id = add_records(encryptor, tmp_path, 6)
+    record_ids = sorted(contents_by_id, reverse=True)
+
+    # Earlier records take longer, so they finish last
+    read_record = encryptor.read_record
+    monkeypatch.setattr(encryptor, 'read_record',
+                        lambda record_id: time.sleep(0.005 * record_id) or read_record(record_id))
+    assert encryptor.decrypt_many(record_ids[::-1], max_workers) == [contents_by_id[record_id]
+                                                                    for record_id in record_ids[::-1]]
+    assert encryptor.decrypt_many(record_ids, max_workers) == [contents_by_id[record_id] for record_id in record_ids]
+
+
+def test_failed_records_are_none_among_the_good_ones(encryptor, tmp_path):
+    contents_by_id = add_records(encryptor, tmp_path, 3)
+    first, tampered, last = sorted(contents_by_id)
+    with open(encryptor.store[tampered]['encrypted_filename'], 'r+b') as f:
+        f.seek(-5, os.SEEK_END)
+        f.write(b'\x00' * 5)
+
+    results = encryptor.decrypt_many([first, tampered, 999, last], max_workers=4)
+    assert results == [contents_by_id[first], None, None, contents_by_id[last]]
+
+
+def test_no_more_threads_than_max_workers(encryptor, tmp_path, monkeypatch):
+    contents_by_id = add_records(encryptor, tmp_path, 10)
+    lock = threading.Lock()
+    running = []
+    most_running = []
+
+    def read_record(record_id):
+        with lock:
+            running.append(record_id)
+            most_running.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(record_id)
+        return record_id
+
+    monkeypatch.setattr(encryptor, 'read_record', read_record)
+    assert encryptor.decrypt_many(list(contents_by_id), max_workers=3) == list(contents_by_id)
+    assert max(most_running) == 3
+    most_running.clear()
+    encryptor.decrypt_many(list(contents_by_id), max_workers=1)
+    assert max(most_running) == 1
+
+
+def test_write_files_writes_each_record(encryptor, tmp_path):
+    contents_by_id = add_records(encryptor, tmp_path, 2)
+    results = encryptor.decrypt_many(list(contents_by_id), write_files=True)
+    assert results == list(contents_by_id.values())
+    for i, contents in enumerate(results):
+        assert (tmp_path / f"decrypted_report{i}.pdf").read_bytes() == contents
@@ -0,0 +1,138 @@
+# Tests for dedup.py and MedicalFileEncryptor.delete_record: identical uploads share one .enc
+# file, which is reference counted and deleted only with the last record pointing at it
+
+import os
+
+import pytest
+
+from encryption import MedicalFileEncryptor
+from key_wrapping import MasterKeyStore
+from metrics import MetricsRegistry
+from storage import SQLiteKeyStore
+
+CONTENTS = b'referral letter ' * 1000
+
+
+# Opens an encryptor on the files in tmp_path; several can be open at once, like separate processes
+def open_encryptor(tmp_path, backend='json', scope='patient'):
+    store = SQLiteKeyStore(str(tmp_path / 'keys.db')) if backend == 'sqlite' else None
+    return MedicalFileEncryptor(keys_path=str(tmp_path / 'encryption_keys.json'), store=store,
+                                metrics=MetricsRegistry(),
+                                master_keys=MasterKeyStore(str(tmp_path / 'master_keys.json')),
+                                dedup=scope, blob_root=str(tmp_path / 'blobs'))
+
+
+def upload(encryptor, tmp_path, patient_id, contents=CONTENTS, name='letter.pdf'):
+    path = tmp_path / name
+    path.write_bytes(contents)
+    return encryptor.encrypt_file(str(path), patient_id=patient_id, record_type='referral')
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def backend(request):
+    return request.param
+
+
+def test_identical_uploads_share_one_file(tmp_path, backend):
+    encryptor = open_encryptor(tmp_path, backend)
+    records = [upload(encryptor, tmp_path, 1) for _ in range(3)]
+    encrypted_filename = records[0]['encrypted_filename']
+    assert {record_info['encrypted_filename'] for record_info in records} == {encrypted_filename}
+    assert [record_info.get('shared_from') for record_info in records] == [None] + [records[0]['record_id']] * 2
+    assert len({record_info['wrapped_key'] for record_info in records}) == 3
+    assert encryptor.store.file_reference_count(encrypted_filename) == 3
+    for record_info in records:
+        assert encryptor.read_record(record_info['record_id']) == CONTENTS
+
+
+def test_file_is_deleted_with_its_last_reference(tmp_path, backend):
+    encryptor = open_encryptor(tmp_path, backend)
+    records = [upload(encryptor, tmp_path, 1) for _ in range(3)]
+    encrypted_filename = records[0]['encrypted_filename']
+
+    # The record that first stored the file goes first; the copies still open
+    assert encryptor.delete_record(records[0]['record_id'])
+    assert os.path.exists(encrypted_filename)
+    assert encryptor.store.file_reference_count(encrypted_filename) == 2
+    encryptor.cache.clear()
+    assert encryptor.read_record(records[2]['record_id']) == CONTENTS
+
+    assert encryptor.delete_record(records[1]['record_id'])
+    assert os.path.exists(encrypted_filename)
+    assert encryptor.delete_record(records[2]['record_id'])
+    assert not os.path.exists(encrypted_filename)
+    assert encryptor.store.file_reference_count(encrypted_filename) == 0
+    assert not encryptor.delete_record(records[2]['record_id'])
+
+
+def test_new_upload_shares_with_a_remaining_copy(tmp_path, backend):
+    encryptor = open_encryptor(tmp_path, backend)
+    first, second = upload(encryptor, tmp_path, 1), upload(encryptor, tmp_path, 1)
+    encryptor.delete_record(first['record_id'])
+
+    third = upload(encryptor, tmp_path, 1)
+    assert third['encrypted_filename'] == first['encrypted_filename']
+    assert third['shared_from'] == second['record_id']
+    assert encryptor.store.file_reference_count(third['encrypted_filename']) == 2
+
+
+def test_upload_after_the_last_reference_is_gone_gets_a_new_file(tmp_path, backend):
+    encryptor = open_encryptor(tmp_path, backend)
+    first = upload(encryptor, tmp_path, 1)
+    encryptor.delete_record(first['record_id'])
+
+    again = upload(encryptor, tmp_path, 1)
+    assert 'shared_from' not in again
+    assert os.path.exists(again['encrypted_filename'])
+    assert encryptor.read_record(again['record_id']) == CONTENTS
+
+
+def test_remove_file_false_keeps_the_last_file(tmp_path, backend):
+    encryptor = open_encryptor(tmp_path, backend)
+    record_info = upload(encryptor, tmp_path, 1)
+    assert encryptor.delete_record(record_info['record_id'], remove_file=False)
+    assert os.path.exists(record_info['encrypted_filename'])
+
+
+@pytest.mark.parametrize('scope, shared', [('patient', False), ('global', True)])
+def test_scope_decides_who_shares(tmp_path, scope, shared):
+    encryptor = open_encryptor(tmp_path, scope=scope)
+    first, other_patient = upload(encryptor, tmp_path, 1), upload(encryptor, tmp_path, 2)
+    assert (other_patient['encrypted_filename'] == first['encrypted_filename']) == shared
+
+    # Deleting one patient's record never takes the other patient's contents with it
+    encryptor.delete_record(first['record_id'])
+    encryptor.cache.clear()
+    assert encryptor.read_record(other_patient['record_id']) == CONTENTS
+
+
+def test_different_contents_are_not_shared(tmp_path):
+    encryptor = open_encryptor(tmp_path)
+    first = upload(encryptor, tmp_path, 1)
+    other = upload(encryptor, tmp_path, 1, CONTENTS + b'!')
+    assert other['encrypted_filename'] != first['encrypted_filename']
+
+
+def test_reference_counts_survive_a_reload(tmp_path):
+    encryptor = open_encryptor(tmp_path)
+    records = [upload(encryptor, tmp_path, 1) for _ in range(3)]
+    encryptor.delete_record(records[0]['record_id'])
+    encryptor.save_keys()
+    upload(encryptor, tmp_path, 1)
+
+    reloaded = open_encryptor(tmp_path)
+    encrypted_filename = records[0]['encrypted_filename']
+    assert reloaded.store.file_reference_count(encrypted_filename) == 3
+
+
+def test_deletes_from_two_processes_remove_the_file_once_both_are_gone(tmp_path, backend):
+    first_process = open_encryptor(tmp_path, backend)
+    records = [upload(first_process, tmp_path, 1) for _ in range(2)]
+    second_process = open_encryptor(tmp_path, backend)
+    encrypted_filename = records[0]['encrypted_filename']
+
+    # Each process deletes one record; the second one must see the first one's delete
+    assert second_process.delete_record(records[0]['record_id'])
+    assert os.path.exists(encrypted_filename)
+    assert first_process.delete_record(records[1]['record_id'])
+    assert not os.path.exists(encrypted_filename)
@@ -0,0 +1,120 @@
+# Tests for event_log.py: nothing is written unless logging is configured, JSON output is one
+# object per line with the event's fields, and the --log option of the command line tools
+
+import datetime
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+
+import pytest
+
+from event_log import CONSOLE, JSON, LOGGER_NAME, SILENT, configure_logging, get_logger, log_event
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# configure_logging changes the shared 'medical' logger; put it back for the other tests
+@pytest.fixture(autouse=True)
+def restore_logger():
+    logger = logging.getLogger(LOGGER_NAME)
+    handlers, level, propagate = list(logger.handlers), logger.level, logger.propagate
+    yield
+    logger.handlers[:] = handlers
+    logger.setLevel(level)
+    logger.propagate = propagate
+
+
+def run_python(code, cwd):
+    return subprocess.run([sys.executable, '-c', code], cwd=cwd, capture_output=True, text=True, timeout=60,
+                          env=dict(os.environ, PYTHONPATH=PROJECT_DIR))
+
+
+def test_silent_by_default(tmp_path):
+    # A fresh interpreter, so pytest's own log capturing isn't in the way
+    result = run_python(
+        "import logging\n"
+        "from event_log import get_logger, log_event\n"
+        "from encryption import MedicalFileEncryptor\n"
+        "encryptor = MedicalFileEncryptor()\n"
+        "encryptor.read_record(999)\n"
+        "log_event(get_logger('test'), 'test.error', 'something failed', logging.ERROR, record_id=1)\n"
+        "print('done')\n", tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert (result.stdout, result.stderr) == ('done\n', '')
+
+
+def test_json_lines_carry_the_event_fields():
+    stream = io.StringIO()
+    configure_logging(JSON, logging.DEBUG, stream)
+    logger = get_logger('test')
+    log_event(logger, 'record.read', "Read record 7", logging.DEBUG, record_id=7, bytes=1024, duration_ms=1.5)
+    log_event(logger, 'auth.failed', level=logging.WARNING, patient_id=None)
+    try:
+        raise ValueError("bad tag")
+    except ValueError:
+        logger.exception("Decryption failed", extra={'event': 'record.failed', 'fields': {'record_id': 8}})
+
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 3
+    first, second, third = [json.loads(line) for line in lines]
+    assert set(first) == {'time', 'level', 'logger', 'event', 'record_id', 'bytes', 'duration_ms', 'message'}
+    assert (first['level'], first['logger'], first['event'], first['message']) == \
+        ('DEBUG', 'medical.test', 'record.read', "Read record 7")
+    assert (first['record_id'], first['bytes'], first['duration_ms']) == (7, 1024, 1.5)
+    # The event name stands in for a missing message
+    assert (second['level'], second['message'], second['patient_id']) == ('WARNING', 'auth.failed', None)
+    assert third['record_id'] == 8
+    assert 'ValueError: bad tag' in third['error'] and '\n' not in lines[2]
+
+
+def test_json_fields_that_are_not_json_types_are_written_as_text():
+    stream = io.StringIO()
+    configure_logging(JSON, stream=stream)
+    log_event(get_logger('test'), 'test.event', day=datetime.date(2025, 3, 1), data=b'x')
+    entry = json.loads(stream.getvalue())
+    assert (entry['day'], entry['data']) == ('2025-03-01', "b'x'")
+
+
+def test_levels_below_the_configured_one_are_dropped():
+    stream = io.StringIO()
+    configure_logging(CONSOLE, logging.WARNING, stream)
+    logger = get_logger('test')
+    log_event(logger, 'test.info', "not shown")
+    log_event(logger, 'test.warning', "shown", logging.WARNING, record_id=1)
+    assert stream.getvalue() == "shown\n"
+
+
+def test_silent_mode_removes_earlier_handlers():
+    stream = io.StringIO()
+    configure_logging(CONSOLE, stream=stream)
+    configure_logging(SILENT)
+    log_event(get_logger('test'), 'test.error', "not shown", logging.ERROR)
+    assert stream.getvalue() == ''
+    with pytest.raises(ValueError):
+        configure_logging('verbose')
+
+
+# The bulk ingest tool with one file for a patient that doesn't exist
+@pytest.mark.parametrize('mode', [SILENT, CONSOLE, JSON])
+def test_log_option(tmp_path, mode):
+    incoming = tmp_path / 'incoming' / '42' / 'lab'
+    incoming.mkdir(parents=True)
+    (incoming / 'report.txt').write_text('results')
+    result = subprocess.run([sys.executable, os.path.join(PROJECT_DIR, 'bulk_ingest.py'),
+                             '--directory', 'incoming', '--log', mode],
+                            cwd=tmp_path, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    assert "0 of 1 files encrypted" in result.stdout
+
+    if mode == SILENT:
+        assert result.stderr == ''
+    elif mode == CONSOLE:
+        assert result.stderr.splitlines()[-1] == "0 of 1 files encrypted"
+    else:
+        entries = [json.loads(line) for line in result.stderr.splitlines()]
+        finished = [entry for entry in entries if entry['event'] == 'ingest.finished']
+        assert len(finished) == 1
+        assert (finished[0]['files'], finished[0]['encrypted'], finished[0]['failed']) == (1, 0, 1)
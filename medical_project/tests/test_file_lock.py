@@ -0,0 +1,98 @@
+# Tests for file_lock.py: reentrancy per lock file and id allocation across processes
+
+import json
+import multiprocessing
+import os
+import threading
+
+from file_lock import FileLock, IdAllocator
+from storage import JsonKeyStore
+
+
+# Runs function on a thread and reports whether it finished within the timeout
+def finishes(function, timeout=5):
+    thread = threading.Thread(target=function, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive()
+
+
+def test_locks_on_the_same_path_are_reentrant_together(tmp_path):
+    path = str(tmp_path / 'store.lock')
+    first = FileLock(path)
+    # Same file, reached through a different spelling of the path
+    second = FileLock(os.path.join(str(tmp_path), '.', 'store.lock'))
+
+    def nested():
+        with first:
+            with second:
+                with first:
+                    pass
+
+    assert finishes(nested)
+
+
+def test_two_stores_on_the_same_files_can_nest(tmp_path):
+    keys_path = str(tmp_path / 'keys.json')
+    one = JsonKeyStore(keys_path)
+    other = JsonKeyStore(keys_path)
+
+    def nested():
+        with one.locked():
+            other.allocate_record_id()
+
+    assert finishes(nested)
+
+
+def test_other_threads_still_wait_for_the_lock(tmp_path):
+    path = str(tmp_path / 'store.lock')
+    entered = threading.Event()
+
+    def take():
+        with FileLock(path):
+            entered.set()
+
+    with FileLock(path):
+        thread = threading.Thread(target=take, daemon=True)
+        thread.start()
+        assert not entered.wait(0.2)
+    assert entered.wait(5)
+    thread.join()
+
+
+def test_counter_is_replaced_atomically(tmp_path):
+    counter_path = str(tmp_path / 'keys.json.ids')
+    allocator = IdAllocator(counter_path, FileLock(counter_path + '.lock'), block_size=10)
+    assert allocator.allocate() == 1
+    assert allocator.allocate(minimum=50) == 50
+
+    with open(counter_path) as f:
+        assert json.load(f) == {'next': 60}
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+    # A fresh process (a new allocator) continues after every reserved block
+    restarted = IdAllocator(counter_path, FileLock(counter_path + '.lock'), block_size=10)
+    assert restarted.allocate() == 60
+
+
+# Allocates ids in a separate process and sends them back
+def allocate_ids(counter_path, count, block_size, results):
+    allocator = IdAllocator(counter_path, FileLock(counter_path + '.lock'), block_size)
+    results.put([allocator.allocate() for _ in range(count)])
+
+
+def test_processes_never_get_the_same_id(tmp_path):
+    counter_path = str(tmp_path / 'keys.json.ids')
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    workers = [context.Process(target=allocate_ids, args=(counter_path, 50, block_size, results))
+               for block_size in (1, 3, 7, 1)]
+    for worker in workers:
+        worker.start()
+    ids = [allocated for _ in workers for allocated in results.get(timeout=60)]
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    assert len(ids) == 200
+    assert len(set(ids)) == 200
@@ -0,0 +1,292 @@
+# Tests for http_service.py: staff endpoints stay closed without a staff key, uploads are
+# streamed into a RecordWriter, and downloads honour Range headers and stop with the client
+
+import asyncio
+import json
+import os
+
+import pytest
+
+from conftest import add_patient, open_system
+from http_service import UPLOAD_PIECE_SIZE, MedicalRecordService, run_service
+from main_system import MedicalRecordSystem
+
+NEW_PATIENT = {'ssn': '123-45-6789', 'name': 'Test Patient', 'email': 'test@example.com',
+               'password': 'correct horse'}
+
+
+# Sends one request to a running service, returns (status, parsed JSON body)
+async def send(port, method, path, body=None, headers=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    payload = json.dumps(body).encode() if body is not None else b''
+    lines = [f"{method} {path} HTTP/1.1", 'Host: localhost', f"Content-Length: {len(payload)}",
+             'Connection: close']
+    lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + payload)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, content = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(content or b'null')
+
+
+# Starts a service for one test, runs requests against it and returns their results
+def run_requests(tmp_path, monkeypatch, staff_key, requests):
+    monkeypatch.chdir(tmp_path)
+
+    async def scenario():
+        service = MedicalRecordService(MedicalRecordSystem(blob_root=str(tmp_path / 'blobs')), staff_key)
+        server = await service.start('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return [await send(port, *request) for request in requests]
+        finally:
+            service.housekeeping_task.cancel()
+            server.close()
+            await server.wait_closed()
+
+    return asyncio.run(scenario())
+
+
+def test_staff_endpoints_are_closed_without_a_staff_key(tmp_path, monkeypatch):
+    results = run_requests(tmp_path, monkeypatch, None, [
+        ('POST', '/patients', NEW_PATIENT),
+        ('POST', '/patients', NEW_PATIENT, {'X-Staff-Key': ''}),
+        ('GET', '/metrics'),
+    ])
+    assert [status for status, body in results] == [403, 403, 403]
+
+
+def test_staff_key_is_checked(tmp_path, monkeypatch):
+    results = run_requests(tmp_path, monkeypatch, 'staff secret', [
+        ('POST', '/patients', NEW_PATIENT),
+        ('POST', '/patients', NEW_PATIENT, {'X-Staff-Key': 'wrong'}),
+        # With the right key the request gets as far as checking its fields
+        ('POST', '/patients', {}, {'X-Staff-Key': 'staff secret'}),
+        ('GET', '/metrics?format=json', None, {'X-Staff-Key': 'staff secret'}),
+    ])
+    assert [status for status, body in results] == [403, 403, 400, 200]
+
+
+def test_run_service_refuses_to_start_without_a_staff_key():
+    with pytest.raises(ValueError):
+        run_service(system=None, staff_key=None)
+
+
+def test_register_and_login_with_the_staff_key(tmp_path, monkeypatch):
+    staff = {'X-Staff-Key': 'staff secret'}
+    results = run_requests(tmp_path, monkeypatch, 'staff secret', [
+        ('POST', '/patients', NEW_PATIENT, staff),
+        ('POST', '/patients', NEW_PATIENT, staff),
+    ])
+    assert [status for status, body in results] == [201, 409]
+    pin = results[0][1]['pin']
+
+    login = {'ssn': NEW_PATIENT['ssn'], 'pin': pin, 'password': NEW_PATIENT['password']}
+    status, body = run_requests(tmp_path, monkeypatch, 'staff secret', [('POST', '/login', login)])[0]
+    assert status == 200 and body['token']
+
+
+# Sends a request head and then the body in pieces, returns (status, headers, body bytes)
+async def send_raw(port, method, path, headers, body_pieces=()):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    lines = [f"{method} {path} HTTP/1.1", 'Host: localhost', 'Connection: close']
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+    for piece in body_pieces:
+        writer.write(piece)
+        await writer.drain()
+        await asyncio.sleep(0.01)
+    response = await reader.read()
+    writer.close()
+    head, _, content = response.partition(b'\r\n\r\n')
+    head_lines = head.decode('latin-1').split('\r\n')
+    response_headers = dict(line.split(': ', 1) for line in head_lines[1:])
+    return int(head_lines[0].split()[1]), response_headers, content
+
+
+# Runs scenario(service, port) against a service on a system with one patient
+def run_scenario(tmp_path, monkeypatch, scenario):
+    monkeypatch.chdir(tmp_path)
+    system = open_system(tmp_path)
+    add_patient(system)
+
+    async def main():
+        service = MedicalRecordService(system, 'staff secret')
+        server = await service.start('127.0.0.1', 0)
+        try:
+            return await scenario(service, server.sockets[0].getsockname()[1])
+        finally:
+            service.housekeeping_task.cancel()
+            server.close()
+            await server.wait_closed()
+
+    try:
+        return system, asyncio.run(main())
+    finally:
+        system.authenticator.hasher.shutdown()
+
+
+def upload_headers(length, staff_key='staff secret'):
+    return {'Content-Length': length, 'X-Staff-Key': staff_key}
+
+
+def test_upload_is_streamed_through_a_record_writer(tmp_path, monkeypatch):
+    data = os.urandom(2 * UPLOAD_PIECE_SIZE + 1000)
+    writes = []
+
+    async def scenario(service, port):
+        encryptor = service.system.encryptor
+        open_record_writer = encryptor.open_record_writer
+
+        def counting_record_writer(*args):
+            record_writer = open_record_writer(*args)
+            write = record_writer.write
+            record_writer.write = lambda piece: writes.append(len(piece)) or write(piece)
+            return record_writer
+
+        monkeypatch.setattr(encryptor, 'open_record_writer', counting_record_writer)
+        pieces = [data[i:i + 100000] for i in range(0, len(data), 100000)]
+        return await send_raw(port, 'POST', '/patients/1/records?record_type=scan&filename=../scan.bin',
+                              upload_headers(len(data)), pieces)
+
+    system, (status, headers, content) = run_scenario(tmp_path, monkeypatch, scenario)
+    body = json.loads(content)
+    assert status == 201
+    assert body['file_size'] == len(data)
+    # Read and encrypted a piece at a time as the body arrived
+    assert writes == [UPLOAD_PIECE_SIZE, UPLOAD_PIECE_SIZE, 1000]
+    record_info = system.encryptor.store[body['record_id']]
+    assert (record_info['patient_id'], record_info['record_type'], record_info['original_filename']) == \
+        (1, 'scan', 'scan.bin')
+    assert system.encryptor.read_record(body['record_id']) == data
+
+
+def test_upload_refusals(tmp_path, monkeypatch):
+    async def scenario(service, port):
+        service.max_upload_bytes = 10
+        return [
+            await send_raw(port, 'POST', '/patients/1/records?record_type=lab', upload_headers(5, 'wrong'), [b'x' * 5]),
+            await send_raw(port, 'POST', '/patients/1/records', upload_headers(5), [b'x' * 5]),
+            await send_raw(port, 'POST', '/patients/1/records?record_type=lab', {'X-Staff-Key': 'staff secret'}),
+            await send_raw(port, 'POST', '/patients/1/records?record_type=lab', upload_headers(11), [b'x' * 11]),
+            await send_raw(port, 'POST', '/patients/99/records?record_type=lab', upload_headers(5), [b'x' * 5]),
+        ]
+
+    system, results = run_scenario(tmp_path, monkeypatch, scenario)
+    assert [status for status, headers, content in results] == [403, 400, 411, 413, 404]
+    assert len(system.encryptor.store) == 0
+
+
+def test_upload_cut_off_part_way_leaves_nothing(tmp_path, monkeypatch):
+    aborted = []
+
+    async def scenario(service, port):
+        encryptor = service.system.encryptor
+        open_record_writer = encryptor.open_record_writer
+
+        def watched_record_writer(*args):
+            record_writer = open_record_writer(*args)
+            abort = record_writer.abort
+            record_writer.abort = lambda: aborted.append(record_writer.encrypted_filename) or abort()
+            return record_writer
+
+        monkeypatch.setattr(encryptor, 'open_record_writer', watched_record_writer)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'POST /patients/1/records?record_type=lab HTTP/1.1\r\nX-Staff-Key: staff secret\r\n'
+                     b'Content-Length: 1000\r\n\r\n' + b'x' * 100)
+        await writer.drain()
+        await asyncio.sleep(0.1)
+        writer.close()
+        for _ in range(100):
+            if aborted:
+                break
+            await asyncio.sleep(0.05)
+
+    system, _ = run_scenario(tmp_path, monkeypatch, scenario)
+    assert len(aborted) == 1
+    assert len(system.encryptor.store) == 0
+    assert not [path for path in (tmp_path / 'blobs').rglob('*') if path.is_file()]
+
+
+def test_range_requests(tmp_path, monkeypatch):
+    data = os.urandom(3000)
+
+    async def scenario(service, port):
+        system = service.system
+        system.encryptor.chunk_size = 256
+        source = tmp_path / 'scan.bin'
+        source.write_bytes(data)
+        record_id = system.encryptor.encrypt_file(str(source), 1, 'scan')['record_id']
+        other_record_id = system.encryptor.encrypt_file(str(source), 2, 'scan')['record_id']
+        token = system.sessions.create_session(1)
+        auth = {'Authorization': f"Bearer {token}"}
+        path = f"/records/{record_id}"
+        return [await send_raw(port, 'GET', path, dict(auth, **extra)) for extra in [
+            {},
+            {'Range': 'bytes=100-299'},
+            {'Range': 'bytes=-50'},
+            {'Range': 'bytes=2990-5000'},
+            {'Range': 'bytes=256-511'},
+            {'Range': 'bytes=3000-'},
+            {'Range': 'bytes=5-3'},
+        ]] + [
+            await send_raw(port, 'GET', f"/records/{other_record_id}", auth),
+            await send_raw(port, 'GET', path, {'Range': 'bytes=0-9'}),
+        ]
+
+    system, results = run_scenario(tmp_path, monkeypatch, scenario)
+    whole, middle, suffix, past_the_end, one_chunk, unsatisfiable, ignored, not_mine, no_session = results
+
+    assert (whole[0], whole[2]) == (200, data)
+    assert (whole[1]['Accept-Ranges'], whole[1]['Content-Length']) == ('bytes', '3000')
+    assert 'Content-Range' not in whole[1]
+    assert whole[1]['Content-Disposition'] == 'attachment; filename="scan.bin"'
+
+    for (status, headers, content), (start, end) in [(middle, (100, 300)), (suffix, (2950, 3000)),
+                                                     (past_the_end, (2990, 3000)), (one_chunk, (256, 512))]:
+        assert status == 206
+        assert headers['Content-Range'] == f"bytes {start}-{end - 1}/3000"
+        assert headers['Content-Length'] == str(end - start)
+        assert content == data[start:end]
+
+    status, headers, content = unsatisfiable
+    assert (status, headers['Content-Range'], json.loads(content)) == \
+        (416, 'bytes */3000', {'error': "Range not satisfiable"})
+    # A range we don't serve gets the whole record
+    assert (ignored[0], ignored[2]) == (200, data)
+    assert [not_mine[0], no_session[0]] == [404, 401]
+
+
+def test_client_going_away_closes_the_record_stream(tmp_path, monkeypatch):
+    closed = []
+
+    # Never runs out, so only the client going away ends the response
+    def endless_chunks(record_id, start=0, end=None):
+        try:
+            while True:
+                yield bytes(64 * 1024)
+        finally:
+            closed.append(record_id)
+
+    async def scenario(service, port):
+        system = service.system
+        source = tmp_path / 'scan.bin'
+        source.write_bytes(bytes(100))
+        record_id = system.encryptor.encrypt_file(str(source), 1, 'scan')['record_id']
+        monkeypatch.setattr(system.encryptor, 'iter_record_chunks', endless_chunks)
+        token = system.sessions.create_session(1)
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f"GET /records/{record_id} HTTP/1.1\r\nAuthorization: Bearer {token}\r\n\r\n".encode())
+        await writer.drain()
+        assert (await reader.readuntil(b'\r\n\r\n')).startswith(b'HTTP/1.1 200')
+        await reader.readexactly(1000)
+        writer.close()
+        for _ in range(100):
+            if closed:
+                return record_id
+            await asyncio.sleep(0.05)
+
+    system, record_id = run_scenario(tmp_path, monkeypatch, scenario)
+    assert closed == [record_id]
@@ -0,0 +1,125 @@
+# Tests for key_journal.py: replay, compaction and recovery from a torn append
+
+import pytest
+
+from key_journal import KeyJournal
+from storage import JsonKeyStore
+
+
+# A key store entry with just the fields the store indexes
+def make_record(record_id, patient_id=1):
+    return {
+        'record_id': record_id,
+        'patient_id': patient_id,
+        'record_type': 'blood_test',
+        'original_filename': f"report_{record_id}.txt",
+        'encrypted_filename': f"blobs/{record_id}.enc",
+        'created_at': '2026-01-01 12:00:00',
+        'file_size': 10,
+    }
+
+
+# Simulates a crash part way through an append
+def tear_append(journal_path):
+    with open(journal_path, 'ab') as f:
+        f.write(b'{"op": "put", "record": {"record_')
+
+
+def open_store(keys_path):
+    store = JsonKeyStore(keys_path)
+    store.load()
+    return store
+
+# A store on a path with no files yet (load raises until something is written)
+def open_store_or_new(keys_path):
+    store = JsonKeyStore(keys_path)
+    try:
+        store.load()
+    except FileNotFoundError:
+        pass
+    return store
+
+
+def test_replay_applies_puts_and_deletes(tmp_path):
+    journal = KeyJournal(str(tmp_path / 'keys.json'))
+    journal.append_put(make_record(1))
+    journal.append_put(make_record(2))
+    journal.append_delete(1)
+    journal.close()
+
+    records = KeyJournal(str(tmp_path / 'keys.json')).load()
+    assert list(records) == [2]
+    assert records[2]['original_filename'] == 'report_2.txt'
+
+
+def test_compaction_keeps_records_and_empties_journal(tmp_path):
+    keys_path = str(tmp_path / 'keys.json')
+    journal = KeyJournal(keys_path)
+    records = {}
+    for record_id in range(1, 4):
+        records[record_id] = make_record(record_id)
+        journal.append_put(records[record_id])
+    journal.compact(records)
+    journal.append_put(make_record(4))
+    journal.close()
+
+    with open(keys_path + '.journal') as f:
+        assert len(f.readlines()) == 1
+    assert sorted(KeyJournal(keys_path).load()) == [1, 2, 3, 4]
+
+
+def test_missing_files_raise(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        KeyJournal(str(tmp_path / 'keys.json')).load()
+
+
+def test_torn_last_line_is_dropped_and_cut_off(tmp_path):
+    keys_path = str(tmp_path / 'keys.json')
+    store = open_store_or_new(keys_path)
+    store.put(make_record(1))
+    store.close()
+    tear_append(keys_path + '.journal')
+
+    store = open_store(keys_path)
+    assert sorted(store) == [1]
+    with open(keys_path + '.journal', 'rb') as f:
+        assert f.read().endswith(b'}\n')
+    store.close()
+
+
+def test_appends_after_a_torn_line_survive_reloads(tmp_path):
+    keys_path = str(tmp_path / 'keys.json')
+    store = open_store_or_new(keys_path)
+    store.put(make_record(1))
+    store.close()
+    tear_append(keys_path + '.journal')
+
+    # Each acknowledged put has to be there after every later reload
+    for record_id in (2, 3):
+        store = open_store(keys_path)
+        store.put(make_record(record_id))
+        store.close()
+        assert sorted(open_store(keys_path)) == list(range(1, record_id + 1))
+
+
+def test_torn_line_from_another_process_is_dropped_on_refresh(tmp_path):
+    keys_path = str(tmp_path / 'keys.json')
+    writer = open_store_or_new(keys_path)
+    writer.put(make_record(1))
+    reader = open_store(keys_path)
+
+    tear_append(keys_path + '.journal')
+    reader.refresh()
+    assert sorted(reader) == [1]
+
+    writer.put(make_record(2))
+    assert sorted(reader) == [1, 2]
+    assert sorted(open_store(keys_path)) == [1, 2]
+
+
+def test_corrupt_line_before_the_end_is_an_error(tmp_path):
+    keys_path = str(tmp_path / 'keys.json')
+    with open(keys_path + '.journal', 'wb') as f:
+        f.write(b'not json\n{"op": "delete", "record_id": 1}\n')
+    with pytest.raises(ValueError):
+        KeyJournal(keys_path).load()
@@ -0,0 +1,126 @@
+# Tests for key_wrapping.py and key_rotation.py: wrapping legacy plaintext keys on load, and
+# carrying on with an interrupted master key rotation
+
+import glob
+import os
+
+import pytest
+
+from encryption import MedicalFileEncryptor
+from key_rotation import checkpoint_path_for, read_checkpoint, rotate_master_key
+from key_wrapping import MasterKeyStore
+from metrics import MetricsRegistry
+from storage import SQLiteKeyStore
+
+
+def make_encryptor(tmp_path, store=None):
+    return MedicalFileEncryptor(keys_path=str(tmp_path / 'encryption_keys.json'), store=store,
+                                metrics=MetricsRegistry(),
+                                master_keys=MasterKeyStore(str(tmp_path / 'master_keys.json')),
+                                blob_root=str(tmp_path / 'blobs'))
+
+
+def sqlite_store(tmp_path):
+    return SQLiteKeyStore(str(tmp_path / 'keys.db'))
+
+
+# Encrypts a few small files, returns {record_id: contents}
+def add_records(encryptor, tmp_path, count):
+    contents = {}
+    for i in range(count):
+        path = tmp_path / f"record{i}.txt"
+        path.write_bytes(f"record {i} ".encode() * 100)
+        record_info = encryptor.encrypt_file(str(path), patient_id=1, record_type='notes')
+        contents[record_info['record_id']] = path.read_bytes()
+    return contents
+
+
+# Turns stored records back into the pre-envelope form with a plaintext 'encryption_key'
+# and writes them to disk that way, returns the plaintext keys
+def make_legacy(encryptor, record_ids):
+    keys = []
+    for record_id in record_ids:
+        record_info = dict(encryptor.key_storage[record_id])
+        data_key = encryptor.envelope.data_key(record_info)
+        del record_info['wrapped_key'], record_info['kek_id']
+        record_info['encryption_key'] = data_key.decode()
+        encryptor.store.put(record_info)
+        keys.append(data_key)
+    encryptor.store.save()
+    return keys
+
+
+# Everything the key store has on disk (snapshot and journal, or database and its log)
+def stored_bytes(tmp_path):
+    data = b''
+    for path in glob.glob(str(tmp_path / 'encryption_keys.json*')) + glob.glob(str(tmp_path / 'keys.db*')):
+        with open(path, 'rb') as f:
+            data += f.read()
+    return data
+
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite'])
+def test_legacy_keys_are_wrapped_on_load(tmp_path, backend):
+    store = sqlite_store(tmp_path) if backend == 'sqlite' else None
+    encryptor = make_encryptor(tmp_path, store)
+    contents = add_records(encryptor, tmp_path, 3)
+    legacy_keys = make_legacy(encryptor, list(contents)[:2])
+    assert all(key in stored_bytes(tmp_path) for key in legacy_keys)
+    encryptor.store.close()
+
+    store = sqlite_store(tmp_path) if backend == 'sqlite' else None
+    loaded = make_encryptor(tmp_path, store)
+    for record_id, data in contents.items():
+        record_info = loaded.key_storage[record_id]
+        assert 'encryption_key' not in record_info
+        assert loaded.envelope.is_current(record_info)
+        assert loaded.read_record(record_id) == data
+    assert not any(key in stored_bytes(tmp_path) for key in legacy_keys)
+    assert loaded.wrap_legacy_keys() == 0
+
+
+def test_wrapped_legacy_keys_survive_another_reload(tmp_path):
+    encryptor = make_encryptor(tmp_path)
+    contents = add_records(encryptor, tmp_path, 2)
+    make_legacy(encryptor, contents)
+
+    make_encryptor(tmp_path)
+    reloaded = make_encryptor(tmp_path)
+    assert reloaded.store.records_with_plaintext_key() == []
+    for record_id, data in contents.items():
+        assert reloaded.read_record(record_id) == data
+
+
+# Stops a rotation by failing from its progress callback after the first batch
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after_first_batch(done, total):
+    raise Interrupted()
+
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite'])
+def test_interrupted_rotation_resumes_with_the_same_key(tmp_path, backend):
+    store = sqlite_store(tmp_path) if backend == 'sqlite' else None
+    encryptor = make_encryptor(tmp_path, store)
+    contents = add_records(encryptor, tmp_path, 5)
+    old_kek_id = encryptor.envelope.master_keys.active_kek_id
+
+    with pytest.raises(Interrupted):
+        rotate_master_key(encryptor, workers=2, batch_size=2, progress=interrupt_after_first_batch)
+    checkpoint = read_checkpoint(checkpoint_path_for(encryptor.envelope.master_keys))
+    target = checkpoint['target_kek_id']
+    assert target != old_kek_id
+    assert checkpoint['rewrapped'] == 2
+
+    report = rotate_master_key(encryptor, workers=2, batch_size=2)
+    assert report['resumed']
+    assert report['target_kek_id'] == target
+    assert report['records'] == 3
+    assert report['rewrapped'] == 3
+    assert report['failed'] == {}
+    assert not os.path.exists(checkpoint_path_for(encryptor.envelope.master_keys))
+    for record_id, data in contents.items():
+        assert encryptor.key_storage[record_id]['kek_id'] == target
+        assert encryptor.read_record(record_id) == data
@@ -0,0 +1,185 @@
+# Tests for metrics.py: the Prometheus text and JSON exports, histogram quantiles and the
+# profiling hook (including one that fails, and slow_call_hook)
+
+import json
+import logging
+
+import pytest
+
+from encryption import MedicalFileEncryptor
+from key_wrapping import MasterKeyStore
+from metrics import Histogram, MetricsRegistry, slow_call_hook
+
+BUCKETS = (0.01, 0.1, 1.0)
+
+
+@pytest.fixture
+def metrics():
+    metrics = MetricsRegistry(BUCKETS)
+    metrics.increment('bytes_encrypted', 100)
+    metrics.increment('bytes_encrypted', 23)
+    metrics.increment('logins_failed')
+    for seconds in (0.005, 0.01, 0.05, 0.5, 3.0):
+        metrics.record_call('file_encrypt', seconds)
+    metrics.record_call('keys_save', 0.02)
+    metrics.register_collector('cache', lambda: {'entries': 3, 'hit_ratio': 0.75, 'enabled': True, 'name': 'x'})
+    return metrics
+
+
+# Parses the sample lines of Prometheus text into {name{labels}: value}, checking each has a TYPE line
+def parse_prometheus(text):
+    assert text.endswith('\n')
+    samples = {}
+    types = {}
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            name, metric_type = line[len('# TYPE '):].split(' ')
+            types[name] = metric_type
+            continue
+        name, value = line.rsplit(' ', 1)
+        base = name.split('{')[0]
+        assert any(base == family or base.startswith(family + '_') for family in types), line
+        samples[name] = float(value)
+    return types, samples
+
+
+def test_prometheus_export(metrics):
+    types, samples = parse_prometheus(metrics.to_prometheus())
+    assert types == {
+        'medical_bytes_encrypted_total': 'counter',
+        'medical_logins_failed_total': 'counter',
+        'medical_stage_duration_seconds': 'histogram',
+        'medical_cache_entries': 'gauge',
+        'medical_cache_hit_ratio': 'gauge',
+    }
+    assert samples['medical_bytes_encrypted_total'] == 123
+    assert samples['medical_logins_failed_total'] == 1
+
+    # Buckets are cumulative and end with +Inf holding every call
+    metric = 'medical_stage_duration_seconds'
+    assert [samples[f'{metric}_bucket{{stage="file_encrypt",le="{bound}"}}'] for bound in BUCKETS + ('+Inf',)] == \
+        [2, 3, 4, 5]
+    assert samples[f'{metric}_count{{stage="file_encrypt"}}'] == 5
+    assert samples[f'{metric}_sum{{stage="file_encrypt"}}'] == pytest.approx(3.565)
+    assert samples[f'{metric}_count{{stage="keys_save"}}'] == 1
+
+    # Only numbers come from collectors; flags and text are left out
+    assert samples['medical_cache_entries'] == 3
+    assert samples['medical_cache_hit_ratio'] == 0.75
+
+
+def test_empty_registry_exports_nothing():
+    metrics = MetricsRegistry()
+    assert metrics.to_prometheus() == '\n'
+    assert json.loads(metrics.to_json()) == {'counters': {}, 'timers': {}, 'gauges': {}}
+
+
+def test_json_export(metrics):
+    snapshot = json.loads(metrics.to_json())
+    assert snapshot == metrics.snapshot()
+    assert snapshot['counters'] == {'bytes_encrypted': 123, 'logins_failed': 1}
+    assert snapshot['gauges'] == {'cache_entries': 3, 'cache_hit_ratio': 0.75}
+    assert snapshot['timers']['file_encrypt'] == {
+        'count': 5,
+        'sum_seconds': 3.565,
+        'mean_seconds': 0.713,
+        'p50_seconds': 0.1,
+        'p95_seconds': 3.0,
+        'p99_seconds': 3.0,
+        'max_seconds': 3.0,
+    }
+
+
+def test_failing_collector_is_skipped(metrics):
+    metrics.register_collector('broken', lambda: 1 / 0)
+    assert 'broken' not in metrics.to_prometheus()
+    assert set(metrics.snapshot()['gauges']) == {'cache_entries', 'cache_hit_ratio'}
+
+
+def test_reset_keeps_collectors_and_hook(metrics):
+    hook = lambda stage, seconds, fields: None
+    metrics.set_profile_hook(hook)
+    metrics.reset()
+    snapshot = metrics.snapshot()
+    assert (snapshot['counters'], snapshot['timers']) == ({}, {})
+    assert snapshot['gauges'] and metrics.profile_hook is hook
+
+
+def test_histogram_quantiles():
+    histogram = Histogram(BUCKETS)
+    assert histogram.quantile(0.5) == 0.0
+    for seconds in [0.001] * 90 + [0.5] * 9 + [7.0]:
+        histogram.observe(seconds)
+    assert histogram.quantile(0.5) == 0.01
+    assert histogram.quantile(0.95) == 1.0
+    assert histogram.quantile(1.0) == 7.0
+    # A bucket's bound is never reported above the largest value seen
+    small = Histogram(BUCKETS)
+    small.observe(0.2)
+    assert small.quantile(0.5) == 0.2
+
+
+def test_profile_hook_gets_every_timed_stage():
+    metrics = MetricsRegistry()
+    calls = []
+    metrics.set_profile_hook(lambda stage, seconds, fields: calls.append((stage, seconds, fields)))
+    with metrics.timer('file_encrypt', record_id=7) as fields:
+        fields['bytes'] = 1024
+    metrics.record_call('keys_load', 0.25, records=3)
+    assert [(stage, fields) for stage, seconds, fields in calls] == \
+        [('file_encrypt', {'record_id': 7, 'bytes': 1024}), ('keys_load', {'records': 3})]
+    assert calls[0][1] >= 0 and calls[1][1] == 0.25
+
+    metrics.set_profile_hook(None)
+    metrics.record_call('keys_load', 0.25)
+    assert len(calls) == 2
+    assert metrics.snapshot()['timers']['keys_load']['count'] == 2
+
+
+def test_timer_records_a_call_that_raises():
+    metrics = MetricsRegistry()
+    with pytest.raises(KeyError):
+        with metrics.timer('key_store_write'):
+            raise KeyError(1)
+    assert metrics.snapshot()['timers']['key_store_write']['count'] == 1
+
+
+def test_failing_hook_never_breaks_the_call(caplog):
+    metrics = MetricsRegistry()
+    metrics.set_profile_hook(lambda stage, seconds, fields: 1 / 0)
+    with caplog.at_level(logging.ERROR, logger='medical.metrics'):
+        with metrics.timer('file_encrypt'):
+            pass
+    assert metrics.snapshot()['timers']['file_encrypt']['count'] == 1
+    assert [record.event for record in caplog.records] == ['metrics.hook_failed']
+    assert caplog.records[0].fields == {'stage': 'file_encrypt', 'error': 'ZeroDivisionError'}
+
+
+def test_slow_call_hook_logs_only_slow_stages(caplog):
+    hook = slow_call_hook(threshold_ms=100)
+    with caplog.at_level(logging.WARNING, logger='medical.metrics'):
+        hook('file_encrypt', 0.05, {'record_id': 1})
+        hook('file_encrypt', 0.25, {'record_id': 2, 'bytes': 10})
+    assert len(caplog.records) == 1
+    record = caplog.records[0]
+    assert (record.event, record.getMessage()) == ('profile.slow_call', "Slow file_encrypt: 250.0 ms")
+    assert record.fields == {'stage': 'file_encrypt', 'duration_ms': 250.0, 'record_id': 2, 'bytes': 10}
+
+
+# The hook sees the encryptor's stages with their ids and sizes, never the file's contents
+def test_profile_hook_on_a_real_encryption(tmp_path):
+    metrics = MetricsRegistry()
+    calls = []
+    metrics.set_profile_hook(lambda stage, seconds, fields: calls.append((stage, dict(fields))))
+    encryptor = MedicalFileEncryptor(keys_path=str(tmp_path / 'encryption_keys.json'), metrics=metrics,
+                                     master_keys=MasterKeyStore(str(tmp_path / 'master_keys.json')),
+                                     blob_root=str(tmp_path / 'blobs'))
+    source = tmp_path / 'report.txt'
+    source.write_bytes(b'secret results')
+    record_id = encryptor.encrypt_file(str(source), patient_id=4, record_type='lab')['record_id']
+
+    stages = dict(calls)
+    assert stages['file_encrypt'] == {'patient_id': 4, 'bytes': 14}
+    assert stages['key_store_write'] == {'record_id': record_id}
+    assert 'secret results' not in repr(calls)
+    assert metrics.snapshot()['counters']['bytes_encrypted'] == 14
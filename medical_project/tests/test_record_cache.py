@@ -0,0 +1,66 @@
+# Tests for record_cache.py: TTL sweeping and zeroizing of expired plaintext
+
+from record_cache import DecryptedRecordCache
+
+
+# A clock the tests move by hand
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_expired_records_are_swept_and_zeroized_by_other_calls():
+    clock = FakeClock()
+    cache = DecryptedRecordCache(ttl_seconds=60, clock=clock)
+    cache.put(1, 7, b'patient data')
+    buffer = cache.entries[1][0]
+
+    clock.now += 61
+    # Looking at the counters, not the expired record itself, is enough to drop it
+    stats = cache.stats()
+    assert stats['entries'] == 0 and stats['bytes'] == 0 and stats['expirations'] == 1
+    assert buffer == bytearray(len(b'patient data'))
+    assert cache.patient_records == {}
+
+
+def test_put_and_get_sweep_other_expired_records():
+    clock = FakeClock()
+    cache = DecryptedRecordCache(ttl_seconds=60, clock=clock)
+    cache.put(1, 7, b'first')
+    clock.now += 30
+    cache.put(2, 7, b'second')
+
+    clock.now += 31
+    cache.put(3, 8, b'third')
+    assert list(cache.entries) == [2, 3]
+    clock.now += 30
+    assert cache.get(3) == b'third'
+    assert list(cache.entries) == [3]
+
+
+def test_caching_again_restarts_the_ttl():
+    clock = FakeClock()
+    cache = DecryptedRecordCache(ttl_seconds=60, clock=clock)
+    cache.put(1, 7, b'old')
+    clock.now += 50
+    cache.put(1, 7, b'new')
+
+    clock.now += 20
+    assert cache.purge_expired() == 0
+    assert cache.get(1) == b'new'
+    clock.now += 40
+    assert cache.get(1) is None
+    assert cache.stats()['expirations'] == 1
+
+
+def test_least_recently_used_record_is_evicted_when_full():
+    cache = DecryptedRecordCache(max_bytes=10, clock=FakeClock())
+    cache.put(1, 7, b'aaaa')
+    cache.put(2, 7, b'bbbb')
+    cache.get(1)
+    cache.put(3, 7, b'cccc')
+    assert sorted(cache.entries) == [1, 3]
+    assert cache.stats()['evictions'] == 1
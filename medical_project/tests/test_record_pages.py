@@ -0,0 +1,113 @@
+# Tests for the paged record views in main_system.py: list_my_records, get_my_records_page and
+# iter_my_records count pages right, filter by record type and sort by created_at
+
+import pytest
+
+from conftest import add_patient
+
+# (file name, record type, created_at); out of creation order, with two records created the same second
+RECORDS = [
+    ('a.txt', 'lab', '2025-03-04 09:00:00'),
+    ('b.png', 'xray', '2025-03-01 09:00:00'),
+    ('c.txt', 'lab', '2025-03-06 09:00:00'),
+    ('d.txt', 'lab', '2025-03-02 09:00:00'),
+    ('e.png', 'xray', '2025-03-06 09:00:00'),
+    ('f.txt', 'note', '2025-03-05 09:00:00'),
+    ('g.txt', 'lab', '2025-03-03 09:00:00'),
+]
+
+
+@pytest.fixture
+def token(system, tmp_path):
+    patient_id, pin = add_patient(system, 1)
+    other_id, _ = add_patient(system, 2)
+    for owner, (file_name, record_type, created_at) in [(patient_id, record) for record in RECORDS] + \
+            [(other_id, ('other.txt', 'lab', '2025-03-07 09:00:00'))]:
+        source = tmp_path / file_name
+        source.write_text(f"contents of {file_name}")
+        record_info = system.encryptor.encrypt_file(str(source), owner, record_type)
+        system.encryptor.store.put(dict(record_info, created_at=created_at))
+    success, token, message = system.login_session('100-00-0001', pin, 'password')
+    assert success, message
+    return token
+
+
+# File names in the expected order: created_at, then record id for records created the same second
+def expected_names(newest_first=True, record_type=None):
+    records = [(created_at, i, file_name) for i, (file_name, r_type, created_at) in enumerate(RECORDS)
+               if record_type is None or r_type == record_type]
+    return [file_name for created_at, i, file_name in sorted(records, reverse=newest_first)]
+
+
+def page_names(page_info):
+    return [record['filename'] for record in page_info['records']]
+
+
+@pytest.mark.parametrize('newest_first', [True, False])
+def test_pages_split_the_sorted_records(system, token, newest_first):
+    names = []
+    for page in (1, 2, 3):
+        success, page_info, message = system.list_my_records(page, 3, newest_first, token=token)
+        assert success
+        assert (page_info['page'], page_info['page_size'], page_info['total'], page_info['pages']) == (page, 3, 7, 3)
+        assert message == f"Page {page} of 3 (7 record(s))"
+        names += page_names(page_info)
+    assert names == expected_names(newest_first)
+    # The last page holds the remainder
+    assert len(page_info['records']) == 1
+
+
+@pytest.mark.parametrize('page_size, pages', [(1, 7), (6, 2), (7, 1), (8, 1), (100, 1)])
+def test_page_count(system, token, page_size, pages):
+    success, page_info, message = system.list_my_records(1, page_size, token=token)
+    assert page_info['pages'] == pages
+    assert page_names(page_info) == expected_names()[:page_size]
+
+
+def test_page_past_the_end_is_empty(system, token):
+    success, page_info, message = system.list_my_records(4, 3, token=token)
+    assert success
+    assert (page_info['records'], page_info['total'], page_info['pages']) == ([], 7, 3)
+
+
+@pytest.mark.parametrize('page, page_size', [(0, 10), (-1, 10), (1, 0)])
+def test_bad_page_numbers_are_refused(system, token, page, page_size):
+    assert system.list_my_records(page, page_size, token=token) == \
+        (False, None, "Page and page size must be at least 1")
+
+
+@pytest.mark.parametrize('record_type', ['lab', 'xray', 'note', 'missing'])
+def test_record_type_filter(system, token, record_type):
+    success, page_info, message = system.list_my_records(1, 100, record_type=record_type, token=token)
+    assert page_names(page_info) == expected_names(record_type=record_type)
+    assert page_info['total'] == len(expected_names(record_type=record_type))
+    assert page_info['pages'] == (1 if page_info['total'] else 0)
+    assert all(record['record_type'] == record_type for record in page_info['records'])
+
+
+def test_records_page_decrypts_text_records_only(system, token):
+    success, page_info, message = system.get_my_records_page(1, 4, record_type=None, token=token)
+    assert success
+    assert page_names(page_info) == expected_names()[:4]
+    for record in page_info['records']:
+        if record['filename'].endswith('.txt'):
+            assert record['content'] == f"contents of {record['filename']}"
+        else:
+            assert record['content'] is None
+
+    success, page_info, message = system.get_my_records_page(2, 2, newest_first=False, record_type='lab',
+                                                             token=token)
+    assert [record['content'] for record in page_info['records']] == \
+        [f"contents of {file_name}" for file_name in expected_names(False, 'lab')[2:4]]
+
+
+@pytest.mark.parametrize('newest_first, record_type', [(True, None), (False, None), (True, 'lab'), (False, 'xray')])
+def test_iter_my_records_matches_the_pages(system, token, newest_first, record_type):
+    records = list(system.iter_my_records(newest_first, record_type, token=token))
+    assert [record['filename'] for record in records] == expected_names(newest_first, record_type)
+
+
+def test_views_need_a_session(system, token):
+    assert system.list_my_records(token='not a token')[0] is False
+    assert system.get_my_records_page(token='not a token')[0] is False
+    assert list(system.iter_my_records(token='not a token')) == []
@@ -0,0 +1,148 @@
+# Tests for scrub.py: shared (deduplicated) files are decrypted once per pass, and problems
+# carried over from an interrupted scrub are checked again when it resumes, and orphaned
+# files are found next to the blob store whatever the working directory
+
+import os
+import shutil
+
+import pytest
+
+import scrub
+from encryption import MedicalFileEncryptor
+from key_wrapping import MasterKeyStore
+from metrics import MetricsRegistry
+
+
+@pytest.fixture
+def encryptor(tmp_path):
+    return MedicalFileEncryptor(keys_path=str(tmp_path / 'encryption_keys.json'), metrics=MetricsRegistry(),
+                                master_keys=MasterKeyStore(str(tmp_path / 'master_keys.json')),
+                                dedup='global', blob_root=str(tmp_path / 'blobs'))
+
+
+# Counts the files scrub decrypts
+@pytest.fixture
+def decrypted(monkeypatch):
+    paths = []
+    verify_file = scrub.verify_file
+
+    def counting_verify_file(encrypted_filename, *args):
+        paths.append(encrypted_filename)
+        return verify_file(encrypted_filename, *args)
+
+    monkeypatch.setattr(scrub, 'verify_file', counting_verify_file)
+    return paths
+
+
+def add_record(encryptor, tmp_path, name, contents, patient_id=1):
+    path = tmp_path / name
+    path.write_bytes(contents)
+    return encryptor.encrypt_file(str(path), patient_id=patient_id, record_type='notes')
+
+
+def run_scrub(encryptor, tmp_path, **options):
+    return scrub.scrub(encryptor, workers=2, checkpoint_path=str(tmp_path / 'scrub_checkpoint.json'),
+                       orphan_min_age_seconds=0, **options)
+
+
+def test_shared_file_is_decrypted_once_per_pass(encryptor, tmp_path, decrypted):
+    shared = [add_record(encryptor, tmp_path, f"copy{i}.txt", b'same contents ' * 500, patient_id=i + 1)
+              for i in range(3)]
+    unique = add_record(encryptor, tmp_path, 'unique.txt', b'other contents ' * 500)
+    assert len({record_info['encrypted_filename'] for record_info in shared}) == 1
+
+    report = run_scrub(encryptor, tmp_path, batch_size=2)
+    assert report['problems'] == []
+    assert report['records'] == 4
+    assert report['reused'] == 2
+    assert sorted(decrypted) == sorted([shared[0]['encrypted_filename'], unique['encrypted_filename']])
+    assert report['bytes'] == (os.path.getsize(shared[0]['encrypted_filename'])
+                               + os.path.getsize(unique['encrypted_filename']))
+
+
+def test_corrupt_shared_file_is_reported_for_every_record(encryptor, tmp_path, decrypted):
+    shared = [add_record(encryptor, tmp_path, f"copy{i}.txt", b'same contents ' * 500) for i in range(3)]
+    path = shared[0]['encrypted_filename']
+    with open(path, 'r+b') as f:
+        f.seek(os.path.getsize(path) // 2)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 1]))
+
+    report = run_scrub(encryptor, tmp_path)
+    assert sorted(problem['record_id'] for problem in report['problems']) == [r['record_id'] for r in shared]
+    assert report['problem_counts'] == {scrub.CORRUPT: 3}
+    assert decrypted == [path]
+
+
+# Stops a scrub by failing from its progress callback after the first batch
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after_first_batch(done, total):
+    raise Interrupted()
+
+
+def interrupt_with_missing_file(encryptor, tmp_path):
+    records = [add_record(encryptor, tmp_path, f"record{i}.txt", f"record {i} ".encode() * 200)
+               for i in range(3)]
+    path = records[0]['encrypted_filename']
+    shutil.move(path, tmp_path / 'moved.enc')
+    with pytest.raises(Interrupted):
+        run_scrub(encryptor, tmp_path, batch_size=1, progress=interrupt_after_first_batch)
+    return records, path
+
+
+def test_resumed_scrub_drops_problems_that_were_fixed(encryptor, tmp_path):
+    records, path = interrupt_with_missing_file(encryptor, tmp_path)
+    shutil.move(tmp_path / 'moved.enc', path)
+
+    report = run_scrub(encryptor, tmp_path, batch_size=1)
+    assert report['resumed']
+    assert report['rechecked'] == 1
+    assert report['problems'] == []
+    assert report['records'] == 3
+
+
+def test_resumed_scrub_keeps_problems_that_are_still_there(encryptor, tmp_path):
+    records, path = interrupt_with_missing_file(encryptor, tmp_path)
+
+    report = run_scrub(encryptor, tmp_path, batch_size=1)
+    assert report['rechecked'] == 1
+    assert [(problem['kind'], problem['record_id']) for problem in report['problems']
+            if problem['record_id'] is not None] == [(scrub.MISSING_FILE, records[0]['record_id'])]
+
+
+def test_resumed_scrub_drops_problems_of_deleted_records(encryptor, tmp_path):
+    records, path = interrupt_with_missing_file(encryptor, tmp_path)
+    encryptor.store.delete(records[0]['record_id'])
+
+    report = run_scrub(encryptor, tmp_path, batch_size=1)
+    assert report['rechecked'] == 1
+    assert report['problems'] == []
+
+
+def test_orphans_are_looked_for_next_to_the_blob_store(encryptor, tmp_path, monkeypatch):
+    add_record(encryptor, tmp_path, 'kept.txt', b'kept')
+    # A flat file of an older record, one nothing points at any more, and a half-written blob
+    legacy = tmp_path / 'encrypted_legacy.txt.enc'
+    record_info = add_record(encryptor, tmp_path, 'legacy.txt', b'legacy')
+    shutil.move(record_info['encrypted_filename'], legacy)
+    encryptor.store.put(dict(record_info, encrypted_filename=str(legacy)))
+    orphan = tmp_path / 'encrypted_old.txt.enc'
+    orphan.write_bytes(b'old')
+    temp = tmp_path / 'blobs' / 'aa' / 'bb' / '9.enc.1.abcd.tmp'
+    temp.parent.mkdir(parents=True)
+    temp.write_bytes(b'partial')
+
+    # Files in the working directory belong to someone else
+    elsewhere = tmp_path / 'elsewhere'
+    elsewhere.mkdir()
+    (elsewhere / 'encrypted_other.enc').write_bytes(b'other')
+    monkeypatch.chdir(elsewhere)
+
+    problems = scrub.find_orphans(encryptor, min_age_seconds=0)
+    assert sorted((problem['kind'], problem['path']) for problem in problems) == \
+        sorted([(scrub.ORPHAN_FILE, str(orphan)), (scrub.STALE_TEMP_FILE, str(temp))])
+    assert scrub.find_orphans(encryptor, min_age_seconds=3600) == []
@@ -0,0 +1,83 @@
+# Tests for session_manager.py: timeouts, periodic purging and the on_expired callback
+
+from session_manager import SessionManager
+
+
+# A clock the tests move by hand
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_manager(clock, expired):
+    return SessionManager(idle_timeout=60, absolute_timeout=600, clock=clock, purge_interval=30,
+                          on_expired=expired.append)
+
+
+def test_idle_and_absolute_timeouts():
+    clock = FakeClock()
+    manager = make_manager(clock, [])
+    token = manager.create_session(1)
+    for _ in range(10):
+        clock.now += 59
+        assert manager.validate(token) == 1
+    clock.now += 59
+    assert manager.validate(token) is None
+
+
+def test_expired_sessions_are_purged_when_others_are_used():
+    clock = FakeClock()
+    expired = []
+    manager = make_manager(clock, expired)
+    for patient_id in range(1, 101):
+        manager.create_session(patient_id)
+
+    clock.now += 61
+    manager.create_session(200)
+    assert manager.active_count() == 1
+    assert sorted(expired) == list(range(1, 101))
+    assert manager.patient_sessions == {200: manager.patient_sessions[200]}
+
+
+def test_purges_wait_for_the_interval():
+    clock = FakeClock()
+    manager = make_manager(clock, [])
+    manager.create_session(1)
+    clock.now += 61
+    manager.create_session(2)
+    assert manager.active_count() == 1
+
+    manager.create_session(3)
+    clock.now += 20
+    manager.create_session(4)
+    assert manager.active_count() == 3
+
+
+def test_on_expired_only_fires_for_a_patients_last_session():
+    clock = FakeClock()
+    expired = []
+    manager = make_manager(clock, expired)
+    old_token = manager.create_session(1)
+    clock.now += 40
+    new_token = manager.create_session(1)
+
+    clock.now += 25
+    assert manager.validate(old_token) is None
+    assert expired == []
+    assert manager.validate(new_token) == 1
+
+    clock.now += 61
+    assert manager.validate(new_token) is None
+    assert expired == [1]
+
+
+def test_revoke_does_not_report_expiry():
+    expired = []
+    manager = make_manager(FakeClock(), expired)
+    token = manager.create_session(1)
+    assert manager.revoke(token) == 1
+    assert manager.purge_expired() == 0
+    assert expired == []
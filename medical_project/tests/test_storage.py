@@ -0,0 +1,266 @@
+# Tests for storage.py: the JSON and SQLite backends behave the same, the JSON key store
+# replays its journal, and migrating JSON into SQLite keeps every record and id counter
+
+import base64
+import hashlib
+import json
+import os
+
+import pytest
+
+from storage import (DuplicatePatientError, JsonKeyStore, JsonPatientStore, SQLiteKeyStore, SQLitePatientStore,
+                     migrate_json_to_sqlite, open_stores)
+
+
+def key_record(record_id, patient_id=1, record_type='lab', encrypted_filename=None, contents=None):
+    record_info = {
+        'record_id': record_id,
+        'patient_id': patient_id,
+        'record_type': record_type,
+        'original_filename': f"file{record_id}.pdf",
+        'encrypted_filename': encrypted_filename or f"blobs/{record_id:02x}/{record_id}.enc",
+        'created_at': '2025-03-01 12:00:00',
+        'file_size': 100 * record_id,
+        'wrapped_key': base64.b64encode(bytes([record_id]) * 60).decode(),
+        'kek_id': 'kek-1',
+    }
+    if contents is not None:
+        record_info['fingerprint'] = hashlib.sha256(contents).hexdigest()
+    return record_info
+
+
+def patient(patient_id, email=None):
+    return {
+        'patient_id': patient_id,
+        'name': f"Patient {patient_id}",
+        'ssn_hash': f"hmac_sha256${hashlib.sha256(str(patient_id).encode()).hexdigest()}",
+        'pin_hash': 'pbkdf2_sha256$1000$c2FsdA==$aGFzaA==',
+        'password_hash': 'pbkdf2_sha256$1000$c2FsdA==$aGFzaA==',
+        'email': email or f"patient{patient_id}@example.com",
+        'registered_at': '2025-03-01 12:00:00',
+    }
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def stores(request, tmp_path):
+    patient_store, key_store = open_stores(request.param, str(tmp_path / 'medical.db'),
+                                           str(tmp_path / 'patients_data.json'),
+                                           str(tmp_path / 'encryption_keys.json'))
+    yield patient_store, key_store
+    key_store.close()
+    patient_store.close()
+
+
+def test_key_store_put_get_and_delete(stores):
+    key_store = stores[1]
+    key_store.put_many([key_record(1), key_record(2, patient_id=2), key_record(3, record_type='xray')])
+    assert len(key_store) == 3
+    assert sorted(key_store) == [1, 2, 3]
+    assert 2 in key_store and 4 not in key_store
+    assert dict(key_store[1]) == key_record(1)
+    assert key_store.get(4) is None
+
+    assert dict(key_store.delete(2)) == key_record(2, patient_id=2)
+    assert key_store.delete(2) is None
+    assert sorted(key_store) == [1, 3]
+
+
+def test_key_store_patient_index_follows_updates(stores):
+    key_store = stores[1]
+    key_store.put_many([key_record(1), key_record(2), key_record(3, patient_id=2)])
+    assert sorted(key_store.record_ids_for_patient(1)) == [1, 2]
+    assert sorted(key_store.record_ids_for_patient(1, 'lab')) == [1, 2]
+
+    # A record changing type or patient moves in the index
+    key_store.put(key_record(2, record_type='xray'))
+    key_store.put(key_record(3, patient_id=1))
+    assert sorted(key_store.record_ids_for_patient(1)) == [1, 2, 3]
+    assert sorted(key_store.record_ids_for_patient(1, 'xray')) == [2]
+    assert key_store.record_ids_for_patient(2) == []
+    assert sorted(record_info['record_id'] for record_info in key_store.records_for_patient(1, 'lab')) == [1, 3]
+
+    key_store.delete(1)
+    assert sorted(key_store.record_ids_for_patient(1)) == [2, 3]
+
+
+def test_key_store_file_references_and_fingerprints(stores):
+    key_store = stores[1]
+    shared = 'blobs/01/1.enc'
+    key_store.put_many([key_record(1, encrypted_filename=shared, contents=b'a'),
+                        key_record(2, encrypted_filename=shared, contents=b'a'),
+                        key_record(3, contents=b'b')])
+    assert key_store.file_reference_count(shared) == 2
+    assert key_store.is_file_referenced(shared)
+    fingerprint = hashlib.sha256(b'a').hexdigest()
+    assert [record_info['record_id'] for record_info in key_store.records_with_fingerprint(fingerprint)] == [1, 2]
+
+    key_store.delete(1)
+    assert key_store.file_reference_count(shared) == 1
+    assert [record_info['record_id'] for record_info in key_store.records_with_fingerprint(fingerprint)] == [2]
+    key_store.delete(2)
+    assert not key_store.is_file_referenced(shared)
+    assert key_store.records_with_fingerprint(fingerprint) == []
+
+
+def test_key_store_finds_plaintext_keys(stores):
+    key_store = stores[1]
+    legacy = key_record(2)
+    del legacy['wrapped_key'], legacy['kek_id']
+    legacy['encryption_key'] = base64.urlsafe_b64encode(bytes(32)).decode()
+    key_store.put_many([key_record(1), legacy])
+    assert [record_info['record_id'] for record_info in key_store.records_with_plaintext_key()] == [2]
+
+
+def test_record_ids_are_never_handed_out_twice(stores):
+    key_store = stores[1]
+    key_store.put(key_record(5))
+    record_ids = [key_store.allocate_record_id() for _ in range(20)]
+    assert len(set(record_ids)) == 20
+    assert min(record_ids) > 5
+
+
+def test_patient_store_lookups_follow_updates(stores):
+    patient_store = stores[0]
+    patient_store.put(patient(1))
+    patient_store.put(patient(2))
+    patient_store.save()
+    assert patient_store.find_by_email('patient2@example.com')['patient_id'] == 2
+    assert patient_store.find_by_ssn_hash(patient(1)['ssn_hash'])['patient_id'] == 1
+    assert patient_store.find_by_ssn_hash('hmac_sha256$missing') is None
+
+    patient_store.put(patient(2, email='new@example.com'))
+    patient_store.save()
+    assert patient_store.find_by_email('new@example.com')['patient_id'] == 2
+    assert patient_store.find_by_email('patient2@example.com') is None
+    assert patient_store.allocate_patient_id() > 2
+
+
+def test_json_key_store_replays_its_journal(tmp_path):
+    keys_path = str(tmp_path / 'encryption_keys.json')
+    key_store = JsonKeyStore(keys_path)
+    key_store.put_many([key_record(1), key_record(2)])
+    key_store.save()
+    key_store.put(key_record(3))
+    key_store.put(key_record(1, record_type='xray'))
+    key_store.delete(2)
+
+    # The changes since the snapshot are only in the journal
+    with open(keys_path) as f:
+        assert sorted(json.load(f)) == ['1', '2']
+    reloaded = JsonKeyStore(keys_path)
+    reloaded.load()
+    assert sorted(reloaded) == [1, 3]
+    assert reloaded[1]['record_type'] == 'xray'
+    assert reloaded.record_ids_for_patient(1, 'xray') == [1]
+
+    reloaded.save()
+    assert reloaded.journal.journal_entries == 0
+    again = JsonKeyStore(keys_path)
+    again.load()
+    assert {record_id: dict(record_info) for record_id, record_info in again.items()} == \
+        {record_id: dict(record_info) for record_id, record_info in reloaded.items()}
+
+
+def test_migration_copies_everything_and_can_run_again(tmp_path):
+    patients_path = str(tmp_path / 'patients_data.json')
+    keys_path = str(tmp_path / 'encryption_keys.json')
+    db_path = str(tmp_path / 'medical.db')
+    patients = JsonPatientStore(patients_path)
+    patients.put(patient(1))
+    patients.put(patient(7))
+    patients.save()
+    keys = JsonKeyStore(keys_path)
+    keys.put_many([key_record(1), key_record(2, contents=b'x')])
+    keys.save()
+    # Left in the journal only
+    keys.put(key_record(9, patient_id=7))
+    keys.close()
+
+    assert migrate_json_to_sqlite(db_path, patients_path, keys_path) == (2, 3)
+    assert migrate_json_to_sqlite(db_path, patients_path, keys_path) == (2, 3)
+
+    sqlite_patients = SQLitePatientStore(db_path)
+    sqlite_keys = SQLiteKeyStore(db_path)
+    assert sorted(sqlite_patients) == [1, 7]
+    assert sqlite_patients.find_by_email('patient7@example.com')['patient_id'] == 7
+    assert sorted(sqlite_keys) == [1, 2, 9]
+    assert sqlite_keys[2] == key_record(2, contents=b'x')
+    assert sqlite_keys.record_ids_for_patient(7) == [9]
+    assert sqlite_keys.allocate_record_id() > 9
+    assert sqlite_patients.allocate_patient_id() > 7
+
+
+def test_sqlite_patient_with_a_taken_ssn_hash_is_refused(tmp_path):
+    patients = SQLitePatientStore(str(tmp_path / 'medical.db'))
+    patients.put(patient(1))
+    duplicate = dict(patient(2), ssn_hash=patient(1)['ssn_hash'])
+    with pytest.raises(DuplicatePatientError):
+        patients.put_many([patient(3), duplicate])
+    # The other patient is kept and nothing of the failed write is stored
+    assert sorted(patients) == [1]
+    assert patients[1] == patient(1)
+
+    # Updating a patient in place is not a conflict with itself
+    patients.put(patient(1, email='new@example.com'))
+    assert patients.find_by_ssn_hash(patient(1)['ssn_hash'])['email'] == 'new@example.com'
+
+
+def test_migration_stops_on_duplicate_ssn_hashes(tmp_path):
+    patients_path = str(tmp_path / 'patients_data.json')
+    db_path = str(tmp_path / 'medical.db')
+    patients = JsonPatientStore(patients_path)
+    patients.put(patient(1))
+    patients.put(dict(patient(2), ssn_hash=patient(1)['ssn_hash']))
+    patients.save()
+
+    with pytest.raises(DuplicatePatientError):
+        migrate_json_to_sqlite(db_path, patients_path, str(tmp_path / 'encryption_keys.json'))
+    assert len(SQLitePatientStore(db_path)) == 0
+
+
+def test_in_memory_database_leaves_no_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    patients = SQLitePatientStore(':memory:')
+    keys = SQLiteKeyStore(':memory:', db=patients.db)
+    with keys.locked():
+        keys.put(key_record(1))
+        assert keys.file_reference_count(key_record(1)['encrypted_filename']) == 1
+    patients.put(patient(1))
+    assert keys.allocate_record_id() > 1
+    assert os.listdir(tmp_path) == []
+
+
+def test_migration_skips_ids_reserved_by_running_processes(tmp_path):
+    patients_path = str(tmp_path / 'patients_data.json')
+    keys_path = str(tmp_path / 'encryption_keys.json')
+    db_path = str(tmp_path / 'medical.db')
+    patients = JsonPatientStore(patients_path)
+    patients.put(patient(1))
+    patients.save()
+    keys = JsonKeyStore(keys_path)
+    keys.put(key_record(1))
+    keys.save()
+
+    # Another process has reserved id blocks but not stored anything with them yet
+    running_keys = JsonKeyStore(keys_path)
+    running_keys.load()
+    handed_out_record_id = running_keys.allocate_record_id()
+    running_patients = JsonPatientStore(patients_path)
+    running_patients.load()
+    running_patients.allocate_patient_id()
+    reserved_record_ids = running_keys.record_ids.next_unreserved()
+    reserved_patient_ids = running_patients.patient_ids.next_unreserved()
+    assert reserved_record_ids > handed_out_record_id + 1
+
+    migrate_json_to_sqlite(db_path, patients_path, keys_path)
+    sqlite_patients = SQLitePatientStore(db_path)
+    sqlite_keys = SQLiteKeyStore(db_path, db=sqlite_patients.db)
+    assert sqlite_keys.allocate_record_id() >= reserved_record_ids
+    assert sqlite_patients.allocate_patient_id() >= reserved_patient_ids
+
+    # Running the migration again never moves a counter back
+    allocated = [sqlite_keys.allocate_record_id() for _ in range(5)]
+    migrate_json_to_sqlite(db_path, patients_path, keys_path)
+    assert sqlite_keys.allocate_record_id() > max(allocated)
+    running_keys.close()
+    keys.close()
@@ -0,0 +1,153 @@
+# Tests for stream_cipher.py and record_keyring.py: every change to a container (tampered bytes,
+# truncation, reordered or extra chunks) fails decryption, also through a reused cipher
+
+import io
+import os
+import struct
+
+import pytest
+from cryptography.fernet import Fernet
+
+from encryption import MedicalFileEncryptor
+from key_wrapping import MasterKeyStore
+from metrics import MetricsRegistry
+from record_keyring import RecordKeyring
+from stream_cipher import (HEADER_SIZE, TAG_SIZE, StreamDecryptionError, decrypt_stream, encrypt_stream,
+                           iter_decrypted_chunks)
+
+CHUNK_SIZE = 64
+# Three full chunks and a short final one
+PLAINTEXT = bytes(range(256)) * 3 + b'tail'
+CHUNK_BYTES = 4 + CHUNK_SIZE + TAG_SIZE
+
+
+def encrypt(key, plaintext=PLAINTEXT, chunk_size=CHUNK_SIZE):
+    out_file = io.BytesIO()
+    encrypt_stream(key, io.BytesIO(plaintext), out_file, chunk_size)
+    return out_file.getvalue()
+
+
+def decrypt(key, container):
+    return b''.join(iter_decrypted_chunks(key, io.BytesIO(container)))
+
+
+@pytest.fixture
+def key():
+    return Fernet.generate_key()
+
+
+@pytest.mark.parametrize('size', [0, 1, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1, 3 * CHUNK_SIZE, len(PLAINTEXT)])
+def test_round_trip(key, size):
+    plaintext = PLAINTEXT[:size]
+    out_file = io.BytesIO()
+    assert decrypt_stream(key, io.BytesIO(encrypt(key, plaintext)), out_file) == size
+    assert out_file.getvalue() == plaintext
+
+
+# Offsets in the magic, chunk size, nonce prefix, a chunk length, ciphertext and tags
+@pytest.mark.parametrize('offset', [0, 9, HEADER_SIZE - 1, HEADER_SIZE, HEADER_SIZE + 4,
+                                    HEADER_SIZE + CHUNK_BYTES - 1, HEADER_SIZE + 2 * CHUNK_BYTES + 10, -1])
+def test_any_flipped_byte_fails(key, offset):
+    container = bytearray(encrypt(key))
+    container[offset] ^= 0x01
+    with pytest.raises(StreamDecryptionError):
+        decrypt(key, bytes(container))
+
+
+# Cut inside the header, at chunk boundaries (whole chunks dropped), inside a length and inside a chunk
+@pytest.mark.parametrize('length', [0, HEADER_SIZE - 1, HEADER_SIZE, HEADER_SIZE + 2, HEADER_SIZE + CHUNK_BYTES,
+                                    HEADER_SIZE + 3 * CHUNK_BYTES, HEADER_SIZE + 3 * CHUNK_BYTES + 10])
+def test_truncated_container_fails(key, length):
+    container = encrypt(key)
+    assert length < len(container)
+    with pytest.raises(StreamDecryptionError):
+        decrypt(key, container[:length])
+
+
+def test_truncation_is_detected_even_when_earlier_chunks_are_yielded(key):
+    container = encrypt(key)[:HEADER_SIZE + 2 * CHUNK_BYTES]
+    chunks = iter_decrypted_chunks(key, io.BytesIO(container))
+    assert next(chunks) == PLAINTEXT[:CHUNK_SIZE]
+    assert next(chunks) == PLAINTEXT[CHUNK_SIZE:2 * CHUNK_SIZE]
+    with pytest.raises(StreamDecryptionError):
+        next(chunks)
+
+
+def test_dropping_the_final_chunk_and_marking_an_earlier_one_final_fails(key):
+    container = bytearray(encrypt(key)[:HEADER_SIZE + CHUNK_BYTES])
+    length = struct.unpack('>I', container[HEADER_SIZE:HEADER_SIZE + 4])[0]
+    container[HEADER_SIZE:HEADER_SIZE + 4] = struct.pack('>I', length | 0x80000000)
+    with pytest.raises(StreamDecryptionError):
+        decrypt(key, bytes(container))
+
+
+def test_swapped_chunks_fail(key):
+    container = encrypt(key)
+    first = container[HEADER_SIZE:HEADER_SIZE + CHUNK_BYTES]
+    second = container[HEADER_SIZE + CHUNK_BYTES:HEADER_SIZE + 2 * CHUNK_BYTES]
+    swapped = container[:HEADER_SIZE] + second + first + container[HEADER_SIZE + 2 * CHUNK_BYTES:]
+    with pytest.raises(StreamDecryptionError):
+        decrypt(key, swapped)
+
+
+def test_data_after_the_final_chunk_fails(key):
+    with pytest.raises(StreamDecryptionError):
+        decrypt(key, encrypt(key) + b'\x00')
+
+
+def test_chunks_from_another_container_fail(key):
+    container = encrypt(key)
+    other = encrypt(key)
+    # Same key, same chunk positions, different header (nonce prefix)
+    with pytest.raises(StreamDecryptionError):
+        decrypt(key, container[:HEADER_SIZE] + other[HEADER_SIZE:])
+
+
+def test_wrong_key_fails(key):
+    with pytest.raises(StreamDecryptionError):
+        decrypt(Fernet.generate_key(), encrypt(key))
+
+
+def test_reused_keyring_cipher_still_rejects_tampering(key):
+    keyring = RecordKeyring()
+    container = encrypt(key)
+    cipher = keyring.stream_cipher(1, key)
+    assert decrypt(cipher, container) == PLAINTEXT
+    assert keyring.stream_cipher(1, key) is cipher
+
+    tampered = bytearray(container)
+    tampered[HEADER_SIZE + CHUNK_BYTES + 10] ^= 0x01
+    with pytest.raises(StreamDecryptionError):
+        decrypt(keyring.stream_cipher(1, key), bytes(tampered))
+    assert keyring.stats()['hits'] == 2
+
+
+def test_changed_key_gets_a_new_cipher(key):
+    keyring = RecordKeyring()
+    cipher = keyring.stream_cipher(1, key)
+    assert keyring.stream_cipher(1, Fernet.generate_key()) is not cipher
+
+
+def test_tampered_record_is_not_returned_or_written(tmp_path):
+    encryptor = MedicalFileEncryptor(keys_path=str(tmp_path / 'encryption_keys.json'), metrics=MetricsRegistry(),
+                                     master_keys=MasterKeyStore(str(tmp_path / 'master_keys.json')),
+                                     blob_root=str(tmp_path / 'blobs'))
+    encryptor.chunk_size = CHUNK_SIZE
+    source = tmp_path / 'scan.bin'
+    source.write_bytes(os.urandom(10 * CHUNK_SIZE))
+    record_info = encryptor.encrypt_file(str(source), patient_id=1, record_type='xray')
+    record_id = record_info['record_id']
+    assert encryptor.read_record(record_id) == source.read_bytes()
+
+    # Damage the last chunk, so earlier chunks still decrypt before the failure
+    encrypted_filename = record_info['encrypted_filename']
+    with open(encrypted_filename, 'r+b') as f:
+        f.seek(-5, os.SEEK_END)
+        f.write(b'\x00' * 5)
+    encryptor.cache.invalidate(record_id)
+
+    assert encryptor.read_record(record_id) is None
+    output_path = tmp_path / 'out.bin'
+    assert encryptor.decrypt_file(record_id, str(output_path)) is None
+    # Neither the output nor the temporary file it is written through is left behind
+    assert not [name for name in os.listdir(tmp_path) if name.startswith('out.bin')]